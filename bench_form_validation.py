@@ -0,0 +1,58 @@
+'''
+Microbenchmark of form validation, the per-request cost of checking the
+input of each of the blog-engine's forms against its form_schema schema.
+
+    python bench_form_validation.py [--repeat 5] [--number 20000]
+
+Created on Jul 16, 2017
+@author: kennethalamantia
+'''
+
+import argparse
+import sys
+import timeit
+import form_schema
+from blog_constants import USER, PASSWORD, PWD_VERIFY, EMAIL, SUBJECT, CONTENT
+
+# Benchmark defaults
+DEFAULT_REPEAT = 5
+DEFAULT_NUMBER = 20000
+
+# Sample input of each form, valid and invalid
+SAMPLE_FORMS = [
+    ("signup", form_schema.SIGNUP_FORM,
+     {USER : "some_user", PASSWORD : "secret", PWD_VERIFY : "secret",
+      EMAIL : "some_user@example.com"}),
+    ("signup, bad user", form_schema.SIGNUP_FORM,
+     {USER : "x", PASSWORD : "secret", PWD_VERIFY : "secret", EMAIL : ""}),
+    ("login", form_schema.LOGIN_FORM,
+     {USER : "some_user", PASSWORD : "secret"}),
+    ("post", form_schema.POST_FORM,
+     {SUBJECT : "A subject", CONTENT : "A paragraph of content.\n" * 200}),
+    ("post, long subject", form_schema.POST_FORM,
+     {SUBJECT : "x" * 10000, CONTENT : "content"}),
+    ("comment", form_schema.COMMENT_FORM,
+     {CONTENT : "A short comment."}),
+    ]
+
+
+def main():
+    '''Runs the benchmark and prints the report.
+    @return: the int exit status
+    '''
+    parser = argparse.ArgumentParser(description="Form validation benchmark")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="number of timing runs, the best is reported")
+    parser.add_argument("--number", type=int, default=DEFAULT_NUMBER,
+                        help="number of validations per timing run")
+    args = parser.parse_args()
+    print "%-22s %12s" % ("form", "us/request")
+    for name, schema, form in SAMPLE_FORMS:
+        best = min(timeit.repeat(lambda: schema.validate(form.get),
+                                 repeat=args.repeat, number=args.number))
+        print "%-22s %12.2f" % (name, best / args.number * 1000000)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
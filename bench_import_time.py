@@ -0,0 +1,167 @@
+'''
+Benchmark of the cost of importing the blog-engine's modules, the main part
+of an App Engine instance's start-up time. Imports a module in a fresh
+interpreter with a timing hook on __import__, then has its WSGI application
+resolve the handlers of one or more routes, as the first request to each
+route does, and reports the time spent loading each module, excluding the
+modules it imported itself.
+
+    python bench_import_time.py [--module blog_app] [--app app]
+                                [--route /blog/display/home] [--top 20]
+                                [--max-ms 500]
+
+Since handlers are loaded lazily, importing the application alone is cheap;
+most of the start-up cost is paid by the first routed request and is
+reported per route. Exits with status 1 if the import time plus the route
+resolution time exceeds --max-ms, so it can guard against start-up
+regressions. The App Engine SDK must be on the PYTHONPATH.
+
+Created on Jul 13, 2017
+@author: kennethalamantia
+'''
+
+import __builtin__
+import argparse
+import sys
+import timeit
+
+# Benchmark defaults
+DEFAULT_MODULE = "blog_app"
+DEFAULT_APP = "app"
+DEFAULT_ROUTES = ["/blog/display/home"]
+DEFAULT_TOP = 20
+
+
+class ImportTimer(object):
+    '''Class timing every first import of a module while installed as
+    __import__.
+    Attributes:
+        self_times: dict of seconds spent loading each module, excluding
+                    nested imports, keyed by module name
+        total_times: dict of seconds spent loading each module, including
+                     nested imports, keyed by module name
+        _stack: list of the seconds spent in nested imports of the modules
+                currently being loaded
+        _real_import: the __import__ function being wrapped
+    '''
+
+    def __init__(self):
+        self.self_times = {}
+        self.total_times = {}
+        self._stack = []
+        self._real_import = __builtin__.__import__
+
+    def install(self):
+        '''Replaces __import__ with the timing hook.
+        '''
+        __builtin__.__import__ = self._timed_import
+
+    def uninstall(self):
+        '''Restores the real __import__.
+        '''
+        __builtin__.__import__ = self._real_import
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=None,
+                      level=-1):
+        '''Times an import if it loads a module for the first time. An import
+        of submodules from an already loaded package, as in
+        "from pkg import mod", is charged to the submodules it loads.
+        '''
+        parent = sys.modules.get(name)
+        if parent is not None and not [
+                item for item in fromlist or () if item != "*" and
+                not hasattr(parent, item)]:
+            return self._real_import(name, globals, locals, fromlist, level)
+        loaded = set(sys.modules) if parent is not None else None
+        self._stack.append(0.0)
+        start = timeit.default_timer()
+        try:
+            return self._real_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = timeit.default_timer() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            if loaded is not None:
+                submodules = [name + "." + item for item in fromlist
+                              if name + "." + item not in loaded and
+                              sys.modules.get(name + "." + item)]
+                name = ", ".join(submodules) or name
+            self.total_times[name] = self.total_times.get(name, 0.0) + elapsed
+            self.self_times[name] = (self.self_times.get(name, 0.0) +
+                                     elapsed - nested)
+
+
+def resolve_route(app, path):
+    '''Matches a path against an application's routes and loads the
+    handler of the matching route, as webapp2 does on the first request
+    routed to it.
+    @param app: the webapp2.WSGIApplication
+    @param path: the request path
+    @return: the handler class
+    @raise ValueError: if no route matches the path
+    '''
+    import webapp2
+    match = app.router.match(webapp2.Request.blank(path))
+    if match is None:
+        raise ValueError("No route matches " + path)
+    handler = match[0].handler
+    if isinstance(handler, basestring):
+        handler = webapp2.import_string(handler)
+    return handler
+
+
+def main():
+    '''Runs the benchmark and prints the report.
+    @return: the int exit status
+    '''
+    parser = argparse.ArgumentParser(description="Import time benchmark")
+    parser.add_argument("--module", default=DEFAULT_MODULE,
+                        help="module to import")
+    parser.add_argument("--app", default=DEFAULT_APP,
+                        help="name of the module's WSGI application")
+    parser.add_argument("--route", action="append", default=None,
+                        help="path of a route whose handler to load, "
+                        "repeatable")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP,
+                        help="number of slowest modules to list")
+    parser.add_argument("--max-ms", type=float, default=None,
+                        help="fail if the import and route time exceeds this")
+    args = parser.parse_args()
+    if args.module in sys.modules:
+        parser.error("%s is already imported" % args.module)
+    timer = ImportTimer()
+    route_ms = []
+    timer.install()
+    start = timeit.default_timer()
+    try:
+        module = __import__(args.module)
+        import_ms = (timeit.default_timer() - start) * 1000
+        for path in args.route or DEFAULT_ROUTES:
+            route_start = timeit.default_timer()
+            resolve_route(getattr(module, args.app), path)
+            route_ms.append((path, (timeit.default_timer() - route_start) *
+                             1000))
+    finally:
+        total_ms = (timeit.default_timer() - start) * 1000
+        timer.uninstall()
+    slowest = sorted(timer.self_times.iteritems(), key=lambda item: item[1],
+                     reverse=True)[:args.top]
+    print "%-50s %10s %10s" % ("module", "self ms", "total ms")
+    for name, seconds in slowest:
+        print "%-50s %10.1f %10.1f" % (name, seconds * 1000,
+                                       timer.total_times[name] * 1000)
+    print "%s imported in %.1f ms" % (args.module, import_ms)
+    for path, milliseconds in route_ms:
+        print "First request to %s loaded its handler in %.1f ms" % (
+            path, milliseconds)
+    print "%d modules loaded in %.1f ms" % (len(timer.self_times), total_ms)
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print "FAIL: %.1f ms exceeds the limit of %.1f ms" % (total_ms,
+                                                              args.max_ms)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
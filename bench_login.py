@@ -0,0 +1,101 @@
+'''
+Benchmark of password hashing, for choosing blog_utilities.PWD_ITERATIONS.
+Times PwdUtil hashing a password at several PBKDF2 iteration counts, with
+a number of concurrent logins, and reports the highest count whose median
+latency meets a target.
+
+    python bench_login.py [--target-ms 100] [--threads 4] [--logins 40]
+                          [--iterations 10000 25000 50000 100000 200000]
+
+Run it on hardware like the instance class the app is deployed on. The App
+Engine SDK must be on the PYTHONPATH.
+
+Created on Jul 15, 2017
+@author: kennethalamantia
+'''
+
+import argparse
+import sys
+import threading
+import timeit
+from blog_utilities import PwdUtil
+
+# Benchmark defaults
+DEFAULT_TARGET_MS = 100.0
+DEFAULT_THREADS = 4
+DEFAULT_LOGINS = 40
+DEFAULT_ITERATIONS = [10000, 25000, 50000, 100000, 200000]
+PASSWORD = "benchmark password"
+
+
+def time_logins(iterations, num_threads, num_logins):
+    '''Verifies a password num_logins times, spread over num_threads threads.
+    @param iterations: the PBKDF2 iteration count of the stored password
+    @param num_threads: the number of concurrent logins
+    @param num_logins: the total number of logins
+    @return: tuple of the sorted list of login latencies in seconds and the
+    wall clock time of the whole run in seconds
+    '''
+    db_password = PwdUtil(PASSWORD,
+                          iterations=iterations).new_pwd_salt_pair()
+    latencies = []
+    lock = threading.Lock()
+
+    def _worker(count):
+        for dummy_idx in range(count):
+            start = timeit.default_timer()
+            PwdUtil(PASSWORD, db_password).verify_password()
+            elapsed = timeit.default_timer() - start
+            with lock:
+                latencies.append(elapsed)
+    counts = [num_logins // num_threads + (1 if idx < num_logins % num_threads
+                                           else 0)
+              for idx in range(num_threads)]
+    threads = [threading.Thread(target=_worker, args=(count,))
+               for count in counts]
+    start = timeit.default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), timeit.default_timer() - start
+
+
+def main():
+    '''Runs the benchmark and prints the report.
+    @return: the int exit status
+    '''
+    parser = argparse.ArgumentParser(description="Login hashing benchmark")
+    parser.add_argument("--target-ms", type=float, default=DEFAULT_TARGET_MS,
+                        help="target median login latency")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS,
+                        help="number of concurrent logins")
+    parser.add_argument("--logins", type=int, default=DEFAULT_LOGINS,
+                        help="total number of logins per iteration count")
+    parser.add_argument("--iterations", type=int, nargs="+",
+                        default=DEFAULT_ITERATIONS,
+                        help="PBKDF2 iteration counts to time")
+    args = parser.parse_args()
+    print "%12s %10s %10s %12s" % ("iterations", "p50 ms", "p95 ms",
+                                   "logins/s")
+    best = None
+    for iterations in sorted(args.iterations):
+        latencies, wall_time = time_logins(iterations, args.threads,
+                                           args.logins)
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[min(len(latencies) - 1,
+                            int(len(latencies) * 0.95))] * 1000
+        print "%12d %10.1f %10.1f %12.1f" % (iterations, p50, p95,
+                                             len(latencies) / wall_time)
+        if p50 <= args.target_ms:
+            best = iterations
+    if best is None:
+        print "No iteration count meets a median of %.1f ms" % args.target_ms
+        return 1
+    print "Highest iteration count within %.1f ms: %d" % (args.target_ms,
+                                                         best)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
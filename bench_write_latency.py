@@ -0,0 +1,113 @@
+'''
+Benchmark of the blog-engine's write paths. Creates and deletes posts and
+comments against the App Engine testbed's datastore stub, and reports the
+latency of each write and the number of API calls it makes.
+
+    python bench_write_latency.py [--writes 50]
+
+The stub has no network round trips, so the latencies only compare write
+paths with each other; the call counts carry over to production. The App
+Engine SDK must be on the PYTHONPATH.
+
+Created on Jul 20, 2017
+@author: kennethalamantia
+'''
+
+import argparse
+import sys
+import timeit
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+import blog_constants as bc
+import rpc_accounting
+from ndb_models import User, BlogPost, Comment, HomeFeed
+
+# Benchmark defaults
+DEFAULT_WRITES = 50
+AUTHOR = "bench_author"
+COMMENTER = "bench_commenter"
+FORM_DATA = {bc.USER: AUTHOR, bc.PASSWORD: "bench password",
+             bc.SUBJECT: "benchmark subject",
+             bc.CONTENT: "benchmark content " * 20}
+# Kinds of write, in the order they are reported
+WRITES = ("create_post", "create_comment", "delete_comment", "delete_post")
+# API call categories reported per write; "other" includes transaction
+# begins and commits.
+CATEGORIES = ("datastore_get", "datastore_put", "datastore_delete", "other")
+
+
+def time_write(write_fun):
+    '''Times one write and counts the API calls it makes.
+    @param write_fun: function making the write
+    @return: tuple of the write's latency in seconds, its RpcStats and the
+    return value of write_fun
+    '''
+    with rpc_accounting.measure() as stats:
+        start = timeit.default_timer()
+        result = write_fun()
+        elapsed = timeit.default_timer() - start
+    return elapsed, stats, result
+
+
+def run(num_writes):
+    '''Makes num_writes of each kind of write in a fresh testbed.
+    @param num_writes: the number of writes of each kind
+    @return: list of tuples of the name of each kind of write, the sorted
+    list of its latencies and the list of its RpcStats
+    '''
+    User.create_new_user(FORM_DATA)
+    HomeFeed.rebuild()
+    results = dict((name, ([], [])) for name in WRITES)
+
+    def _record(name, write_fun):
+        elapsed, stats, result = time_write(write_fun)
+        results[name][0].append(elapsed)
+        results[name][1].append(stats)
+        return result
+    for dummy_idx in range(num_writes):
+        post_key = _record("create_post", lambda: BlogPost.create_new_post(
+            AUTHOR, FORM_DATA))
+        comment_key = _record("create_comment",
+                              lambda: Comment.create_new_comment(
+                                  COMMENTER, post_key.urlsafe(), FORM_DATA))
+        _record("delete_comment",
+                lambda: Comment.delete_comment(comment_key.get()))
+        _record("delete_post", lambda: BlogPost.delete_post(post_key.get()))
+    return [(name, sorted(results[name][0]), results[name][1])
+            for name in WRITES]
+
+
+def main():
+    '''Runs the benchmark and prints the report.
+    @return: the int exit status
+    '''
+    parser = argparse.ArgumentParser(description="Write latency benchmark")
+    parser.add_argument("--writes", type=int, default=DEFAULT_WRITES,
+                        help="number of writes of each kind")
+    args = parser.parse_args()
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+    ndb.get_context().set_cache_policy(False)
+    try:
+        report = run(args.writes)
+    finally:
+        bed.deactivate()
+    print "%-16s %10s %10s" % ("write", "mean ms", "p95 ms") + "".join(
+        " %16s" % category for category in CATEGORIES)
+    for name, latencies, all_stats in report:
+        mean = sum(latencies) / len(latencies) * 1000
+        p95 = latencies[min(len(latencies) - 1,
+                            int(len(latencies) * 0.95))] * 1000
+        calls = ["%16.1f" % (float(sum(stats.count(category)
+                                       for stats in all_stats)) /
+                             len(all_stats))
+                 for category in CATEGORIES]
+        print "%-16s %10.2f %10.2f %s" % (name, mean, p95, " ".join(calls))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
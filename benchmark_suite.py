@@ -0,0 +1,383 @@
+'''
+Microbenchmark suite of the blog-engine's request handlers and hot helpers.
+Times each benchmark on testbed datastores holding standard corpus_generator
+corpora, saves the results as JSON and compares them with a stored baseline:
+
+    python benchmark_suite.py [--sizes tiny small] [--rounds 5]
+                              [--filter Login] [--json results.json]
+                              [--baseline benchmark_baseline.json]
+                              [--threshold 10] [--threshold-for Login.post=25]
+                              [--save-baseline]
+
+A benchmark regresses when its median time per call is more than its
+threshold percentage above the baseline; the suite then exits with status 1,
+so it can gate a deploy. Save a baseline with --save-baseline on the machine
+the suite is gated on, since times do not carry over between machines.
+
+Handlers are called through the WSGI application without the RPC accounting
+middleware. Caches are warm after the first call of each benchmark, which is
+not timed, so the times are those of a steady stream of requests.
+
+Created on Jul 25, 2017
+@author: kennethalamantia
+'''
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import re
+import sys
+import timeit
+import blog_constants as bc
+import corpus_generator
+
+# Suite defaults
+DEFAULT_SIZES = ["tiny", "small"]
+DEFAULT_ROUNDS = 5
+DEFAULT_ITERATIONS = 20
+# Benchmarks of password hashing run fewer iterations per round.
+HASHING_ITERATIONS = 3
+DEFAULT_THRESHOLD_PCT = 10.0
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+# Request paths
+HOME_PATH = "/blog/display/home"
+POST_PATH = "/blog/post_id/%s/display/display_post"
+LIKE_PATH = "/blog/post_id/%s/like_post/home"
+COMMENT_PATH = "/blog/post_id/%s/comment/new/display_post"
+EDIT_PATH = "/blog/post_id/%s/edit"
+LOGIN_PATH = "/blog/login"
+SIGNUP_PATH = "/blog/signup/display"
+SIGNUP_USER_FORMAT = "bench%07d"
+
+
+class Benchmark(object):
+    '''Class describing one benchmark.
+    Attributes:
+        name: the name the benchmark is reported under
+        fun: the function to time, called without arguments. Handler
+             benchmarks return the response.
+        iterations: the number of calls per round
+        expected_status: the int status every response must have, or None
+    '''
+
+    def __init__(self, name, fun, iterations=DEFAULT_ITERATIONS,
+                 expected_status=None):
+        self.name = name
+        self.fun = fun
+        self.iterations = iterations
+        self.expected_status = expected_status
+
+    def check(self):
+        '''Calls the function once, untimed, warming up its caches.
+        @raise ValueError: if the response has an unexpected status, since
+        an error page would make a broken handler look fast
+        '''
+        result = self.fun()
+        if (self.expected_status is not None and
+                result.status_int != self.expected_status):
+            raise ValueError("%s returned status %d, expected %d" % (
+                self.name, result.status_int, self.expected_status))
+
+    def time(self, rounds):
+        '''Times the function.
+        @param rounds: the number of rounds of iterations to time
+        @return: dict of the median and minimum time per call in
+        microseconds over the rounds
+        '''
+        per_call = []
+        for dummy_round in range(rounds):
+            start = timeit.default_timer()
+            for dummy_idx in range(self.iterations):
+                self.fun()
+            per_call.append((timeit.default_timer() - start) /
+                            self.iterations)
+        per_call.sort()
+        return {"median_us": per_call[len(per_call) // 2] * 1e6,
+                "min_us": per_call[0] * 1e6,
+                "rounds": rounds,
+                "iterations": self.iterations}
+
+
+class Fixture(object):
+    '''A testbed holding a corpus in the app's storage backend, and the
+    requests made against it. Deactivate it with close.
+    Attributes:
+        corpus: the corpus_generator.Corpus in the app's storage
+        hot_post_id: the id of the corpus's hottest post
+        author: the user name of the hot post's author
+        reader: the user name of another user
+        _testbed: the active testbed
+    '''
+
+    def __init__(self, size, seed):
+        from google.appengine.ext import testbed
+        import blog_storage
+        self._testbed = testbed.Testbed()
+        self._testbed.activate()
+        self._testbed.init_datastore_v3_stub()
+        self._testbed.init_memcache_stub()
+        self._testbed.init_taskqueue_stub()
+        self._testbed.init_user_stub()
+        self.corpus = corpus_generator.build_corpus(
+            blog_storage.app_storage(), corpus_generator.SIZES[size], seed)
+        self.hot_post_id = self.corpus.hot_post_ids[0]
+        self.author = self.post_author(self.hot_post_id)
+        self.reader = [user_name for user_name in self.corpus.user_names
+                       if user_name != self.author][0]
+
+    def post_author(self, post_id):
+        '''Returns the user name of the author of a post.
+        '''
+        import blog_storage
+        return blog_storage.app_storage().get_post(post_id).author
+
+    def cookie_headers(self, user_name):
+        '''Returns the request headers of a logged in user.
+        '''
+        from blog_utilities import CookieUtil
+        return [("Cookie", CookieUtil._format_cookie(bc.USER, user_name))]
+
+    def request(self, path, form=None, user_name=None):
+        '''Makes a request of the WSGI application.
+        @param path: the request path
+        @param form: dict of POST form fields, or None for a GET request
+        @param user_name: the user name of the logged in user, or None
+        @return: the response
+        '''
+        import blog_app
+        return blog_app.app.get_response(
+            path, POST=form,
+            headers=self.cookie_headers(user_name) if user_name else [])
+
+    def close(self):
+        self._testbed.deactivate()
+
+
+def handler_benchmarks(fixture):
+    '''Returns the benchmarks of the request handlers.
+    '''
+    post_id = fixture.hot_post_id
+    edits = itertools.cycle(["first edit", "second edit"])
+    new_users = itertools.count()
+
+    def _signup():
+        user_name = SIGNUP_USER_FORMAT % next(new_users)
+        return fixture.request(SIGNUP_PATH, {
+            bc.USER: user_name, bc.PASSWORD: "bench_pwd",
+            bc.PWD_VERIFY: "bench_pwd", bc.EMAIL: user_name + "@example.com"})
+    return [
+        Benchmark("BlogMainPage.get",
+                  lambda: fixture.request(HOME_PATH), expected_status=200),
+        Benchmark("BlogMainPage.get (logged in)",
+                  lambda: fixture.request(HOME_PATH,
+                                          user_name=fixture.reader),
+                  expected_status=200),
+        Benchmark("BlogPostDisplay.get",
+                  lambda: fixture.request(POST_PATH % post_id,
+                                          user_name=fixture.reader),
+                  expected_status=200),
+        # Each call toggles the reader's like, so the likes stay bounded.
+        Benchmark("LikePost.post",
+                  lambda: fixture.request(LIKE_PATH % post_id,
+                                          {},
+                                          user_name=fixture.reader),
+                  expected_status=302),
+        Benchmark("NewComment.post",
+                  lambda: fixture.request(COMMENT_PATH % post_id,
+                                          {bc.CONTENT: "benchmark comment"},
+                                          user_name=fixture.reader),
+                  expected_status=302),
+        Benchmark("EditPost.post",
+                  lambda: fixture.request(EDIT_PATH % post_id,
+                                          {bc.SUBJECT: "benchmark subject",
+                                           bc.CONTENT: next(edits)},
+                                          user_name=fixture.author),
+                  expected_status=302),
+        Benchmark("Login.post",
+                  lambda: fixture.request(LOGIN_PATH, {
+                      bc.USER: fixture.reader,
+                      bc.PASSWORD: corpus_generator.CORPUS_PASSWORD}),
+                  iterations=HASHING_ITERATIONS, expected_status=302),
+        Benchmark("Signup.post", _signup, iterations=HASHING_ITERATIONS,
+                  expected_status=302)]
+
+
+def helper_benchmarks(fixture):
+    '''Returns the benchmarks of the helpers every request runs through.
+    '''
+    import webapp2
+    import blog_app
+    import blog_handler
+    import form_schema
+    from blog_utilities import CookieUtil, PwdUtil
+    cookie_request = webapp2.Request.blank(
+        "/", headers=fixture.cookie_headers(fixture.reader))
+    cookie_handler = webapp2.RequestHandler(cookie_request,
+                                            webapp2.Response())
+
+    def _get_cookie_cold():
+        CookieUtil.clear_local()
+        return CookieUtil.get_cookie(bc.USER, cookie_handler)
+
+    def _render():
+        request = webapp2.Request.blank("/")
+        blog_app.app.set_globals(app=blog_app.app, request=request)
+        handler = blog_handler.Handler(request, webapp2.Response())
+        handler.render(bc.WELCOME_TEMPLATE, username=fixture.reader)
+        return handler.response
+    stored_password = PwdUtil(corpus_generator.CORPUS_PASSWORD
+                              ).new_pwd_salt_pair()
+    signup_input = {bc.USER: "bench_user", bc.PASSWORD: "bench_pwd",
+                    bc.PWD_VERIFY: "bench_pwd",
+                    bc.EMAIL: "bench_user@example.com"}
+    return [
+        Benchmark("CookieUtil.get_cookie",
+                  lambda: CookieUtil.get_cookie(bc.USER, cookie_handler)),
+        Benchmark("CookieUtil.get_cookie (cold)", _get_cookie_cold),
+        Benchmark("PwdUtil.verify_password",
+                  lambda: PwdUtil(corpus_generator.CORPUS_PASSWORD,
+                                  stored_password).verify_password(),
+                  iterations=HASHING_ITERATIONS),
+        Benchmark("SIGNUP_FORM.validate",
+                  lambda: form_schema.SIGNUP_FORM.validate(signup_input.get)),
+        Benchmark("Handler.render", _render, expected_status=200)]
+
+
+def run_suite(sizes, seed, rounds, name_filter=None):
+    '''Runs every benchmark on each corpus size.
+    @param sizes: list of corpus_generator.SIZES keys
+    @param seed: the seed of the corpora
+    @param rounds: the number of timed rounds per benchmark
+    @param name_filter: compiled regex benchmark names must match, or None
+    @return: dict of dicts of timings keyed by benchmark name, keyed by size
+    '''
+    results = {}
+    for size in sizes:
+        fixture = Fixture(size, seed)
+        try:
+            results[size] = {}
+            for benchmark in (handler_benchmarks(fixture) +
+                              helper_benchmarks(fixture)):
+                if name_filter and not name_filter.search(benchmark.name):
+                    continue
+                benchmark.check()
+                results[size][benchmark.name] = benchmark.time(rounds)
+        finally:
+            fixture.close()
+    return results
+
+
+def compare(results, baseline, threshold_pct, thresholds):
+    '''Compares results with a baseline.
+    @param results: the results of run_suite
+    @param baseline: the results of a previous run
+    @param threshold_pct: the default allowed slowdown in percent
+    @param thresholds: dict of allowed slowdowns in percent keyed by
+    benchmark name, overriding threshold_pct
+    @return: list of tuples of the size, name, baseline and current median
+    times in us, the change in percent and the status of each benchmark:
+    "ok", "faster", "REGRESSED" or "new"
+    '''
+    rows = []
+    for size in sorted(results):
+        for name in sorted(results[size]):
+            current = results[size][name]["median_us"]
+            previous = baseline.get(size, {}).get(name)
+            if previous is None:
+                rows.append((size, name, None, current, None, "new"))
+                continue
+            change = (current / previous["median_us"] - 1) * 100
+            allowed = thresholds.get(name, threshold_pct)
+            if change > allowed:
+                status = "REGRESSED"
+            elif change < -allowed:
+                status = "faster"
+            else:
+                status = "ok"
+            rows.append((size, name, previous["median_us"], current, change,
+                         status))
+    return rows
+
+
+def _parse_thresholds(specs):
+    '''Parses NAME=PCT threshold overrides.
+    @return: dict of thresholds in percent keyed by benchmark name
+    @raise ValueError: if a spec is malformed
+    '''
+    thresholds = {}
+    for spec in specs:
+        name, sep, pct = spec.rpartition("=")
+        if not sep or not name:
+            raise ValueError("Threshold must be NAME=PCT: " + spec)
+        thresholds[name] = float(pct)
+    return thresholds
+
+
+def main():
+    '''Runs the suite, saves its results and compares them with the
+    baseline.
+    @return: the int exit status, 1 if any benchmark regressed
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark suite")
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES,
+                        choices=sorted(corpus_generator.SIZES),
+                        help="corpus sizes to run the suite on")
+    parser.add_argument("--seed", type=int,
+                        default=corpus_generator.DEFAULT_SEED,
+                        help="seed of the corpora")
+    parser.add_argument("--rounds", type=int, default=DEFAULT_ROUNDS,
+                        help="timed rounds per benchmark")
+    parser.add_argument("--filter", default=None,
+                        help="regex benchmark names must match")
+    parser.add_argument("--json", default=None,
+                        help="path to write the results to")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE,
+                        help="path of the baseline results")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="save the results as the new baseline")
+    parser.add_argument("--threshold", type=float,
+                        default=DEFAULT_THRESHOLD_PCT,
+                        help="allowed slowdown in percent")
+    parser.add_argument("--threshold-for", action="append", default=[],
+                        metavar="NAME=PCT",
+                        help="allowed slowdown of one benchmark")
+    args = parser.parse_args()
+    thresholds = _parse_thresholds(args.threshold_for)
+    results = run_suite(args.sizes, args.seed, args.rounds,
+                        re.compile(args.filter) if args.filter else None)
+    document = {"python": platform.python_version(),
+                "machine": platform.machine(),
+                "seed": args.seed,
+                "results": results}
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(document, json_file, indent=2, sort_keys=True)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+    rows = compare(results, baseline, args.threshold, thresholds)
+    print "%-6s %-30s %12s %12s %9s  %s" % ("size", "benchmark",
+                                            "baseline us", "median us",
+                                            "change", "status")
+    for size, name, previous, current, change, status in rows:
+        print "%-6s %-30s %12s %12.1f %9s  %s" % (
+            size, name, "%.1f" % previous if previous is not None else "-",
+            current, "%+.1f%%" % change if change is not None else "-",
+            status)
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(document, baseline_file, indent=2, sort_keys=True)
+        print "Saved the baseline to " + args.baseline
+        return 0
+    if not baseline:
+        print "No baseline at %s, run with --save-baseline to create one" % (
+            args.baseline)
+    return 1 if any(row[5] == "REGRESSED" for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
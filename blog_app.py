@@ -0,0 +1,53 @@
+'''
+The WSGI application of the blog-engine. Handlers are named by import string,
+so this module loads only webapp2, the route constants and the RPC accounting
+middleware; the handler module, the models and the template machinery are
+imported by webapp2 the first time a request is routed to one of them.
+
+Every handler lives in blog_handler, so loading is lazy per application, not
+per route: the first request to any route pays for the handler module, the
+models, jinja2 and the caches at once. bench_import_time.py times that first
+route resolution as well as the import of this module.
+
+Created on Jul 13, 2017
+@author: kennethalamantia
+'''
+
+import webapp2
+from webapp2_extras import routes
+from rpc_accounting import RpcAccountingMiddleware
+from blog_constants import (HOME, HOME_ERROR, NEW_POST, DISPLAY_POST,
+                            NEW_COMMENT, EDIT_COMMENT, EDIT_POST, DELETE_POST,
+                            DELETE_COMMENT, LIKE_POST, WELCOME, LOGIN, LOGOUT,
+                            SIGNUP, WARMUP, PROFILES)
+
+app = webapp2.WSGIApplication([
+    webapp2.Route("/_ah/warmup", "blog_handler.Warmup", WARMUP),
+    webapp2.Route("/_admin/profiles", "blog_handler.ProfileReport", PROFILES),
+    routes.PathPrefixRoute("/blog", [
+        webapp2.Route("/display/<:\w+>", "blog_handler.BlogMainPage", HOME),
+        webapp2.Route("/error/<:\w+-\w+|\w+>", "blog_handler.BlogMainPage",
+                      HOME_ERROR),
+        webapp2.Route("/new_post", "blog_handler.NewPost", NEW_POST),
+        routes.PathPrefixRoute("/post_id/<:\w+-\w+|\w+>", [
+            webapp2.Route("/display/<:\w+>", "blog_handler.BlogPostDisplay",
+                          DISPLAY_POST),
+            webapp2.Route("/comment/new/<:\w+>", "blog_handler.NewComment",
+                          NEW_COMMENT),
+            webapp2.Route("/comment/edit", "blog_handler.EditComment",
+                          EDIT_COMMENT),
+            webapp2.Route("/edit", "blog_handler.EditPost", EDIT_POST),
+            webapp2.Route("/delete", "blog_handler.DeletePost", DELETE_POST),
+            webapp2.Route("/comment/delete", "blog_handler.DeleteComment",
+                          DELETE_COMMENT),
+            webapp2.Route("/like_post/<:\w+>", "blog_handler.LikePost",
+                          LIKE_POST)]),
+        webapp2.Route("/user_welcome", "blog_handler.Welcome", WELCOME),
+        webapp2.Route("/login", "blog_handler.Login", LOGIN),
+        webapp2.Route("/logout", "blog_handler.Logout", LOGOUT),
+        webapp2.Route("/signup/<:\w+>", "blog_handler.Signup", SIGNUP)
+    ])
+])
+
+# The application as served, counting the API calls of each request
+application = RpcAccountingMiddleware(app)
@@ -0,0 +1,46 @@
+'''
+Deployment settings of the blog-engine, derived from the environment the app
+is running in.
+
+Created on Jul 12, 2017
+@author: kennethalamantia
+'''
+
+import os
+
+# Environment
+SERVER_SOFTWARE = os.environ.get("SERVER_SOFTWARE", "")
+# Set by serve.py when it serves the app outside of App Engine
+SELF_HOSTED_SOFTWARE = "blog-engine serve.py/"
+PRODUCTION = SERVER_SOFTWARE.startswith(("Google App Engine/",
+                                         SELF_HOSTED_SOFTWARE))
+
+# Storage settings
+# The backend of the app's data, a name in blog_storage.BACKENDS, and the
+# keyword arguments of its constructor, e.g. dict(path=...) for SQLite.
+STORAGE_BACKEND = "ndb"
+STORAGE_OPTIONS = {}
+
+# Template settings
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+COMPILED_TEMPLATE_DIR = os.path.join(os.path.dirname(__file__),
+                                     'compiled_templates')
+# Options shared by the run time environment and the build step, since
+# compiled templates bake in e.g. autoescaping.
+TEMPLATE_OPTIONS = dict(extensions=['jinja2.ext.autoescape'],
+                        autoescape=True)
+# Templates are only checked for changes on disk outside of production.
+TEMPLATE_AUTO_RELOAD = not PRODUCTION
+TEMPLATE_CACHE_SIZE = 100
+
+# RPC accounting settings
+# Adds the API call counts of each request to its response headers.
+RPC_DEBUG_HEADER = not PRODUCTION
+
+# Profiler settings
+# Profiles a PROFILE_SAMPLE_RATE fraction of all requests when enabled.
+# Admins can also profile single requests by sending PROFILE_HEADER.
+PROFILING_ENABLED = False
+PROFILE_SAMPLE_RATE = 0.01
+PROFILE_HEADER = "X-Blog-Profile"
+PROFILE_TOP_N = 25
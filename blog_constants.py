@@ -0,0 +1,66 @@
+'''
+Constants shared by the blog-engine's routes, handlers, templates and models:
+route names, template filenames and form field names. Kept in a module with
+no imports so that any module can use them without loading the others.
+
+Created on Jul 13, 2017
+@author: kennethalamantia
+'''
+
+# HTML Filenames
+MAIN_PAGE_TEMPLATE = "blog.html"
+NEW_POST_TEMPLATE = "newpost.html"
+POST_ONLY_TEMPLATE = "new_post_base.html"
+POST_WITH_COMMENTS = "new_post_with_comments.html"
+SIGNUP_TEMPLATE = "signup_page.html"
+WELCOME_TEMPLATE = "welcome.html"
+LOGIN_TEMPLATE = "login_page.html"
+COMMENT_TEMPLATE = "new_comment.html"
+POST_BODY_FRAGMENT = "post_body.html"
+COMMENT_THREAD_FRAGMENT = "comment_thread.html"
+ALL_TEMPLATES = (MAIN_PAGE_TEMPLATE, NEW_POST_TEMPLATE, POST_ONLY_TEMPLATE,
+                 POST_WITH_COMMENTS, SIGNUP_TEMPLATE, WELCOME_TEMPLATE,
+                 LOGIN_TEMPLATE, COMMENT_TEMPLATE, POST_BODY_FRAGMENT,
+                 COMMENT_THREAD_FRAGMENT)
+
+# URI Routes
+HOME = "home"
+HOME_ERROR = "home_error"
+NEW_POST = "new_post"
+SIGNUP = "signup"
+WELCOME = "welcome"
+LOGIN = "login"
+LOGOUT = "logout"
+DISPLAY_POST = "display_post"
+NEW_COMMENT = "new_comment"
+EDIT_COMMENT = "edit_comment"
+EDIT_POST = "edit_post"
+LIKE_POST = "like_post"
+DELETE_POST = "delete_post"
+DELETE_COMMENT = "delete_comment"
+WARMUP = "warmup"
+PROFILES = "profiles"
+
+# Form Input Fields
+USER = "username"
+PASSWORD = "password"
+PWD_VERIFY = "pwd_verify"
+EMAIL = "email"
+SUBJECT = "subject"
+CONTENT = "content"
+ERROR = "_error"
+COMMENT = "comment"
+DELETE = "delete"
+POST = "post"
+LIKE = "like"
+CURSOR = "cursor"
+
+# Content id of the first page of the home page, whose version stamp changes
+# with every post or like shown on it
+HOME_CONTENT_ID = "home_feed"
+
+# URI status terminators
+ACCESS_ERROR = "access_error"
+OWN_POST = "own_post"
+NOT_AUTHOR = "not_author"
+DISPLAY = "display"
@@ -1,6 +1,7 @@
 '''
-Classes that implement the a blog-engine running on google appengine and the
-google cloud datastore.
+Classes that implement the a blog-engine running on google appengine. The
+handlers read and write the blog's data through the storage backend chosen in
+blog_config, see blog_storage.
 
 Dependencies:
 webapp2
@@ -14,68 +15,58 @@ Created on Jan 7, 2017
 
 # imports
 import os
-import re
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from functools import wraps
 import jinja2
 import webapp2
-from webapp2_extras import routes
 from google.appengine.ext import ndb
-from blog_utilities import CookieUtil, PwdUtil
-from google.appengine.ext.datastore_admin.config import current
-import time
-from ndb_models import User, BlogPost, Comment
+import blog_config
+import form_schema
+from google.appengine.api import users
+from profiler import RouteProfiles
+from blog_utilities import CookieUtil, PwdUtil, HashingBusyError
+from fragment_cache import ContentVersion, FragmentCache, PageCache
+from blog_storage import app_storage, DuplicateUserError, InvalidCursorError
+from blog_constants import *
+# The application is defined in blog_app, which loads this module lazily.
+from blog_app import app
 
 
 # Template constants
-TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
-JINJA = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
-                           extensions=['jinja2.ext.autoescape'],
-                           autoescape=True)
-
-# HTML Filenames
-MAIN_PAGE_TEMPLATE = "blog.html"
-NEW_POST_TEMPLATE = "newpost.html"
-POST_ONLY_TEMPLATE = "new_post_base.html"
-POST_WITH_COMMENTS = "new_post_with_comments.html"
-SIGNUP_TEMPLATE = "signup_page.html"
-WELCOME_TEMPLATE = "welcome.html"
-LOGIN_TEMPLATE = "login_page.html"
-COMMENT_TEMPLATE = "new_comment.html"
-
-# URI Routes
-HOME = "home"
-HOME_ERROR = "home_error"
-NEW_POST = "new_post"
-SIGNUP = "signup"
-WELCOME = "welcome"
-LOGIN = "login"
-LOGOUT = "logout"
-DISPLAY_POST = "display_post"
-NEW_COMMENT = "new_comment"
-EDIT_COMMENT = "edit_comment"
-EDIT_POST = "edit_post"
-LIKE_POST = "like_post"
-DELETE_POST = "delete_post"
-DELETE_COMMENT = "delete_comment"
-
-# Form Input Fields
-USER = "username"
-PASSWORD = "password"
-PWD_VERIFY = "pwd_verify"
-EMAIL = "email"
-SUBJECT = "subject"
-CONTENT = "content"
-ERROR = "_error"
-COMMENT = "comment"
-DELETE = "delete"
-POST = "post"
-LIKE = "like"
-
-# URI status terminators
-ACCESS_ERROR = "access_error"
-OWN_POST = "own_post"
-NOT_AUTHOR = "not_author"
-DISPLAY = "display"
+TEMPLATE_DIR = blog_config.TEMPLATE_DIR
+
+# Seconds clients are asked to wait before retrying a busy login or signup
+HASH_RETRY_AFTER_SECS = 5
+
+
+def _template_loader():
+    '''Returns the loader of the template environment. In production,
+    templates precompiled by compile_templates.py are preferred over parsing
+    template source. Elsewhere templates are always loaded from source, so
+    edits are picked up even after a local build.
+    '''
+    source_loader = jinja2.FileSystemLoader(TEMPLATE_DIR)
+    if (not blog_config.PRODUCTION or
+            not os.path.isdir(blog_config.COMPILED_TEMPLATE_DIR)):
+        return source_loader
+    return jinja2.ChoiceLoader([
+        jinja2.ModuleLoader(blog_config.COMPILED_TEMPLATE_DIR),
+        source_loader])
+
+_jinja = None
+
+
+def jinja_env():
+    '''Returns the template environment, creating it on first use.
+    '''
+    global _jinja
+    if _jinja is None:
+        _jinja = jinja2.Environment(
+            loader=_template_loader(),
+            auto_reload=blog_config.TEMPLATE_AUTO_RELOAD,
+            cache_size=blog_config.TEMPLATE_CACHE_SIZE,
+            **blog_config.TEMPLATE_OPTIONS)
+    return _jinja
 
 
 class Handler(webapp2.RequestHandler):
@@ -83,6 +74,37 @@ class Handler(webapp2.RequestHandler):
     function used in all child classes.
     '''
 
+    @webapp2.cached_property
+    def context(self):
+        '''The RequestContext shared by the decorators, helpers and handler
+        method serving this request.
+        '''
+        return RequestContext(self)
+
+    @ndb.toplevel
+    def dispatch(self):
+        '''Dispatches the request to the handler method, under the profiler if
+        this request is to be profiled. Waits for every NDB operation started
+        by the handler, including ones it did not wait for itself.
+        '''
+        if RouteProfiles.should_profile(self.request):
+            route = self.request.route
+            return RouteProfiles.profile(
+                route.name if route else self.request.path,
+                super(Handler, self).dispatch)
+        return super(Handler, self).dispatch()
+
+    def handle_exception(self, exception, debug):
+        '''Answers requests that found every password hashing slot busy with
+        a 503 asking the client to retry, and lets other exceptions through.
+        '''
+        if not isinstance(exception, HashingBusyError):
+            return super(Handler, self).handle_exception(exception, debug)
+        self.response.clear()
+        self.response.set_status(503)
+        self.response.headers["Retry-After"] = str(HASH_RETRY_AFTER_SECS)
+        self.response.out.write("The server is busy, please try again.")
+
     def render(self, template, **template_fields):
         '''Prepares a template for rendering and renders the template. Updates
         the template fields dict with a boolean for whether a user is logged in
@@ -94,15 +116,21 @@ class Handler(webapp2.RequestHandler):
         '''
 
         template_fields.update(dict(
-            logged_in=CookieUtil.get_cookie(USER, self)))
+            logged_in=self.context.cur_user))
 
-        def _render_template():
-            '''Helper function to load and render template.
-            '''
-            template_to_render = JINJA.get_template(template)
-            return template_to_render.render(template_fields)
+        template_to_render = jinja_env().get_template(template)
+        self.response.out.write(template_to_render.render(template_fields))
 
-        self.response.out.write(_render_template())
+    def render_fragment(self, template, **template_fields):
+        '''Renders a template holding part of a page and returns it, marked
+        as safe to include unescaped in another template.
+        @param template: the template html
+        @param template_fields: dictionary of arguments where keys match
+        template variables
+        @return: the rendered fragment as a jinja2.Markup str
+        '''
+        return jinja2.Markup(jinja_env().get_template(template).render(
+            template_fields))
     
     @classmethod
     def check_logged_in(cls, handler_fun):
@@ -113,8 +141,7 @@ class Handler(webapp2.RequestHandler):
         
         @wraps(handler_fun)
         def wrapper(self, *args, **kwargs):
-            helper = HandlerHelper(self, [])
-            if not helper.is_logged_in():
+            if self.context.cur_user is None:
                 self.redirect(self.uri_for(SIGNUP, ACCESS_ERROR))
             else:
                 handler_fun(self, *args, **kwargs)
@@ -167,27 +194,223 @@ class Handler(webapp2.RequestHandler):
     def check_post_exists(cls, handler_fun):
         '''If attempt to query database for blog post fails, raise a 404
         error. Otherwise continue handler execution.
-        @return: BlogPost entity from key or raise a 404 error.
+        @return: the handler's result, or a 404 error.
         '''
         @wraps(handler_fun)
         def wrapper(self, *args, **kwargs):
             post_key = args[0]
-            helper = HandlerHelper(self, [], post_key)
-            if helper.cur_post is not None:
+            if self.context.get_post(post_key) is not None:
                 return handler_fun(self, *args, **kwargs)
             else:
                 return self.error(404)
         return wrapper
 
+    @classmethod
+    def read_post_version(cls, handler_fun):
+        '''Reads the version stamp of the post of the request before the post
+        is loaded. Fragments cached under the stamp are then rendered from
+        data at least as new as it, so a concurrent write can make them
+        older than their key but never newer.
+        @return: the handler's result
+        '''
+        @wraps(handler_fun)
+        def wrapper(self, *args, **kwargs):
+            self.context.content_version(args[0])
+            return handler_fun(self, *args, **kwargs)
+        return wrapper
+
+    @classmethod
+    def cache_anonymous_page(cls, version_key_fun):
+        '''Parameterized decorator for GET methods of pages that look the same
+        to every visitor who is not logged in. For such visitors the page is
+        served from the page cache, with strong ETag and Last-Modified headers
+        derived from the version stamp of the page's content, and conditional
+        requests for an unchanged page are answered with a 304. Neither
+        touches the datastore once the page is cached. Validators are only
+        sent with pages that rendered, so missing posts stay 404s.
+        @param version_key_fun: function taking the handler and the handler
+        method's arguments and returning the content id whose version stamp
+        the page is derived from, or None if the request cannot be cached
+        '''
+        def takes_function(handler_fun):
+            @wraps(handler_fun)
+            def wrapper(self, *args, **kwargs):
+                version_key = version_key_fun(self, *args)
+                if version_key is None or self.context.cur_user is not None:
+                    return handler_fun(self, *args, **kwargs)
+                version = self.context.content_version(version_key)
+                # Only a page rendered at this version proves its content
+                # exists; deletes bump the version, so a deleted or missing
+                # post never gets a 304 or a cached page.
+                cached_page = PageCache.get(self.request.path_qs, version)
+                if cached_page is not None:
+                    self._set_validators(version)
+                    if self._is_not_modified(version):
+                        return self.response.set_status(304)
+                    self.response.headers["Content-Type"] = cached_page[0]
+                    return self.response.out.write(cached_page[1])
+                result = handler_fun(self, *args, **kwargs)
+                if self.response.status_int == 200:
+                    PageCache.set(self.request.path_qs, version,
+                                  self.response.headers["Content-Type"],
+                                  self.response.body)
+                    self._set_validators(version)
+                    if self._is_not_modified(version):
+                        self.response.clear()
+                        self.response.set_status(304)
+                return result
+            return wrapper
+        return takes_function
+
+    def _set_validators(self, version):
+        '''Sets the cache validator headers of a page cached for anonymous
+        visitors. The ETag includes the deployed app version, so a deploy that
+        changes the markup also changes every ETag.
+        @param version: the version stamp of the page's content
+        '''
+        timestamp = int(version) / 1000000.0
+        self.response.headers["ETag"] = self._etag(version)
+        self.response.headers["Last-Modified"] = formatdate(timestamp,
+                                                            usegmt=True)
+        self.response.headers["Cache-Control"] = "no-cache"
+        self.response.headers["Vary"] = "Cookie"
+
+    def _is_not_modified(self, version):
+        '''Does a conditional request match the current version of a page?
+        If-None-Match takes precedence over If-Modified-Since. Only concrete
+        ETags match; "*" is a precondition on existence, not a validator.
+        If-Modified-Since has whole seconds, so it only matches a stamp
+        older than its second; a bump within the second of the client's copy
+        must not get a 304.
+        @param version: the version stamp of the page's content
+        '''
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match:
+            etags = [etag.strip() for etag in if_none_match.split(",")]
+            return self._etag(version) in etags
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_modified_since:
+            since = parsedate_tz(if_modified_since)
+            return (since is not None and
+                    int(version) < mktime_tz(since) * 1000000)
+        return False
+
+    def _etag(self, version):
+        '''Returns the quoted strong ETag of a version of a page.
+        '''
+        return '"%s-%s"' % (version,
+                            os.environ.get("CURRENT_VERSION_ID", "dev"))
+
+
+def _home_page_version_key(handler, status):
+    '''Returns the content id whose version stamp the first page of the home
+    page is derived from, or None for other pages and errors.
+    '''
+    if status == HOME and not handler.request.get(CURSOR):
+        return HOME_CONTENT_ID
+
+
+def _post_page_version_key(handler, post_key, error):
+    '''Returns the content id whose version stamp the first page of a post
+    is derived from, the post's id, or None for other pages and errors.
+    '''
+    if error in (DISPLAY, DISPLAY_POST) and not handler.request.get(CURSOR):
+        return post_key
+
+
+class RequestContext(object):
+    '''Per-request store of the state shared by the Handler.check_*
+    decorators, HandlerHelper instances and the handler methods. The current
+    user, each post or comment looked up by id and each validated form are
+    resolved at most once per request and handed to every later caller.
+    Attributes:
+        handler: the Webapp2 request handler
+        _cur_user: the str user name of a logged in user, if resolved
+        _records: dict of PostRecords, CommentRecords or None, keyed by
+                  (kind, id) tuple
+        _forms: dict of (is_valid, form_data) tuples keyed by tuple of fields
+        _versions: dict of version stamps keyed by content id
+    '''
+
+    _UNRESOLVED = object()
+
+    def __init__(self, handler):
+        '''
+        @param handler: the Webapp2 request handler
+        '''
+        self.handler = handler
+        self._cur_user = self._UNRESOLVED
+        self._records = {}
+        self._forms = {}
+        self._versions = {}
+
+    @property
+    def cur_user(self):
+        '''The str user name of the logged in user, or None. The login cookie
+        is validated on first access only.
+        '''
+        if self._cur_user is self._UNRESOLVED:
+            self._cur_user = CookieUtil.get_cookie(USER, self.handler)
+        return self._cur_user
+
+    def content_version(self, content_id):
+        '''Returns the version stamp of some content, read on first use.
+        @param content_id: the str id of the content
+        '''
+        if content_id not in self._versions:
+            self._versions[content_id] = ContentVersion.get(content_id)
+        return self._versions[content_id]
+
+    def get_post(self, post_id):
+        '''Returns the PostRecord of a blog post, or None.
+        @param post_id: the str id of the post from the url
+        '''
+        return self._get_record(POST, app_storage().get_post, post_id)
+
+    def get_comment(self, comment_id):
+        '''Returns the CommentRecord of a comment, or None.
+        @param comment_id: the str id of the comment from the request
+        '''
+        return self._get_record(COMMENT, app_storage().get_comment,
+                                comment_id)
+
+    def validate_form(self, field_list):
+        '''Validates form input against its form_schema schema, once per set
+        of fields.
+        @param field_list: list of template form field names to process
+        @return: tuple of a boolean, true if the input was valid, and a copy
+        of the dict returned by FormSchema.validate
+        '''
+        fields = tuple(field_list)
+        if fields not in self._forms:
+            self._forms[fields] = form_schema.schema_for(fields).validate(
+                self.handler.request.get)
+        is_valid, form_data = self._forms[fields]
+        return is_valid, dict(form_data)
+
+    def _get_record(self, kind, get_fun, record_id):
+        '''Returns a record by id, fetching it on first use.
+        @param kind: the entity type of the record, POST or COMMENT
+        @param get_fun: the storage method fetching the record by id
+        @param record_id: the str id of the record
+        '''
+        if not record_id:
+            return None
+        if (kind, record_id) not in self._records:
+            self._records[(kind, record_id)] = get_fun(record_id)
+        return self._records[(kind, record_id)]
+
 
 class HandlerHelper(object):
     '''A class that aggregates data about the state of a request handler
     and performs validation and parsing actions on that state. Makes the data
-    available for use in templates.
+    available for use in templates. State is read from the handler's
+    RequestContext, so constructing several helpers per request is cheap.
     Attributes:
         handler: the Webapp2 request handler
         cur_user: the str user name of a logged in user, if any
-        cur_post: the blog post database object relevant to the current page
+        cur_post: the PostRecord of the blog post relevant to the current
+                  page
         data_error_msgs: dict of error msgs generated from bad text form input
         valid_data: dict holding data to be rendered to a template
         is_data_valid: boolean, true if text input was valid
@@ -198,8 +421,8 @@ class HandlerHelper(object):
         @param handler: the Webapp2 request handler
         @param field_list: list of form input fields to verify, named by
         global constants
-        @param post_id: the url-safe NDB key id of a post entity, used to 
-        retrieve the post entity upon initialization, if desired
+        @param post_id: the str id of a post, used to retrieve the post upon
+        initialization, if desired
         '''
         self.handler = handler
         self.cur_user = self._logged_in_user()
@@ -219,34 +442,28 @@ class HandlerHelper(object):
     def is_logged_in(self):
         '''Returns true if a cookie is set for a logged in user.
         '''
-        return CookieUtil.get_cookie(USER, self.handler) is not None
-            
+        return self.cur_user is not None
 
     def _logged_in_user(self):
         '''Returns the str user name of user currently logged in.
         '''
-        return CookieUtil.get_cookie(USER, self.handler)
+        return self.handler.context.cur_user
 
-    def get_cur_post(self, key_from_url):
-        '''Returns a blog post ENTITY from url-safe string.
-        @param key_from_url: the url-safe key string for a BlogPost
+    def get_cur_post(self, post_id):
+        '''Returns the PostRecord of a blog post, or None.
+        @param post_id: the str id of the post
         '''
-        if key_from_url:
-            try:
-                return ndb.Key(urlsafe=key_from_url).get()
-            except:
-                return None
+        return self.handler.context.get_post(post_id)
 
     def _validate_user_input(self, field_list):
-        '''Validate text input into html form using FormHelper class.
+        '''Validate text input into html form using its form schema.
         Sets data_error_msgs, is_data_valid, and valid_data class
         attributes accordingly.
         @param field_list: list of template form field names to process. Refer
         to declared global constants for options.
         '''
-        form_helper = FormHelper(self.handler)
-        form_data = form_helper.validate_form_data(field_list)
-        if not form_helper.valid_input:
+        is_valid, form_data = self.handler.context.validate_form(field_list)
+        if not is_valid:
             self.data_error_msgs = form_data
             self.is_data_valid = False
         else:
@@ -261,7 +478,7 @@ class HandlerHelper(object):
 
     def validate_form_input(self, template, **additional_elements):
         '''Checks the data input into the form for validity based on rules defined
-        in the Form Helper class. Re-renders the form with error messages using
+        in the form_schema module. Re-renders the form with error messages using
         the provided template.
         @param template: template to render - global constant
         @param additional_elements: if the template requires non-form input
@@ -273,11 +490,11 @@ class HandlerHelper(object):
 
     def is_cur_user_author(self, entity_type):
         if entity_type == COMMENT:
-            comment = Comment.entity_from_uri(
+            comment = self.handler.context.get_comment(
                       self.handler.request.get("comment_key"))
-            return comment.author == self.cur_user
+            return comment is not None and comment.author == self.cur_user
         elif entity_type == POST:
-            return self.cur_post.post_author == self.cur_user
+            return self.cur_post.author == self.cur_user
         else:
             raise Exception("Entity type not 'post' or 'comment'")
 
@@ -285,7 +502,7 @@ class HandlerHelper(object):
         '''Returns string literal "like or "unlike" based on whether the
         current user has or hasn't liked the current post.
         '''
-        if BlogPost.already_liked(self.cur_post, self.cur_user):
+        if app_storage().has_liked(self.cur_post.post_id, self.cur_user):
             return "Unlike"
         else:
             return "Like"
@@ -297,8 +514,7 @@ class ErrorHelper(object):
     Attributes:
         _message: error message text as a str
         _error_type: str type of the error message e.g. "delete_button_error"
-        _target_id: the url key id of the database entity the messages relates
-                    to
+        _target_id: the str id of the post the messages relates to
         _like_text_map: dict for rendering like buttons to main page
     '''
 
@@ -307,44 +523,46 @@ class ErrorHelper(object):
         Create a new error helper instance holding an error message.
         @param error_msg: error message text
         @param error_type: type of the error message, matches button name
-        @param entity_id: the url key id of the NDB entity re: the message
+        @param entity_id: the str id of the post re: the message
         '''
         self._message = error_msg
         self._target_id = entity_id
         self._like_text_map = None
 
-    def get_error(self, current_entity):
+    def get_error(self, current_post):
         '''Return an error message if one is required.
-        @param current_entity: the database entity whose data is being rendered
-        @param current_error: type of the error message to render
+        @param current_post: the PostRecord being rendered
         '''
-        if current_entity.key.urlsafe() == self._target_id:
+        if current_post.post_id == self._target_id:
             return self._message
         else:
             return ""
 
     def setup_main_page_like_buttons(self, recent_posts, handler):
-        '''Setup the like button text for retrieval in the template.
+        '''Setup the like button text for retrieval in the template. The like
+        state of every post is resolved for the current user with one batch
+        read.
         @param recent_posts: list of posts to render to the template
         that have like buttons.
         @param handler: handler instance this method is being called from
         '''
-        button_text_map = {}
-        for post in recent_posts:
-            post_url_key = post.key.urlsafe()
-            button_helper = HandlerHelper(handler, [], post_url_key)
-            if button_helper.cur_post is None:
-                continue
+        post_ids = [post.post_id for post in recent_posts]
+        liked_ids = app_storage().liked_by_user(post_ids,
+                                                handler.context.cur_user)
+        self._like_text_map = {}
+        for post_id in post_ids:
+            if post_id in liked_ids:
+                self._like_text_map[post_id] = "Unlike"
             else:
-                button_text_map[post_url_key] = button_helper.gen_like_text()
-        self._like_text_map = button_text_map
+                self._like_text_map[post_id] = "Like"
 
-    def get_like_text(self, current_post_key):
+    def get_like_text(self, current_post_id):
         '''Return the correct like text for a like button in the template.
-        @param current_post_key: the NDB url key identifying the entity for
-        which to retrieve the like status
+        @param current_post_id: the str id of the post for which to retrieve
+        the like status
         '''
-        return self._like_text_map.get(current_post_key)
+        return self._like_text_map.get(current_post_id)
+
 
 class LikePost(Handler):
     '''Handles requests to like posts. Checks if the current user has 
@@ -358,8 +576,8 @@ class LikePost(Handler):
     @Handler.check_post_exists
     def post(self, post_key, origin):
         helper = HandlerHelper(self, [], post_key)
-        BlogPost.add_like_unlike(helper.cur_post, helper.cur_user, 
-                                 helper.gen_like_text())
+        app_storage().add_like_unlike(post_key, helper.cur_user,
+                                      helper.gen_like_text())
         if origin == HOME:
             return self.redirect(self.uri_for(HOME, "update"))
         elif origin == DISPLAY_POST or origin == OWN_POST:
@@ -370,6 +588,7 @@ class BlogMainPage(Handler):
     '''Class to handle requests on the main page.
     '''
 
+    @Handler.cache_anonymous_page(_home_page_version_key)
     def get(self, status):
         '''Displays the main page, including recent blog posts.
         '''
@@ -377,17 +596,34 @@ class BlogMainPage(Handler):
             helper =  ErrorHelper(None, None)
         else:
             helper = ErrorHelper("You cannot like your own post", status)
-        HandlerHelper(self, ())
         self._render_main_page(helper)
 
     def _render_main_page(self, error_helper_inst):
-        '''Convenience function to render the main page.
+        '''Convenience function to render the main page. The first page comes
+        from the home feed, later pages from the cursor in the request.
         @param error_helper_inst: instance of ErrorHelper from post/get
         '''
-        recent_posts = BlogPost.most_recent_20()
+        cursor = self.request.get(CURSOR)
+        try:
+            if cursor:
+                recent_posts, next_cursor = app_storage().recent_posts_page(
+                    cursor)
+            else:
+                recent_posts, next_cursor = app_storage().first_posts_page()
+        except InvalidCursorError:
+            return self.error(404)
         error_helper_inst.setup_main_page_like_buttons(recent_posts, self)
         self.render(MAIN_PAGE_TEMPLATE, recent_blog_posts=recent_posts,
-                    error_helper=error_helper_inst)
+                    error_helper=error_helper_inst,
+                    next_page=self._next_page_uri(next_cursor))
+
+    def _next_page_uri(self, next_cursor):
+        '''Returns the uri of the next page of posts, or None if there is no
+        next page.
+        @param next_cursor: url-safe cursor str of the next page, or None
+        '''
+        if next_cursor:
+            return self.uri_for(HOME, HOME, cursor=next_cursor)
 
 
 class NewPost(Handler):
@@ -406,10 +642,9 @@ class NewPost(Handler):
         '''
         helper = HandlerHelper(self, (SUBJECT, CONTENT))
         if helper.is_data_valid:
-            new_post_key = BlogPost.create_new_post(helper.cur_user,
+            new_post_id = app_storage().create_post(helper.cur_user,
                                                     helper.valid_data)
-            self.redirect(self.uri_for(DISPLAY_POST, new_post_key.urlsafe(),
-                                       DISPLAY))
+            self.redirect(self.uri_for(DISPLAY_POST, new_post_id, DISPLAY))
         else:
             helper.validate_form_input(NEW_POST_TEMPLATE)
 
@@ -421,10 +656,12 @@ class BlogPostDisplay(Handler):
     delete existing comments.
     '''
     
+    @Handler.cache_anonymous_page(_post_page_version_key)
+    @Handler.read_post_version
     @Handler.check_post_exists
     def get(self, post_key, error):
         '''Renders an individual blog post and all comments made on that post.
-        @param post_key: the url key from the uri of for the post being viewed
+        @param post_key: the post id from the uri of the post being viewed
         '''
         helper = HandlerHelper(self, (), post_key)
         if error == OWN_POST:
@@ -439,29 +676,66 @@ class BlogPostDisplay(Handler):
             error_helper = ErrorHelper(None, None)
         self._render_post_template(helper, error_helper)
 
-    def _choose_template(self, post_entity):
+    def _choose_template(self, num_comments):
         '''Returns the proper template for rendering based on whether this post
         has comments.
-        @param post_entity: the BlogPost entity to be rendered
+        @param num_comments: the number of comments on the post
         '''
-        if post_entity.cur_num_comments == 0:
+        if num_comments == 0:
             return POST_ONLY_TEMPLATE
         else:
             return POST_WITH_COMMENTS
 
     def _render_post_template(self, helper, error_helper_instance):
-        '''Renders a blog post template.
+        '''Renders a blog post template. The post body and the comment thread
+        come from the fragment cache; only the like button and error messages,
+        which depend on the current user, are rendered on every request. The
+        like state, comment count and like count are read concurrently.
         @param helper: a HandlerHelper instance from get/post
         @param error_helper_instance: an ErrorHelper instance from same
         '''
-        comments = BlogPost.get_all_comments(helper.cur_post)
-        to_render = dict(current_post=helper.cur_post,
-                         like_text=helper.gen_like_text(),
-                         all_comments=comments,
+        post = helper.cur_post
+        version = self.context.content_version(post.post_id)
+        stats = app_storage().get_post_stats(post.post_id, helper.cur_user)
+        template = self._choose_template(stats.num_comments)
+        post_body = FragmentCache.get_or_render(
+            post.post_id, version, "body",
+            lambda: self.render_fragment(
+                POST_BODY_FRAGMENT, current_post=post,
+                like_count=stats.num_likes))
+        comment_thread = ""
+        if template == POST_WITH_COMMENTS:
+            cursor = self.request.get(CURSOR)
+            try:
+                comment_thread = FragmentCache.get_or_render(
+                    post.post_id, version, "comments:" + cursor,
+                    lambda: self._render_comment_thread(post, cursor))
+            except InvalidCursorError:
+                return self.error(404)
+        to_render = dict(current_post=post,
+                         post_body=jinja2.Markup(post_body),
+                         comment_thread=jinja2.Markup(comment_thread),
+                         like_text="Unlike" if stats.liked else "Like",
                          error_helper=error_helper_instance)
         to_render.update(helper.valid_data)
-        self.render(self._choose_template(helper.cur_post),
-                    **to_render)
+        self.render(template, **to_render)
+
+    def _render_comment_thread(self, post, cursor):
+        '''Renders one page of the comments of a post.
+        @param post: the PostRecord of the post whose comments to render
+        @param cursor: cursor str of the page, "" for the first page
+        @return: the rendered fragment
+        @raise InvalidCursorError: if cursor is not a valid cursor
+        '''
+        comments, next_cursor = app_storage().get_comments_page(
+            post.post_id, cursor or None)
+        next_page = None
+        if next_cursor:
+            next_page = self.uri_for(DISPLAY_POST, post.post_id,
+                                     DISPLAY_POST, cursor=next_cursor)
+        return self.render_fragment(COMMENT_THREAD_FRAGMENT,
+                                    all_comments=comments,
+                                    next_page=next_page)
         
     def parse_url_error(self, error_string):
         split_text = error_string.split("_")
@@ -477,11 +751,11 @@ class EditPost(Handler):
     @Handler.check_post_exists
     def get(self, post_key):
         '''Handles requests to display the edit post form.
-        @param post_key: string id of a BlogPost entity supplied in the URI
+        @param post_key: string id of a post supplied in the URI
         '''
         helper = HandlerHelper(self, (), post_key)
-        self.render(NEW_POST_TEMPLATE, subject=helper.cur_post.post_subject,
-                    content=helper.cur_post.post_content)
+        self.render(NEW_POST_TEMPLATE, subject=helper.cur_post.subject,
+                    content=helper.cur_post.content)
 
     @Handler.check_is_author(POST)
     @Handler.check_logged_in
@@ -489,11 +763,11 @@ class EditPost(Handler):
     def post(self, post_key):
         '''Handles submission of edited post form. Validates form data and
         submits edited content to the database.
-        @param post_key: string id of a BlogPost entity supplied in the URI
+        @param post_key: string id of a post supplied in the URI
         '''
         helper = HandlerHelper(self, (SUBJECT, CONTENT), post_key)
         if helper.is_data_valid:
-            BlogPost.update_post(helper.cur_post, helper.valid_data)
+            app_storage().update_post(post_key, helper.valid_data)
             self.redirect(self.uri_for(DISPLAY_POST, post_key, DISPLAY_POST))
         else:
             helper.validate_form_input(NEW_POST_TEMPLATE)
@@ -507,7 +781,7 @@ class DeletePost(Handler):
     @Handler.check_logged_in
     @Handler.check_post_exists
     def post(self, post_key):
-        BlogPost.delete_post(ndb.Key(urlsafe=post_key).get())
+        app_storage().delete_post(post_key)
         self.redirect(self.uri_for(HOME, HOME))
 
 class DeleteComment(Handler):
@@ -519,9 +793,9 @@ class DeleteComment(Handler):
     @Handler.check_post_exists
     def post(self, post_key):
         comment_key = self.request.get("comment_key")
-        comment_to_delete = ndb.Key(urlsafe=comment_key).get()
+        comment_to_delete = self.context.get_comment(comment_key)
         if comment_to_delete is not None:
-            Comment.delete_comment(comment_to_delete)
+            app_storage().delete_comment(comment_key)
             self.redirect(self.uri_for(DISPLAY_POST, post_key, DISPLAY_POST))
         else:
             return self.error(404)
@@ -548,17 +822,29 @@ class Signup(Handler):
         '''
         helper = HandlerHelper(self, (USER, PASSWORD, PWD_VERIFY, EMAIL))
         helper.validate_form_input(SIGNUP_TEMPLATE)
+        if not helper.is_data_valid:
+            return
+        storage = app_storage()
+        user_name = helper.valid_data.get(USER)
         try:
-            user_entity = User.already_exists(helper.valid_data.get(USER))
+            user_exists = storage.get_user(user_name) is not None
         except:
             return self.error(404)
-        if helper.is_data_valid and user_entity:
+        # Created first, so no session starts if hashing is busy. Creating
+        # fails if someone took the name since it was checked.
+        if not user_exists:
+            password = PwdUtil(helper.valid_data.get(PASSWORD))
+            try:
+                storage.create_user(user_name, password.new_pwd_salt_pair(),
+                                    helper.valid_data.get(EMAIL))
+            except DuplicateUserError:
+                user_exists = True
+        if user_exists:
             helper.set_template_field(USER + ERROR, "User already exists. " +
                                       "Please choose another user name.")
             self.render(SIGNUP_TEMPLATE, **helper.valid_data)
-        elif helper.is_data_valid:
+        else:
             helper.login_user()
-            User.create_new_user(helper.valid_data)
             self.redirect(WELCOME)
 
 
@@ -572,7 +858,7 @@ class NewComment(Handler):
         '''Displays the form to add a new comment to a blog post. If a user
         attempts to visit this page without being logged in, they are directed
         to the signup page.
-        @param post_key: string id of a BlogPost entity supplied in the URI
+        @param post_key: string id of a post supplied in the URI
         @param origin: the leaf of the URI tree where this request originated
         '''
         helper = HandlerHelper(self, (), post_key)
@@ -582,15 +868,15 @@ class NewComment(Handler):
     @Handler.check_post_exists
     def post(self, post_key, origin):
         '''Handles form submission of new comment.
-        @param post_key: string id of a BlogPost entity supplied in the URI
+        @param post_key: string id of a post supplied in the URI
         @param origin: the leaf of the URI tree where this request originated
         '''
         helper = HandlerHelper(self, [CONTENT], post_key)
         helper.validate_form_input(COMMENT_TEMPLATE,
                                    current_post=helper.cur_post)
         if helper.is_data_valid:
-            Comment.create_new_comment(helper.cur_user,
-                                       post_key, helper.valid_data)
+            app_storage().create_comment(helper.cur_user, post_key,
+                                         helper.valid_data)
             self.redirect(self.uri_for(DISPLAY_POST, post_key, origin))
 
 class EditComment(Handler):
@@ -608,10 +894,10 @@ class EditComment(Handler):
     def get(self, post_key):
         '''Retrieves the content of a comment and renders it to a form for
         editing.
-        @param post_key: url-safe ndb entity key
+        @param post_key: string id of a post supplied in the URI
         '''
         helper = HandlerHelper(self, (), post_key)
-        cur_comment = ndb.Key(urlsafe=self.request.get("comment_key")).get() 
+        cur_comment = self.context.get_comment(self.request.get("comment_key"))
         self.render(COMMENT_TEMPLATE, current_post=helper.cur_post,
                         content=cur_comment.content)
 
@@ -621,13 +907,15 @@ class EditComment(Handler):
     def post(self, post_key):
         '''Handles submission of edited comment form. Validates data submitted 
         and updates the database.
-        @param post_key: url-safe ndb entity key
+        @param post_key: string id of a post supplied in the URI
         '''
         helper = HandlerHelper(self, [CONTENT], post_key)
         if helper.is_data_valid:
-            cur_comment = Comment.entity_from_uri(self.request.get("comment_key"))
+            cur_comment = self.context.get_comment(
+                self.request.get("comment_key"))
             if cur_comment is not None:
-                Comment.update_comment(cur_comment, helper.valid_data)
+                app_storage().update_comment(cur_comment.comment_id,
+                                             helper.valid_data)
             else:
                 return self.error(404)
             self.redirect(self.uri_for(DISPLAY_POST, post_key, DISPLAY_POST))
@@ -670,13 +958,17 @@ class Login(Handler):
         helper = HandlerHelper(self, (USER, PASSWORD))
         helper.validate_form_input(LOGIN_TEMPLATE)
         try:
-            user_entity = User.already_exists(helper.valid_data.get(USER))
+            user = app_storage().get_user(helper.valid_data.get(USER))
         except:
             return self.error(404)
-        if helper.valid_data and user_entity:
+        if helper.valid_data and user:
             pwd_helper = PwdUtil(helper.valid_data.get(PASSWORD),
-                                 user_entity.password)
+                                 user.password)
             if pwd_helper.verify_password():
+                if pwd_helper.needs_rehash():
+                    rehashed = PwdUtil(helper.valid_data.get(PASSWORD))
+                    app_storage().update_password(
+                        user.user_name, rehashed.new_pwd_salt_pair())
                 helper.login_user()
                 self.redirect(self.uri_for(WELCOME))
             else:
@@ -695,94 +987,43 @@ class Logout(Handler):
     def get(self):
         '''Logs the user out and redirects to the signup page.
         '''
-        CookieUtil.set_cookie(USER, "", self)
+        CookieUtil.revoke_cookie(USER, self)
         self.redirect(self.uri_for(SIGNUP, DISPLAY))
 
 
-class FormHelper(object):
-    '''Class to help process form input.
-    Attributes:
-        _regex_table: regular expressions keyed to global constants matching
-                      the form field name in the template. Text input
-                      into form needs to match these expressions.
-        _error_table: same use of global constants, values are error messages
-                      that result when regex does not match
-        valid_input: boolean flag - true if all form fields match regex
-        _handler: webapp2 request handler instance using this class
+class Warmup(webapp2.RequestHandler):
+    '''Class to handle warmup requests, sent by App Engine to a new instance
+    before it takes traffic.
     '''
 
-    def __init__(self, handler):
-        self._regex_table = {
-                        USER : r"^[a-zA-Z0-9_-]{3,20}$",
-                        PASSWORD: r"^.{3,20}$",
-                        PWD_VERIFY : r"^.{3,20}$",
-                        EMAIL: r"(^[\S]+@[\S]+.[\S]+$)|(^(?![\s\S]))",
-                        SUBJECT : "^.{1,100}$",
-                        CONTENT : "^.{1,}$"
-                        }
-        self._error_table = {
-                        USER : "The username is invalid.",
-                        PASSWORD : "The password is invalid.",
-                        PWD_VERIFY : "The passwords do not match.",
-                        EMAIL : "Invalid email address.",
-                        SUBJECT : "You must have a subject of less than "
-                                   + "100 chars in length.",
-                        CONTENT: "You must include some content."
-                        }
-        self.valid_input = True
-        self._handler = handler
-
-    def _is_input_valid(self, input_name):
-        '''Checks if form field input matches regex.
-        @param input_name: global constant name of the form field. Assumes this
-        constant is present in both class dicts.
-        @return: boolean - does the form field match
-        '''
-        if input_name == PWD_VERIFY:
-            return self._handler.request.get(
-                PWD_VERIFY) == self._handler.request.get(PASSWORD)
-        else:
-            pattern = re.compile(self._regex_table[input_name])
-            return pattern.match(self._handler.request.get(input_name))
-
-    def validate_form_data(self, all_fields):
-        '''Checks each form field to make sure it matches the regex, supplies
-        error messages if it does not.
-        @param all_fields: the names of the form fields to check, they must be
-        present in _regex_table and _error_table.
-        @return: either a copy of the dict passed to this method or a dict
-        containing error messages keyed to the form field name.
-        '''
-        to_render = {}
-        for input_name in all_fields:
-            if not self._is_input_valid(input_name):
-                to_render[input_name + ERROR] = self._error_table.get(
-                    input_name)
-                to_render[input_name] = ""
-                self.valid_input = False
-            else:
-                to_render[input_name] = self._handler.request.get(input_name)
-        return to_render
-
-
-app = webapp2.WSGIApplication([
-    routes.PathPrefixRoute("/blog", [
-        webapp2.Route("/display/<:\w+>", BlogMainPage, HOME),
-        webapp2.Route("/error/<:\w+-\w+|\w+>", BlogMainPage, HOME_ERROR),
-        webapp2.Route("/new_post", NewPost, NEW_POST),
-        routes.PathPrefixRoute("/post_id/<:\w+-\w+|\w+>", [
-            webapp2.Route("/display/<:\w+>", BlogPostDisplay, DISPLAY_POST),
-            webapp2.Route("/comment/new/<:\w+>", NewComment, NEW_COMMENT),
-            webapp2.Route("/comment/edit", 
-                          EditComment, EDIT_COMMENT),
-            webapp2.Route("/edit", EditPost, EDIT_POST),
-            webapp2.Route("/delete", DeletePost, DELETE_POST),
-            webapp2.Route("/comment/delete", 
-                          DeleteComment, DELETE_COMMENT),
-            webapp2.Route("/like_post/<:\w+>", LikePost, LIKE_POST)]),
-        webapp2.Route("/user_welcome", Welcome, WELCOME),
-        webapp2.Route("/login", Login, LOGIN),
-        webapp2.Route("/logout", Logout, LOGOUT),
-        webapp2.Route("/signup/<:\w+>", Signup, SIGNUP)
-    ])
-])
+    def get(self):
+        '''Loads every template and fills the cache of the home feed, so the
+        first visitors do not pay for either.
+        '''
+        for template in ALL_TEMPLATES:
+            jinja_env().get_template(template)
+        app_storage().first_posts_page()
+        self.response.out.write("")
+
+
+class ProfileReport(webapp2.RequestHandler):
+    '''Class to handle the admin-only page listing the profiled hotspots of
+    each route.
+    '''
+
+    def get(self):
+        '''Shows the top cumulative hotspots of each profiled route.
+        '''
+        if not users.is_current_user_admin():
+            return self.abort(403)
+        self.response.headers["Content-Type"] = "text/plain"
+        self.response.out.write(RouteProfiles.report() or
+                                "No requests have been profiled.\n")
+
+    def post(self):
+        '''Discards every profile.
+        '''
+        if not users.is_current_user_admin():
+            return self.abort(403)
+        RouteProfiles.clear()
+        self.redirect(self.uri_for(PROFILES))
@@ -0,0 +1,1007 @@
+'''
+Pluggable storage of the blog-engine's users, posts, comments and likes.
+
+Storage is the repository interface. Its backends are:
+    NdbStorage - the App Engine datastore, through the classmethods of the
+                 models in ndb_models
+    MemoryStorage - dicts in process memory, for fast tests and benchmarks
+    SqliteStorage - a SQLite database, for self-hosting on plain Linux boxes
+
+Backends return plain records rather than model entities, and identify posts
+and comments by opaque id strs, so callers can run against any backend.
+Only NdbStorage needs the App Engine SDK. The handlers reach the backend
+chosen by blog_config.STORAGE_BACKEND through app_storage.
+
+Created on Jul 21, 2017
+@author: kennethalamantia
+'''
+
+import abc
+import datetime
+import itertools
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+import blog_config
+import blog_constants as bc
+
+# Storage constants, kept equal to those in ndb_models
+RECENT_POSTS = 20
+EXCERPT_LENGTH = 300
+COMMENT_PAGE_SIZE = 20
+
+# SQLite settings
+SQLITE_STATEMENT_CACHE = 100
+SQLITE_TIMEOUT_SECS = 10.0
+SQLITE_MEMORY = ":memory:"
+SQLITE_MAX_ROWID = 2 ** 63 - 1
+
+# Records returned by every backend
+UserRecord = namedtuple("UserRecord", ["user_name", "password", "email",
+                                       "date_created", "posts_made"])
+PostRecord = namedtuple("PostRecord", ["post_id", "author", "post_number",
+                                       "subject", "content", "excerpt",
+                                       "content_length", "date_created"])
+CommentRecord = namedtuple("CommentRecord", ["comment_id", "post_id",
+                                             "author", "content",
+                                             "date_created"])
+PostStats = namedtuple("PostStats", ["num_comments", "num_likes", "liked"])
+
+
+class InvalidCursorError(ValueError):
+    '''Raised when a page is requested with a cursor str that the backend did
+    not issue.
+    '''
+
+
+class DuplicateUserError(ValueError):
+    '''Raised when a user is created with a user name that is taken.
+    '''
+
+
+class Storage(object):
+    '''Repository interface of the blog-engine's data. Subclasses implement
+    every abstract method; the others may be overridden where a backend can
+    do better, e.g. by batching reads.
+    Backends that do not keep the fragment and page caches current
+    themselves report each write to a listener, with the ids of the content
+    whose version stamps it changed: the id of a post, or
+    bc.HOME_CONTENT_ID for the first page of the home page.
+    Attributes:
+        _on_change: function taking a tuple of changed content ids, or None
+    '''
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, on_change=None):
+        '''
+        @param on_change: function called with a tuple of the content ids
+        changed by each write, e.g. fragment_cache.ContentVersion.bump_multi
+        '''
+        self._on_change = on_change
+
+    @abc.abstractmethod
+    def create_user(self, user_name, password, email=None):
+        '''Creates a new user account.
+        @param user_name: the str user name
+        @param password: the hashed and salted password, see PwdUtil
+        @param email: the user's email address, or None
+        @return: the user name
+        @raise DuplicateUserError: if the user already exists
+        '''
+
+    @abc.abstractmethod
+    def get_user(self, user_name):
+        '''Returns the UserRecord of a user, or None if there is none.
+        '''
+
+    @abc.abstractmethod
+    def update_password(self, user_name, password):
+        '''Replaces the stored password of a user.
+        @param user_name: the str user name
+        @param password: the new hashed and salted password, see PwdUtil
+        '''
+
+    @abc.abstractmethod
+    def create_post(self, user_name, form_data):
+        '''Creates a new post numbered from its author's total number of
+        posts made.
+        @param user_name: the user name of the post's author
+        @param form_data: dict keyed to global constants containing the
+        subject and content strs
+        @return: the str id of the new post
+        @raise KeyError: if the user does not exist, in the memory and SQLite
+        backends
+        '''
+
+    @abc.abstractmethod
+    def get_post(self, post_id):
+        '''Returns the PostRecord of a post, or None if there is none or the
+        id is not a post id of this backend.
+        '''
+
+    @abc.abstractmethod
+    def update_post(self, post_id, form_data):
+        '''Updates the subject and content of a post.
+        @param post_id: the str id of the post
+        @param form_data: dict keyed to global constants containing the
+        edited subject and content strs
+        @return: the updated PostRecord
+        '''
+
+    @abc.abstractmethod
+    def delete_post(self, post_id):
+        '''Deletes a post with its comments and likes.
+        @param post_id: the str id of the post
+        '''
+
+    @abc.abstractmethod
+    def recent_posts_page(self, cursor=None, page_size=RECENT_POSTS):
+        '''Returns one page of post summaries, most recent first. The content
+        of a summary may be None; every other field is set.
+        @param cursor: cursor str marking the start of the page, or None for
+        the first page
+        @param page_size: the maximum number of posts on the page
+        @return: tuple of a list of PostRecords and the cursor str of the next
+        page, or None if this is the last page
+        @raise InvalidCursorError: if cursor is not a valid cursor
+        '''
+
+    def first_posts_page(self):
+        '''Returns the first page of the home page, as recent_posts_page(None)
+        does. Backends may serve it from a materialized feed.
+        '''
+        return self.recent_posts_page(None)
+
+    def most_recent_posts(self, limit=RECENT_POSTS):
+        '''Returns a list of the summaries of up to limit posts, most recent
+        first.
+        '''
+        return self.recent_posts_page(None, limit)[0]
+
+    @abc.abstractmethod
+    def create_comment(self, user_name, post_id, form_data):
+        '''Creates a new comment on a post.
+        @param user_name: the user name of the comment's author
+        @param post_id: the str id of the post
+        @param form_data: dict keyed to global constant containing the
+        content of the comment
+        @return: the str id of the new comment
+        '''
+
+    @abc.abstractmethod
+    def get_comment(self, comment_id):
+        '''Returns the CommentRecord of a comment, or None if there is none or
+        the id is not a comment id of this backend.
+        '''
+
+    @abc.abstractmethod
+    def update_comment(self, comment_id, form_data):
+        '''Updates the content of a comment.
+        @param comment_id: the str id of the comment
+        @param form_data: dict keyed to global constant containing the
+        edited content
+        @return: the updated CommentRecord
+        '''
+
+    @abc.abstractmethod
+    def delete_comment(self, comment_id):
+        '''Deletes a comment.
+        @param comment_id: the str id of the comment
+        '''
+
+    @abc.abstractmethod
+    def get_all_comments(self, post_id):
+        '''Returns a list of the CommentRecords of a post, most recent first.
+        '''
+
+    @abc.abstractmethod
+    def get_comments_page(self, post_id, cursor=None,
+                          page_size=COMMENT_PAGE_SIZE):
+        '''Returns one page of the comments of a post, most recent first.
+        @param post_id: the str id of the post
+        @param cursor: cursor str marking the start of the page, or None for
+        the first page
+        @param page_size: the maximum number of comments on the page
+        @return: tuple of a list of CommentRecords and the cursor str of the
+        next page, or None if this is the last page
+        @raise InvalidCursorError: if cursor is not a valid cursor
+        '''
+
+    @abc.abstractmethod
+    def count_comments(self, post_id):
+        '''Returns the number of current comments on a post.
+        '''
+
+    @abc.abstractmethod
+    def add_like_unlike(self, post_id, user_name, like_status):
+        '''Records or removes a user's like of a post.
+        @param post_id: the str id of the post
+        @param user_name: the user liking/unliking the post
+        @param like_status: current str value of the like button
+        @return: boolean, true if a like was added or removed
+        '''
+
+    @abc.abstractmethod
+    def has_liked(self, post_id, user_name):
+        '''Has a given user liked a post?
+        @param user_name: the user name to check, None if no user is logged in
+        @return: boolean
+        '''
+
+    @abc.abstractmethod
+    def count_likes(self, post_id):
+        '''Returns the number of users who have liked a post.
+        '''
+
+    @abc.abstractmethod
+    def liked_by_user(self, post_ids, user_name):
+        '''Which of several posts has a user liked?
+        @param post_ids: list of str ids of posts
+        @param user_name: the user name to check, None if no user is logged in
+        @return: set of the ids of the posts the user has liked
+        '''
+
+    def get_post_stats(self, post_id, user_name):
+        '''Returns what the page of a post shows besides the post itself.
+        @param post_id: the str id of the post
+        @param user_name: the user viewing the post, None if no user is
+        logged in
+        @return: PostStats of the number of comments and likes of the post,
+        and whether the user has liked it
+        '''
+        return PostStats(self.count_comments(post_id),
+                         self.count_likes(post_id),
+                         self.has_liked(post_id, user_name))
+
+    def _changed(self, *content_ids):
+        '''Reports the ids of the content changed by a write to the listener.
+        '''
+        if self._on_change is not None:
+            self._on_change(content_ids)
+
+
+def _new_post_record(post_id, user_name, post_number, form_data,
+                     date_created):
+    '''Returns the PostRecord of a new post, with its summary fields set.
+    '''
+    content = form_data[bc.CONTENT]
+    return PostRecord(post_id, user_name, post_number, form_data[bc.SUBJECT],
+                      content, content[:EXCERPT_LENGTH], len(content),
+                      date_created)
+
+
+def _post_id(user_name, post_number):
+    '''Returns the str id of a post in the memory and SQLite backends. Made of
+    word characters only, so it can be used in the blog's urls.
+    '''
+    return "%s_%d" % (user_name.encode("utf-8").encode("hex"), post_number)
+
+
+def _cursor_position(cursor, first):
+    '''Returns the int position marked by a cursor str of the memory and
+    SQLite backends, or first if there is no cursor.
+    @raise InvalidCursorError: if cursor is not a str of digits
+    '''
+    if not cursor:
+        return first
+    if not cursor.isdigit():
+        raise InvalidCursorError(cursor)
+    return int(cursor)
+
+
+class NdbStorage(Storage):
+    '''Storage in the App Engine datastore. Post and comment ids are the
+    url-safe keys of their entities, as used in the blog's urls. The models
+    bump the version stamps of the content they write themselves, so the
+    on_change listener is never called.
+    Attributes:
+        _models: the ndb_models module
+        _errors: the datastore_errors module
+    '''
+
+    def __init__(self, on_change=None):
+        # Imported here so the other backends run without the SDK.
+        from google.appengine.api import datastore_errors
+        import ndb_models
+        super(NdbStorage, self).__init__(on_change)
+        self._models = ndb_models
+        self._errors = datastore_errors
+
+    def create_user(self, user_name, password, email=None):
+        if self._models.User.insert_user(user_name, password, email) is None:
+            raise DuplicateUserError(user_name)
+        return user_name
+
+    def get_user(self, user_name):
+        user = self._models.User.already_exists(user_name)
+        if user is None:
+            return None
+        return UserRecord(user.user_name, user.password, user.email,
+                          user.date_created, user.posts_made)
+
+    def update_password(self, user_name, password):
+        self._models.User.set_password(user_name, password)
+
+    def create_post(self, user_name, form_data):
+        return self._models.BlogPost.create_new_post(user_name,
+                                                     form_data).urlsafe()
+
+    def get_post(self, post_id):
+        post = self._entity(post_id, "BlogPost")
+        return self._post_record(post) if post is not None else None
+
+    def update_post(self, post_id, form_data):
+        return self._post_record(self._models.BlogPost.update_post(
+            self._key(post_id).get(), form_data))
+
+    def delete_post(self, post_id):
+        post = self._key(post_id).get()
+        if post is not None:
+            self._models.BlogPost.delete_post(post)
+
+    def recent_posts_page(self, cursor=None, page_size=RECENT_POSTS):
+        try:
+            posts, next_cursor = self._models.BlogPost.recent_posts_page(
+                cursor, page_size)
+        except (self._errors.BadValueError, self._errors.BadRequestError):
+            raise InvalidCursorError(cursor)
+        return [self._summary_record(post) for post in posts], next_cursor
+
+    def first_posts_page(self):
+        entries, next_cursor = self._models.HomeFeed.first_page()
+        return [self._summary_record(entry) for entry in entries], next_cursor
+
+    def create_comment(self, user_name, post_id, form_data):
+        return self._models.Comment.create_new_comment(user_name, post_id,
+                                                       form_data).urlsafe()
+
+    def get_comment(self, comment_id):
+        comment = self._entity(comment_id, "Comment")
+        return self._comment_record(comment) if comment is not None else None
+
+    def update_comment(self, comment_id, form_data):
+        return self._comment_record(self._models.Comment.update_comment(
+            self._key(comment_id).get(), form_data))
+
+    def delete_comment(self, comment_id):
+        comment = self._key(comment_id).get()
+        if comment is not None:
+            self._models.Comment.delete_comment(comment)
+
+    def get_all_comments(self, post_id):
+        comments = self._models.BlogPost.comments_query(
+            self._key(post_id)).fetch()
+        return [self._comment_record(comment) for comment in comments]
+
+    def get_comments_page(self, post_id, cursor=None,
+                          page_size=COMMENT_PAGE_SIZE):
+        try:
+            comments, next_cursor = self._models.BlogPost.comments_page_async(
+                self._key(post_id), cursor, page_size).get_result()
+        except (self._errors.BadValueError, self._errors.BadRequestError):
+            raise InvalidCursorError(cursor)
+        return ([self._comment_record(comment) for comment in comments],
+                next_cursor)
+
+    def count_comments(self, post_id):
+        return self._models.BlogPost.count_comments_async(
+            self._key(post_id)).get_result()
+
+    def add_like_unlike(self, post_id, user_name, like_status):
+        if like_status == "Like":
+            return self._models.Like.add_like(self._key(post_id), user_name)
+        return self._models.Like.remove_like(self._key(post_id), user_name)
+
+    def has_liked(self, post_id, user_name):
+        return self._models.Like.has_liked(self._key(post_id), user_name)
+
+    def count_likes(self, post_id):
+        return self._models.Like.count_likes(self._key(post_id))
+
+    def liked_by_user(self, post_ids, user_name):
+        post_keys = [self._key(post_id) for post_id in post_ids]
+        liked_keys = self._models.Like.liked_by_user(post_keys, user_name)
+        return set(post_id for post_id, post_key in zip(post_ids, post_keys)
+                   if post_key in liked_keys)
+
+    def get_post_stats(self, post_id, user_name):
+        '''Reads the comment count, like count and like state concurrently.
+        '''
+        post_key = self._key(post_id)
+        models = self._models
+        futures = (models.BlogPost.count_comments_async(post_key),
+                   models.Like.count_likes_async(post_key),
+                   models.Like.has_liked_async(post_key, user_name))
+        return PostStats(*[future.get_result() for future in futures])
+
+    def _key(self, record_id):
+        '''Returns the key of a post or comment from its id.
+        '''
+        return self._models.ndb.Key(urlsafe=record_id)
+
+    def _entity(self, record_id, kind):
+        '''Returns the entity of a post or comment id, or None if there is
+        none or the id is not the url-safe key of an entity of that kind.
+        @param record_id: the str id from a url or a form
+        @param kind: the str kind of the entity, "BlogPost" or "Comment"
+        '''
+        try:
+            key = self._key(record_id)
+        except Exception:
+            return None
+        if key.kind() != kind:
+            return None
+        try:
+            return key.get()
+        except self._errors.BadRequestError:
+            # The key belongs to another application or namespace.
+            return None
+
+    def _post_record(self, post):
+        '''Returns the PostRecord of a BlogPost entity.
+        '''
+        return PostRecord(post.key.urlsafe(), post.post_author,
+                          int(post.post_number), post.post_subject,
+                          post.post_content, post.post_excerpt,
+                          post.content_length, post.date_created)
+
+    def _summary_record(self, summary):
+        '''Returns the PostRecord of a HomeFeedEntry or projected BlogPost,
+        with neither content nor date set.
+        '''
+        return PostRecord(summary.key.urlsafe(), summary.post_author,
+                          int(summary.key.id()), summary.post_subject, None,
+                          summary.post_excerpt, summary.content_length, None)
+
+    def _comment_record(self, comment):
+        '''Returns the CommentRecord of a Comment entity.
+        '''
+        return CommentRecord(comment.key.urlsafe(),
+                             comment.key.parent().urlsafe(), comment.author,
+                             comment.content, comment.date_created)
+
+
+class MemoryStorage(Storage):
+    '''Thread-safe storage in process memory. Nothing is persisted. Cursors
+    are offsets into the listing they page through.
+    Attributes:
+        _users: dict of UserRecords keyed by user name
+        _posts: dict of PostRecords keyed by post id
+        _post_order: list of post ids in the order the posts were created
+        _comments: dict of CommentRecords keyed by comment id
+        _post_comments: dict of lists of comment ids, oldest first, keyed by
+                        post id
+        _likes: set of (post id, user name) tuples
+        _like_counts: dict of the number of likes keyed by post id
+        _comment_ids: iterator of new comment numbers
+        _lock: lock serializing every operation
+    '''
+
+    def __init__(self, on_change=None):
+        super(MemoryStorage, self).__init__(on_change)
+        self._users = {}
+        self._posts = {}
+        self._post_order = []
+        self._comments = {}
+        self._post_comments = {}
+        self._likes = set()
+        self._like_counts = {}
+        self._comment_ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def create_user(self, user_name, password, email=None):
+        with self._lock:
+            if user_name in self._users:
+                raise DuplicateUserError(user_name)
+            self._users[user_name] = UserRecord(user_name, password, email,
+                                                datetime.datetime.utcnow(), 0)
+            return user_name
+
+    def get_user(self, user_name):
+        return self._users.get(user_name)
+
+    def update_password(self, user_name, password):
+        with self._lock:
+            self._users[user_name] = self._users[user_name]._replace(
+                password=password)
+
+    def create_post(self, user_name, form_data):
+        with self._lock:
+            user = self._users[user_name]
+            post_number = user.posts_made + 1
+            self._users[user_name] = user._replace(posts_made=post_number)
+            post_id = _post_id(user_name, post_number)
+            self._posts[post_id] = _new_post_record(
+                post_id, user_name, post_number, form_data,
+                datetime.datetime.utcnow())
+            self._post_order.append(post_id)
+            self._post_comments[post_id] = []
+        self._changed(bc.HOME_CONTENT_ID)
+        return post_id
+
+    def get_post(self, post_id):
+        return self._posts.get(post_id)
+
+    def update_post(self, post_id, form_data):
+        with self._lock:
+            post = self._posts[post_id]
+            post = _new_post_record(post_id, post.author, post.post_number,
+                                    form_data, post.date_created)
+            self._posts[post_id] = post
+        self._changed(post_id, bc.HOME_CONTENT_ID)
+        return post
+
+    def delete_post(self, post_id):
+        with self._lock:
+            del self._posts[post_id]
+            self._post_order.remove(post_id)
+            for comment_id in self._post_comments.pop(post_id):
+                del self._comments[comment_id]
+            self._likes = set(like for like in self._likes
+                              if like[0] != post_id)
+            self._like_counts.pop(post_id, None)
+        self._changed(post_id, bc.HOME_CONTENT_ID)
+
+    def recent_posts_page(self, cursor=None, page_size=RECENT_POSTS):
+        start = _cursor_position(cursor, 0)
+        with self._lock:
+            post_ids = self._post_order[::-1][start:start + page_size + 1]
+            posts = [self._posts[post_id] for post_id in post_ids]
+        return self._page(posts, start, page_size)
+
+    def create_comment(self, user_name, post_id, form_data):
+        with self._lock:
+            comment_id = str(next(self._comment_ids))
+            self._comments[comment_id] = CommentRecord(
+                comment_id, post_id, user_name, form_data[bc.CONTENT],
+                datetime.datetime.utcnow())
+            self._post_comments[post_id].append(comment_id)
+        self._changed(post_id)
+        return comment_id
+
+    def get_comment(self, comment_id):
+        return self._comments.get(comment_id)
+
+    def update_comment(self, comment_id, form_data):
+        with self._lock:
+            comment = self._comments[comment_id]._replace(
+                content=form_data[bc.CONTENT])
+            self._comments[comment_id] = comment
+        self._changed(comment.post_id)
+        return comment
+
+    def delete_comment(self, comment_id):
+        with self._lock:
+            comment = self._comments.pop(comment_id)
+            self._post_comments[comment.post_id].remove(comment_id)
+        self._changed(comment.post_id)
+
+    def get_all_comments(self, post_id):
+        with self._lock:
+            return [self._comments[comment_id] for comment_id
+                    in reversed(self._post_comments.get(post_id, []))]
+
+    def get_comments_page(self, post_id, cursor=None,
+                          page_size=COMMENT_PAGE_SIZE):
+        start = _cursor_position(cursor, 0)
+        with self._lock:
+            comment_ids = self._post_comments.get(post_id, [])[::-1]
+            comments = [self._comments[comment_id] for comment_id
+                        in comment_ids[start:start + page_size + 1]]
+        return self._page(comments, start, page_size)
+
+    def count_comments(self, post_id):
+        return len(self._post_comments.get(post_id, []))
+
+    def add_like_unlike(self, post_id, user_name, like_status):
+        like = (post_id, user_name)
+        with self._lock:
+            if like_status == "Like":
+                if like in self._likes:
+                    return False
+                self._likes.add(like)
+                delta = 1
+            else:
+                if like not in self._likes:
+                    return False
+                self._likes.remove(like)
+                delta = -1
+            self._like_counts[post_id] = (self._like_counts.get(post_id, 0) +
+                                          delta)
+        self._changed(post_id)
+        return True
+
+    def has_liked(self, post_id, user_name):
+        return (post_id, user_name) in self._likes
+
+    def count_likes(self, post_id):
+        return self._like_counts.get(post_id, 0)
+
+    def liked_by_user(self, post_ids, user_name):
+        return set(post_id for post_id in post_ids
+                   if (post_id, user_name) in self._likes)
+
+    def _page(self, records, start, page_size):
+        '''Returns a page of records and the cursor of the next page.
+        @param records: list of up to page_size + 1 records from the listing,
+        the last one only read to find out whether there is a next page
+        @param start: the offset of the page in the listing
+        '''
+        if len(records) > page_size:
+            return records[:page_size], str(start + page_size)
+        return records, None
+
+
+# SQLite schema. Posts are listed in rowid order, which is their creation
+# order, and comments through an index on their post and id, so every page is
+# a range scan. Every like lookup is a primary key lookup.
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    user_name TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    email TEXT,
+    date_created REAL NOT NULL,
+    posts_made INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS posts (
+    post_id TEXT PRIMARY KEY,
+    author TEXT NOT NULL REFERENCES users (user_name),
+    post_number INTEGER NOT NULL,
+    subject TEXT NOT NULL,
+    content TEXT NOT NULL,
+    excerpt TEXT NOT NULL,
+    content_length INTEGER NOT NULL,
+    date_created REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS comments (
+    comment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id TEXT NOT NULL REFERENCES posts (post_id) ON DELETE CASCADE,
+    author TEXT NOT NULL,
+    content TEXT NOT NULL,
+    date_created REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS comments_by_post
+    ON comments (post_id, comment_id);
+CREATE TABLE IF NOT EXISTS likes (
+    post_id TEXT NOT NULL REFERENCES posts (post_id) ON DELETE CASCADE,
+    user_name TEXT NOT NULL,
+    date_created REAL NOT NULL,
+    PRIMARY KEY (post_id, user_name));
+'''
+
+# SQLite statements. The sqlite3 module prepares each distinct statement once
+# per connection and reuses it from its statement cache.
+SQL_INSERT_USER = ("INSERT OR IGNORE INTO users (user_name, password, email, "
+                   "date_created) VALUES (?, ?, ?, ?)")
+SQL_GET_USER = ("SELECT user_name, password, email, date_created, posts_made "
+                "FROM users WHERE user_name = ?")
+SQL_UPDATE_PASSWORD = "UPDATE users SET password = ? WHERE user_name = ?"
+SQL_INCR_POSTS_MADE = ("UPDATE users SET posts_made = posts_made + 1 "
+                       "WHERE user_name = ?")
+SQL_GET_POSTS_MADE = "SELECT posts_made FROM users WHERE user_name = ?"
+POST_COLUMNS = ("post_id, author, post_number, subject, content, excerpt, "
+                "content_length, date_created")
+# The summary columns leave out the content, in the same row layout
+SUMMARY_COLUMNS = ("post_id, author, post_number, subject, NULL, excerpt, "
+                   "content_length, date_created")
+SQL_INSERT_POST = ("INSERT INTO posts (" + POST_COLUMNS + ") "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+SQL_GET_POST = "SELECT " + POST_COLUMNS + " FROM posts WHERE post_id = ?"
+SQL_UPDATE_POST = ("UPDATE posts SET subject = ?, content = ?, excerpt = ?, "
+                   "content_length = ? WHERE post_id = ?")
+SQL_DELETE_POST = "DELETE FROM posts WHERE post_id = ?"
+SQL_RECENT_POSTS_PAGE = ("SELECT " + SUMMARY_COLUMNS + ", rowid FROM posts "
+                         "WHERE rowid < ? ORDER BY rowid DESC LIMIT ?")
+COMMENT_COLUMNS = "comment_id, post_id, author, content, date_created"
+SQL_INSERT_COMMENT = ("INSERT INTO comments (post_id, author, content, "
+                      "date_created) VALUES (?, ?, ?, ?)")
+SQL_GET_COMMENT = ("SELECT " + COMMENT_COLUMNS + " FROM comments "
+                   "WHERE comment_id = ?")
+SQL_UPDATE_COMMENT = "UPDATE comments SET content = ? WHERE comment_id = ?"
+SQL_POST_COMMENTS = ("SELECT " + COMMENT_COLUMNS + " FROM comments "
+                     "WHERE post_id = ? ORDER BY comment_id DESC")
+SQL_POST_COMMENTS_PAGE = ("SELECT " + COMMENT_COLUMNS + " FROM comments "
+                          "WHERE post_id = ? AND comment_id < ? "
+                          "ORDER BY comment_id DESC LIMIT ?")
+SQL_COUNT_COMMENTS = "SELECT COUNT(*) FROM comments WHERE post_id = ?"
+SQL_DELETE_COMMENT = "DELETE FROM comments WHERE comment_id = ?"
+SQL_INSERT_LIKE = ("INSERT OR IGNORE INTO likes (post_id, user_name, "
+                   "date_created) VALUES (?, ?, ?)")
+SQL_DELETE_LIKE = "DELETE FROM likes WHERE post_id = ? AND user_name = ?"
+SQL_HAS_LIKED = "SELECT 1 FROM likes WHERE post_id = ? AND user_name = ?"
+SQL_COUNT_LIKES = "SELECT COUNT(*) FROM likes WHERE post_id = ?"
+# Formatted with one placeholder per post id
+SQL_LIKED_BY_USER = ("SELECT post_id FROM likes "
+                     "WHERE user_name = ? AND post_id IN (%s)")
+
+
+class SqliteStorage(Storage):
+    '''Storage in a SQLite database. A database file is opened in WAL mode
+    with one connection per thread, so readers never block the writer. An
+    in-memory database has a single connection shared by all threads.
+    Cursors are the rowid of the last post or the id of the last comment of a
+    page.
+    Attributes:
+        path: the path of the database file, or SQLITE_MEMORY
+        _local: thread local holding each thread's connection
+        _shared: the connection of an in-memory database, else None
+        _lock: lock serializing use of the shared connection
+    '''
+
+    def __init__(self, path=SQLITE_MEMORY, on_change=None):
+        super(SqliteStorage, self).__init__(on_change)
+        self.path = path
+        self._local = threading.local()
+        self._shared = None
+        self._lock = threading.RLock()
+        if path == SQLITE_MEMORY:
+            self._shared = self._connect()
+        with self._transaction() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+
+    def create_user(self, user_name, password, email=None):
+        with self._transaction() as conn:
+            inserted = conn.execute(SQL_INSERT_USER, (user_name, password,
+                                                      email, time.time()))
+        if not inserted.rowcount:
+            raise DuplicateUserError(user_name)
+        return user_name
+
+    def get_user(self, user_name):
+        with self._transaction() as conn:
+            row = conn.execute(SQL_GET_USER, (user_name,)).fetchone()
+        if row is None:
+            return None
+        return UserRecord(row[0], row[1], row[2], _from_timestamp(row[3]),
+                          row[4])
+
+    def update_password(self, user_name, password):
+        with self._transaction() as conn:
+            conn.execute(SQL_UPDATE_PASSWORD, (password, user_name))
+
+    def create_post(self, user_name, form_data):
+        with self._transaction() as conn:
+            conn.execute(SQL_INCR_POSTS_MADE, (user_name,))
+            row = conn.execute(SQL_GET_POSTS_MADE, (user_name,)).fetchone()
+            if row is None:
+                raise KeyError(user_name)
+            post_number = row[0]
+            post = _new_post_record(_post_id(user_name, post_number),
+                                    user_name, post_number, form_data,
+                                    time.time())
+            conn.execute(SQL_INSERT_POST, post)
+        self._changed(bc.HOME_CONTENT_ID)
+        return post.post_id
+
+    def get_post(self, post_id):
+        with self._transaction() as conn:
+            row = conn.execute(SQL_GET_POST, (post_id,)).fetchone()
+        return self._post_record(row) if row is not None else None
+
+    def update_post(self, post_id, form_data):
+        content = form_data[bc.CONTENT]
+        with self._transaction() as conn:
+            conn.execute(SQL_UPDATE_POST, (form_data[bc.SUBJECT], content,
+                                           content[:EXCERPT_LENGTH],
+                                           len(content), post_id))
+            row = conn.execute(SQL_GET_POST, (post_id,)).fetchone()
+        self._changed(post_id, bc.HOME_CONTENT_ID)
+        return self._post_record(row)
+
+    def delete_post(self, post_id):
+        with self._transaction() as conn:
+            conn.execute(SQL_DELETE_POST, (post_id,))
+        self._changed(post_id, bc.HOME_CONTENT_ID)
+
+    def recent_posts_page(self, cursor=None, page_size=RECENT_POSTS):
+        before = _cursor_position(cursor, SQLITE_MAX_ROWID)
+        with self._transaction() as conn:
+            rows = conn.execute(SQL_RECENT_POSTS_PAGE,
+                                (before, page_size + 1)).fetchall()
+        next_cursor = None
+        if len(rows) > page_size:
+            next_cursor = str(rows[page_size - 1][8])
+        return ([self._post_record(row) for row in rows[:page_size]],
+                next_cursor)
+
+    def create_comment(self, user_name, post_id, form_data):
+        with self._transaction() as conn:
+            inserted = conn.execute(SQL_INSERT_COMMENT,
+                                    (post_id, user_name,
+                                     form_data[bc.CONTENT], time.time()))
+        self._changed(post_id)
+        return str(inserted.lastrowid)
+
+    def get_comment(self, comment_id):
+        if not comment_id or not comment_id.isdigit():
+            return None
+        with self._transaction() as conn:
+            row = conn.execute(SQL_GET_COMMENT,
+                               (int(comment_id),)).fetchone()
+        return self._comment_record(row) if row is not None else None
+
+    def update_comment(self, comment_id, form_data):
+        with self._transaction() as conn:
+            conn.execute(SQL_UPDATE_COMMENT, (form_data[bc.CONTENT],
+                                              int(comment_id)))
+            row = conn.execute(SQL_GET_COMMENT,
+                               (int(comment_id),)).fetchone()
+        comment = self._comment_record(row)
+        self._changed(comment.post_id)
+        return comment
+
+    def delete_comment(self, comment_id):
+        with self._transaction() as conn:
+            row = conn.execute(SQL_GET_COMMENT,
+                               (int(comment_id),)).fetchone()
+            conn.execute(SQL_DELETE_COMMENT, (int(comment_id),))
+        if row is not None:
+            self._changed(row[1])
+
+    def get_all_comments(self, post_id):
+        with self._transaction() as conn:
+            rows = conn.execute(SQL_POST_COMMENTS, (post_id,)).fetchall()
+        return [self._comment_record(row) for row in rows]
+
+    def get_comments_page(self, post_id, cursor=None,
+                          page_size=COMMENT_PAGE_SIZE):
+        before = _cursor_position(cursor, SQLITE_MAX_ROWID)
+        with self._transaction() as conn:
+            rows = conn.execute(SQL_POST_COMMENTS_PAGE,
+                                (post_id, before, page_size + 1)).fetchall()
+        next_cursor = None
+        if len(rows) > page_size:
+            next_cursor = str(rows[page_size - 1][0])
+        return ([self._comment_record(row) for row in rows[:page_size]],
+                next_cursor)
+
+    def count_comments(self, post_id):
+        with self._transaction() as conn:
+            return conn.execute(SQL_COUNT_COMMENTS, (post_id,)).fetchone()[0]
+
+    def add_like_unlike(self, post_id, user_name, like_status):
+        with self._transaction() as conn:
+            if like_status == "Like":
+                changed = conn.execute(SQL_INSERT_LIKE, (post_id, user_name,
+                                                         time.time()))
+            else:
+                changed = conn.execute(SQL_DELETE_LIKE, (post_id, user_name))
+        if changed.rowcount > 0:
+            self._changed(post_id)
+            return True
+        return False
+
+    def has_liked(self, post_id, user_name):
+        with self._transaction() as conn:
+            return conn.execute(SQL_HAS_LIKED,
+                                (post_id, user_name)).fetchone() is not None
+
+    def count_likes(self, post_id):
+        with self._transaction() as conn:
+            return conn.execute(SQL_COUNT_LIKES, (post_id,)).fetchone()[0]
+
+    def liked_by_user(self, post_ids, user_name):
+        if not user_name or not post_ids:
+            return set()
+        with self._transaction() as conn:
+            rows = conn.execute(SQL_LIKED_BY_USER % _placeholders(post_ids),
+                                [user_name] + list(post_ids)).fetchall()
+        return set(row[0] for row in rows)
+
+    def close(self):
+        '''Closes the calling thread's connection, or the shared connection.
+        '''
+        conn = self._shared or getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+        self._shared = None
+        self._local.conn = None
+
+    def _connect(self):
+        '''Opens and configures a new connection to the database.
+        '''
+        conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT_SECS,
+                               check_same_thread=self.path != SQLITE_MEMORY,
+                               cached_statements=SQLITE_STATEMENT_CACHE)
+        conn.execute("PRAGMA foreign_keys = ON")
+        if self.path != SQLITE_MEMORY:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        '''Context manager running its block in a transaction on the calling
+        thread's connection. The transaction commits if the block completes
+        and rolls back if it raises.
+        @return: the connection
+        '''
+        if self._shared is not None:
+            with self._lock, self._shared:
+                yield self._shared
+            return
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        with conn:
+            yield conn
+
+    def _post_record(self, row):
+        '''Returns the PostRecord of a row starting with POST_COLUMNS or
+        SUMMARY_COLUMNS.
+        '''
+        return PostRecord(*(row[:7] + (_from_timestamp(row[7]),)))
+
+    def _comment_record(self, row):
+        '''Returns the CommentRecord of a row of COMMENT_COLUMNS.
+        '''
+        return CommentRecord(str(row[0]), row[1], row[2], row[3],
+                             _from_timestamp(row[4]))
+
+
+def _placeholders(values):
+    '''Returns the comma-separated SQL placeholders of a list of values.
+    '''
+    return ", ".join(["?"] * len(values))
+
+
+def _from_timestamp(timestamp):
+    '''Returns the UTC datetime of a unix timestamp.
+    '''
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+
+# Backends, by name
+BACKENDS = {"ndb": NdbStorage,
+            "memory": MemoryStorage,
+            "sqlite": SqliteStorage}
+
+
+def get_storage(name, *args, **kwargs):
+    '''Returns a new storage backend.
+    @param name: the name of the backend, a key of BACKENDS
+    @param args, kwargs: passed to the backend's constructor, e.g. the path
+    of a SQLite database
+    @raise KeyError: if there is no backend of that name
+    '''
+    return BACKENDS[name](*args, **kwargs)
+
+
+_app_storage = None
+_app_storage_lock = threading.Lock()
+
+
+def app_storage():
+    '''Returns the backend the application's handlers use, creating the one
+    configured in blog_config on first use.
+    '''
+    global _app_storage
+    if _app_storage is None:
+        with _app_storage_lock:
+            if _app_storage is None:
+                _app_storage = get_storage(blog_config.STORAGE_BACKEND,
+                                           on_change=_bump_versions,
+                                           **blog_config.STORAGE_OPTIONS)
+    return _app_storage
+
+
+def set_app_backend(name, **options):
+    '''Replaces the backend the application's handlers use, e.g. to self-host
+    on SQLite or to test the handlers against memory.
+    @param name: the name of the backend, a key of BACKENDS
+    @param options: keyword arguments of the backend's constructor
+    @return: the new backend
+    '''
+    global _app_storage
+    with _app_storage_lock:
+        _app_storage = get_storage(name, on_change=_bump_versions, **options)
+    return _app_storage
+
+
+def _bump_versions(content_ids):
+    '''Bumps the version stamps of the content changed by a write, so cached
+    fragments and pages of it are no longer served.
+    '''
+    # Imported here so the backends load without the SDK.
+    from fragment_cache import ContentVersion
+    ContentVersion.bump_multi(content_ids)
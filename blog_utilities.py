@@ -1,6 +1,6 @@
 '''
-Library of classes that supports password and cookie hashing and secure
-setting and retrieval of cookies.
+Library of classes that supports password and cookie hashing, secure
+setting and retrieval of cookies, and in-process caching.
 
 Created on Jan 14, 2017
 @author: kennethalamantia
@@ -10,21 +10,132 @@ import hashlib
 import hmac
 import random
 import string
+import threading
+import time
+from collections import OrderedDict
+from google.appengine.api import memcache
 import secure_key
 
 # secure key used in hashing
 KEY = secure_key.KEY
 
+# Session cookie constants
+SESSION_MAX_AGE = 14 * 24 * 60 * 60
+REVOKED_CACHE_PREFIX = "revoked:"
+VERIFIED_TOKEN_ENTRIES = 10000
+
+# Password hashing constants, see bench_login.py for choosing PWD_ITERATIONS
+PWD_KDF = "pbkdf2_sha256"
+PWD_FORMAT = "{kdf}${iterations}${salt}${hash}"
+PWD_ITERATIONS = 50000
+SALT_LEN = 16
+MAX_CONCURRENT_HASHES = 4
+# Seconds a request waits for a hashing slot before giving up
+HASH_WAIT_SECS = 2.0
+
+
+class LRUCache(object):
+    '''Thread-safe, in-process cache that evicts the least recently used
+    entries once it holds more than a maximum number of entries or a maximum
+    total size of values.
+    Attributes:
+        _max_entries: the maximum number of entries held
+        _max_size: the maximum total size of the values held, or None
+        _size_fun: function returning the size of a value
+        _entries: OrderedDict of values, least recently used first
+        _size: the current total size of the values held
+        _lock: lock guarding the other attributes
+    '''
+
+    def __init__(self, max_entries, max_size=None, size_fun=len):
+        '''
+        @param max_entries: the maximum number of entries held
+        @param max_size: the maximum total size of the values held, or None
+        for no limit on size
+        @param size_fun: function returning the size of a value, len by
+        default
+        '''
+        self._max_entries = max_entries
+        self._max_size = max_size
+        self._size_fun = size_fun
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''Returns the value held for a key and marks it as recently used.
+        @param key: the key to look up
+        @param default: returned if the key is not held
+        '''
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        '''Holds a value for a key, evicting least recently used entries as
+        needed. A value larger than the maximum size is not held.
+        @param key: the key to hold the value for
+        @param value: the value to hold
+        '''
+        value_size = self._size_fun(value)
+        with self._lock:
+            self._remove(key)
+            if self._max_size is not None and value_size > self._max_size:
+                return
+            self._entries[key] = value
+            self._size += value_size
+            while (len(self._entries) > self._max_entries or
+                   (self._max_size is not None and
+                    self._size > self._max_size)):
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        '''Stops holding the value for a key, if any.
+        '''
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        '''Stops holding every value.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        '''Removes an entry, if held. The caller must hold the lock.
+        '''
+        if key in self._entries:
+            self._size -= self._size_fun(self._entries.pop(key))
+
 
 class CookieUtil(object):
     '''Class providing a number of methods to set, get, and hash cookies.
-    Cookies are a string in the format "name=value|hash" where name is the
-    unique name of the cookie, value is the plain-text value of the cookie,
-    and hash is the hashed version of the value. The hash and the value are
-    always separated by the "|" character. Use of the word "cookie" throughout
-    this class assumes this format is observed.
+    Cookies are a string in the format "name=value|issued_at|hash" where name
+    is the unique name of the cookie, value is the plain-text value of the
+    cookie, issued_at is the int time the cookie was set, in seconds since
+    the epoch, and hash is the HMAC of "value|issued_at". The parts are
+    always separated by the "|" character. Use of the word "cookie" or
+    "token" throughout this class assumes this format is observed.
+
+    Cookies expire SESSION_MAX_AGE seconds after they are issued, and are
+    revoked on logout. Every request checks the token's revocation marker in
+    memcache, so a token revoked on one instance is rejected by all of them
+    at once. Verified tokens are held in an in-process LRU, so a repeat
+    visitor's token skips the HMAC.
+    Attributes:
+        _verified: LRUCache of (value, issued_at) tuples keyed by verified
+                   token
     '''
 
+    _verified = LRUCache(VERIFIED_TOKEN_ENTRIES)
+
     @classmethod
     def set_cookie(cls, cookie_name, cookie_value, handler):
         '''Sets a secured cookie, giving it a name and value in the header
@@ -41,22 +152,91 @@ class CookieUtil(object):
         '''Validates and retrieves the value of a cookie, if valid.
         @param cookie_name: the name of the cookie to retrieve from the handler
         @param handler: the webapp2 request handler holding the cookie
-        @return: str value of the cookie or None if cookie was invalid
+        @return: str value of the cookie or None if cookie was invalid,
+        expired or revoked
         '''
         cookie = handler.request.cookies.get(cookie_name)
-        if (cookie and not cls._is_empty(cookie)
-                and cls._validate_cookie(cookie)):
-            return cls._get_value(cookie)
+        if cookie:
+            return cls._verify_token(cookie.encode("utf-8"))
         else:
             return None
 
     @classmethod
-    def _is_empty(cls, cookie):
-        '''Returns a boolean value indicating whether the cookie value is an
-        empty string.
-        @param cookie: cookie in the format described in this class' docstring
+    def revoke_cookie(cls, cookie_name, handler):
+        '''Revokes the token held by a cookie on every instance and clears the
+        cookie.
+        @param cookie_name: the name of the cookie to revoke
+        @param handler: the webapp2 request handler holding the cookie
+        '''
+        cookie = handler.request.cookies.get(cookie_name)
+        token = cookie.encode("utf-8") if cookie else ""
+        parsed = cls._parse_token(token)
+        if parsed is not None:
+            dummy_value, issued_at, token_hash = parsed
+            remaining = issued_at + SESSION_MAX_AGE - int(cls._now())
+            if remaining > 0:
+                memcache.set(REVOKED_CACHE_PREFIX + token_hash, True,
+                             remaining)
+            cls._verified.delete(token)
+        cls.set_cookie(cookie_name, "", handler)
+
+    @classmethod
+    def clear_local(cls):
+        '''Empties this instance's LRU of verified tokens.
         '''
-        return len(cls._get_value(cookie)) < 1
+        cls._verified.clear()
+
+    @classmethod
+    def _verify_token(cls, token):
+        '''Returns the value of a token if it is authentic, unexpired and not
+        revoked. Tokens verified before skip the HMAC, but never the
+        revocation check.
+        @param token: str token in the format described in this class'
+        docstring
+        @return: str value of the token or None
+        '''
+        now = cls._now()
+        cached = cls._verified.get(token)
+        if cached is not None:
+            value, issued_at = cached
+            if now - issued_at > SESSION_MAX_AGE:
+                cls._verified.delete(token)
+                return None
+        else:
+            parsed = cls._parse_token(token)
+            if parsed is None:
+                return None
+            value, issued_at, token_hash = parsed
+            if (not value or now - issued_at > SESSION_MAX_AGE or
+                    not _compare_digest(cls._hash(value + "|" +
+                                                  str(issued_at)),
+                                        token_hash)):
+                return None
+        if cls._is_revoked(token):
+            cls._verified.delete(token)
+            return None
+        if cached is None:
+            cls._verified.set(token, (value, issued_at))
+        return value
+
+    @classmethod
+    def _is_revoked(cls, token):
+        '''Has a token been revoked on any instance?
+        '''
+        return memcache.get(REVOKED_CACHE_PREFIX +
+                            token[token.rindex("|") + 1:]) is not None
+
+    @classmethod
+    def _parse_token(cls, token):
+        '''Splits a token into its parts.
+        @param token: str token, possibly malformed
+        @return: tuple of the str value, int issued_at and str hash, or None
+        if the token is malformed
+        '''
+        parts = token.split("|")
+        if len(parts) != 3 or not parts[1].isdigit():
+            return None
+        return parts[0], int(parts[1]), parts[2]
 
     @classmethod
     def _hash(cls, str_to_hash):
@@ -69,92 +249,159 @@ class CookieUtil(object):
 
     @classmethod
     def _value_and_hash(cls, value):
-        '''Hashes and formats the cookie value.
+        '''Stamps the cookie value with the current time and hashes it.
         @param value: the unhashed cookie value to hash
-        @return: a string in the format "value|hash"
+        @return: a string in the format "value|issued_at|hash"
         '''
-        hashed_value = cls._hash(value)
-        return_template = "{value}|{hash}"
-        return return_template.format(value=value, hash=hashed_value)
-
-    @classmethod
-    def _validate_cookie(cls, value_w_hash):
-        '''Checks the hash of a pre-existing cookie.
-        @param value_w_hash: cookie value with unknown hash
-        @return: boolean true if hash valid, false otherwise
-        '''
-        value_w_hash = value_w_hash.encode("utf-8")
-        value = cls._get_value(value_w_hash)
-        known_hash = value_w_hash[value_w_hash.index("|") + 1:]
-        return cls._hash(value) == known_hash
+        stamped_value = "{value}|{issued_at}".format(
+            value=value, issued_at=int(cls._now()))
+        return "{stamped}|{hash}".format(stamped=stamped_value,
+                                         hash=cls._hash(stamped_value))
 
     @classmethod
     def _format_cookie(cls, name, value):
         '''Returns a formatted cookie.
         @param name: the name of the cookie
-        @param value: value|hash pair str or "" if the cookie is being cleared
+        @param value: the cookie value or "" if the cookie is being cleared
         @return: cookie
         '''
-        cookie_template = "{name}={value}; Path=/"
+        cookie_template = "{name}={value}; Path=/; Max-Age={max_age}"
         if value == "":
             new_value = value
+            max_age = 0
         else:
             new_value = cls._value_and_hash(value)
-        return cookie_template.format(name=name, value=new_value)
+            max_age = SESSION_MAX_AGE
+        return cookie_template.format(name=name, value=new_value,
+                                      max_age=max_age)
 
     @classmethod
-    def _get_value(cls, value_w_hash):
-        '''Retrieve the part of the value preceding the "|"char.
+    def _now(cls):
+        '''Returns the current time in seconds since the epoch.
         '''
-        slice_idx = value_w_hash.index("|")
-        return value_w_hash[:slice_idx]
+        return time.time()
+
+
+def _compare_digest(a, b):
+    '''Compares two str digests in time independent of where they differ.
+    Uses hmac.compare_digest where the runtime has it.
+    '''
+    if hasattr(hmac, "compare_digest"):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class HashingBusyError(Exception):
+    '''Raised when no password hashing slot frees up within HASH_WAIT_SECS.
+    Handlers answer it with a 503, asking the client to try again.
+    '''
+
+
+class HashSlots(object):
+    '''Class limiting the number of concurrent password hashes, with a
+    bounded wait for a free slot.
+    Attributes:
+        _free: the number of free slots
+        _condition: threading.Condition guarding _free
+    '''
+
+    def __init__(self, num_slots):
+        self._free = num_slots
+        self._condition = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout):
+        '''Takes a slot, waiting at most timeout seconds for one to free up.
+        @param timeout: the float number of seconds to wait
+        @raise HashingBusyError: if no slot freed up in time
+        '''
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._free == 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise HashingBusyError("No password hashing slot free")
+                self._condition.wait(remaining)
+            self._free -= 1
+
+    def release(self):
+        '''Frees a slot taken with acquire.
+        '''
+        with self._condition:
+            self._free += 1
+            self._condition.notify()
 
 
 class PwdUtil(object):
     '''Class to create salted, hashed passwords for storing in database and for
     checking whether an input password matches an already created password.
+    Passwords are hashed with PBKDF2-HMAC-SHA256 and stored in the format
+    "pbkdf2_sha256$iterations$salt$hash", so the cost of each hash is stored
+    with it. Passwords stored by earlier versions in the legacy format
+    "hash,salt", a single salted SHA-256, can still be verified, and should be
+    rehashed, see needs_rehash.
+
+    At most MAX_CONCURRENT_HASHES hashes are computed at once per instance.
+    A request waits at most HASH_WAIT_SECS for a hashing slot, then fails
+    with HashingBusyError, so a burst of logins queues on a few request
+    threads for a bounded time instead of piling up on all of them.
     Attributes:
         _new_salt: randomly generated salt used to hash new passwords
         _existing_password: hashed password that comes from database
         _existing_salt: password salt that comes from the database
+        _iterations: the PBKDF2 iteration count of the password being hashed,
+                     or None for a legacy password
         _hashed_text: the newly hashed password
     '''
 
-    def __init__(self, clear_text, db_password=None):
+    _hash_slots = HashSlots(MAX_CONCURRENT_HASHES)
+
+    def __init__(self, clear_text, db_password=None,
+                 iterations=PWD_ITERATIONS):
         '''Hashes a new password from clear text or compares a password to
         the password and salt stored in the database.
         @param clear_text: the password in clear text
         @param db_password: the hashed password and salt from the database,
         pass this parameter if checking the validity of a preexisting password.
+        @param iterations: the PBKDF2 iteration count used to hash a new
+        password
+        @raise HashingBusyError: if no hashing slot freed up in time
         '''
         self._new_salt = None
         self._existing_password = None
         self._existing_salt = None
+        self._iterations = iterations
         if db_password:
             self._extract_pwd_salt(db_password)
-        self._hashed_text = self._hash_salt(clear_text)
+        self._hashed_text = self._hash_salt(clear_text.encode("utf-8"))
 
     def _hash_salt(self, clear_text):
         '''Returns a salted and hashed password, either based on a new
         randomly generated salt or an existing one. Updates the _new_salt
         class field if necessary.
-        @param clear_text: the text to be hashed
+        @param clear_text: the utf-8 encoded text to be hashed
         @return: a hashed and salted password
         '''
-        hashed_output = None
         if self._existing_password:
-            hashed_output = "".join(hashlib.sha256(
-                clear_text + self._existing_salt).hexdigest())
+            salt = self._existing_salt
         else:
             generator = random.SystemRandom()
-            SALT_LEN = 5
             possible_chars = string.letters + string.digits
-            new_salt = "".join(generator.choice(possible_chars)
-                               for dummy_idx in range(SALT_LEN))
-            hashed_output = "".join(hashlib.sha256(
-                clear_text + new_salt).hexdigest())
-            self._new_salt = new_salt
-        return hashed_output
+            salt = "".join(generator.choice(possible_chars)
+                           for dummy_idx in range(SALT_LEN))
+            self._new_salt = salt
+        if self._iterations is None:
+            return hashlib.sha256(clear_text + salt).hexdigest()
+        self._hash_slots.acquire(HASH_WAIT_SECS)
+        try:
+            return hashlib.pbkdf2_hmac("sha256", clear_text, salt,
+                                       self._iterations).encode("hex")
+        finally:
+            self._hash_slots.release()
 
     def verify_password(self):
         '''Compares existing password with the unknown password input into the
@@ -162,22 +409,39 @@ class PwdUtil(object):
         no db_password was passed to the constructor, None will be returned.
         '''
         if self._existing_password:
-            return self._existing_password == self._hashed_text
+            return _compare_digest(self._existing_password, self._hashed_text)
         else:
             return None
 
+    def needs_rehash(self):
+        '''Returns True if the existing password is in the legacy format or
+        was hashed with fewer iterations than PWD_ITERATIONS. Only meaningful
+        once verify_password has returned True.
+        '''
+        return self._iterations is None or self._iterations < PWD_ITERATIONS
+
     def new_pwd_salt_pair(self):
-        '''Returns the hashed password/salt combination
+        '''Returns the hashed password, salt and iteration count
         for storing in the database.
         '''
         if self._new_salt:
-            return self._hashed_text + "," + self._new_salt
+            return PWD_FORMAT.format(kdf=PWD_KDF, iterations=self._iterations,
+                                     salt=self._new_salt,
+                                     hash=self._hashed_text)
 
-    def _extract_pwd_salt(self, pwd_and_salt):
-        '''Splits the "password,salt" string at the ",". Stores each part
-        in the respective class fields.
-        @param pwd_and_salt: string in the form "password,salt"
+    def _extract_pwd_salt(self, db_password):
+        '''Splits a stored password into its parts. Stores each part in the
+        respective class fields.
+        @param db_password: string in the form
+        "pbkdf2_sha256$iterations$salt$hash" or the legacy "password,salt"
         '''
-        slice_idx = pwd_and_salt.rfind(",")
-        self._existing_salt = pwd_and_salt[slice_idx + 1:]
-        self._existing_password = pwd_and_salt[:slice_idx]
+        if db_password.startswith(PWD_KDF + "$"):
+            dummy_kdf, iterations, salt, password = db_password.split("$")
+            self._iterations = int(iterations)
+            self._existing_salt = str(salt)
+            self._existing_password = str(password)
+        else:
+            slice_idx = db_password.rfind(",")
+            self._iterations = None
+            self._existing_salt = str(db_password[slice_idx + 1:])
+            self._existing_password = str(db_password[:slice_idx])
@@ -0,0 +1,43 @@
+'''
+Build step that precompiles every template under templates/ into importable
+python modules in compiled_templates/. Run it before deploying:
+
+    python compile_templates.py
+
+When compiled_templates/ exists, the app in production loads templates from
+it and never parses template source at run time. Templates missing from it,
+e.g. ones added after the last build, are still loaded from templates/.
+Outside of production the app ignores compiled_templates/, so template edits
+show up without a rebuild.
+
+Created on Jul 12, 2017
+@author: kennethalamantia
+'''
+
+import os
+import shutil
+import sys
+import jinja2
+import blog_config
+
+
+def compile_all(target=blog_config.COMPILED_TEMPLATE_DIR):
+    '''Compiles all templates into a fresh target directory.
+    @param target: path of the directory to write compiled templates to
+    @return: list of the names of the compiled templates
+    '''
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(blog_config.TEMPLATE_DIR),
+        **blog_config.TEMPLATE_OPTIONS)
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    names = env.list_templates()
+    env.compile_templates(target, zip=None, ignore_errors=False)
+    return names
+
+
+if __name__ == "__main__":
+    target_dir = (sys.argv[1] if len(sys.argv) > 1 else
+                  blog_config.COMPILED_TEMPLATE_DIR)
+    compiled = compile_all(target_dir)
+    print "Compiled %d templates into %s" % (len(compiled), target_dir)
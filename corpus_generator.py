@@ -0,0 +1,223 @@
+'''
+Generates a synthetic corpus of users, posts, comments and likes for
+benchmarks. The corpus is deterministic: the same size and seed always give
+the same data, so every benchmark can start from the same corpus.
+
+Post lengths follow a log-normal distribution. Authors, comments and likes go
+to posts and users by Zipf distributions, so a few hot posts draw most of
+the comments and likes, as on a real blog. Everything is written through a
+blog_storage backend:
+
+    python corpus_generator.py [--size medium] [--seed 1]
+                               [--backend sqlite] [--path corpus.sqlite3]
+
+With --backend ndb, the corpus is written into the datastore and memcache
+of serve.py, e.g. for load tests over HTTP.
+
+Every user's password is CORPUS_PASSWORD, hashed once, so load tests can
+log in as any user.
+
+Created on Jul 23, 2017
+@author: kennethalamantia
+'''
+
+import argparse
+import bisect
+import math
+import random
+import sys
+import timeit
+from collections import namedtuple
+import blog_constants as bc
+import blog_storage
+from form_schema import SUBJECT_MAX_LEN, CONTENT_MAX_LEN
+
+# Corpus constants
+DEFAULT_SEED = 1
+CORPUS_PASSWORD = "corpus_pwd"
+USER_NAME_FORMAT = "user%05d"
+ZIPF_EXPONENT = 1.1
+# Post content lengths in chars, log-normal around the median
+CONTENT_MEDIAN_LEN = 1500
+CONTENT_SIGMA = 0.8
+SUBJECT_MIN_WORDS = 2
+SUBJECT_MAX_WORDS = 10
+COMMENT_MEDIAN_LEN = 200
+COMMENT_SIGMA = 0.7
+PARAGRAPH_WORDS = 80
+VOCABULARY = ("the of and to in is that for it as was with be by on not he "
+              "this are or his from at which but have an they you were her "
+              "she there been one all we their has would when if so no "
+              "blog post engine datastore cache latency request server "
+              "python template query index shard counter memcache cursor "
+              "page comment like user feed render stream profile benchmark "
+              "deploy throughput worker thread process socket network disk "
+              "quickly slowly carefully simple complex large small hot cold "
+              "read write update delete create fetch store batch async"
+              ).split()
+
+CorpusSpec = namedtuple("CorpusSpec", ["users", "posts", "comments", "likes",
+                                       "hot_posts"])
+Corpus = namedtuple("Corpus", ["spec", "seed", "user_names", "post_ids",
+                               "hot_post_ids", "comment_ids", "num_likes"])
+
+# Standard corpus sizes shared by the benchmarks
+SIZES = {"tiny": CorpusSpec(users=5, posts=20, comments=50, likes=50,
+                            hot_posts=2),
+         "small": CorpusSpec(users=20, posts=100, comments=500, likes=1000,
+                             hot_posts=5),
+         "medium": CorpusSpec(users=200, posts=2000, comments=10000,
+                              likes=20000, hot_posts=10),
+         "large": CorpusSpec(users=2000, posts=20000, comments=100000,
+                             likes=200000, hot_posts=20)}
+
+
+class ZipfSampler(object):
+    '''Draws ranks 0 to n - 1, rank r with probability proportional to
+    1 / (r + 1) ** exponent.
+    Attributes:
+        _rng: the random.Random drawing the samples
+        _cumulative: list of the cumulative weights of the ranks
+    '''
+
+    def __init__(self, n, rng, exponent=ZIPF_EXPONENT):
+        self._rng = rng
+        self._cumulative = []
+        total = 0.0
+        for rank in range(n):
+            total += 1.0 / (rank + 1) ** exponent
+            self._cumulative.append(total)
+
+    def sample(self):
+        '''Returns a random rank.
+        '''
+        point = self._rng.random() * self._cumulative[-1]
+        return min(bisect.bisect_left(self._cumulative, point),
+                   len(self._cumulative) - 1)
+
+
+def _text(rng, length, paragraph_words=PARAGRAPH_WORDS):
+    '''Returns roughly length chars of words from VOCABULARY, split into
+    paragraphs.
+    '''
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(VOCABULARY)
+        if words and len(words) % paragraph_words == 0:
+            word = "\n\n" + word
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:length].strip() or rng.choice(VOCABULARY)
+
+
+def _log_normal_len(rng, median, sigma, max_len):
+    '''Returns a log-normally distributed length between 1 and max_len.
+    '''
+    return max(1, min(max_len, int(rng.lognormvariate(math.log(median),
+                                                      sigma))))
+
+
+def _password_hash():
+    '''Returns the stored form of CORPUS_PASSWORD.
+    '''
+    # Imported here since blog_utilities needs the App Engine SDK, which the
+    # rest of the generator does not.
+    from blog_utilities import PwdUtil
+    return PwdUtil(CORPUS_PASSWORD).new_pwd_salt_pair()
+
+
+def build_corpus(storage, spec, seed=DEFAULT_SEED, password_hash=None):
+    '''Writes a corpus into a storage backend.
+    @param storage: the blog_storage.Storage backend to write to, normally
+    empty
+    @param spec: the CorpusSpec of the corpus, e.g. SIZES["small"]
+    @param seed: the seed of the corpus
+    @param password_hash: the stored form of CORPUS_PASSWORD, hashed with
+    PwdUtil if None
+    @return: the Corpus written. Its post ids are in creation order and its
+    hot post ids most popular first.
+    '''
+    rng = random.Random(seed)
+    if password_hash is None:
+        password_hash = _password_hash()
+    user_names = [USER_NAME_FORMAT % index for index in range(spec.users)]
+    for user_name in user_names:
+        storage.create_user(user_name, password_hash,
+                            user_name + "@example.com")
+    # Users are ranked by a seeded shuffle, the first ranks most active.
+    user_ranks = user_names[:]
+    rng.shuffle(user_ranks)
+    user_sampler = ZipfSampler(spec.users, rng)
+    post_ids = []
+    for dummy_idx in range(spec.posts):
+        subject = " ".join(rng.choice(VOCABULARY) for dummy_word in range(
+            rng.randint(SUBJECT_MIN_WORDS, SUBJECT_MAX_WORDS)))
+        content = _text(rng, _log_normal_len(rng, CONTENT_MEDIAN_LEN,
+                                             CONTENT_SIGMA, CONTENT_MAX_LEN))
+        post_ids.append(storage.create_post(
+            user_ranks[user_sampler.sample()],
+            {bc.SUBJECT: subject[:SUBJECT_MAX_LEN].strip(),
+             bc.CONTENT: content}))
+    # Posts are ranked the same way, the first ranks are the hot posts.
+    post_ranks = post_ids[:]
+    rng.shuffle(post_ranks)
+    post_sampler = ZipfSampler(spec.posts, rng)
+    comment_ids = []
+    for dummy_idx in range(spec.comments):
+        content = _text(rng, _log_normal_len(rng, COMMENT_MEDIAN_LEN,
+                                             COMMENT_SIGMA, CONTENT_MAX_LEN))
+        comment_ids.append(storage.create_comment(
+            rng.choice(user_names), post_ranks[post_sampler.sample()],
+            {bc.CONTENT: content}))
+    num_likes = 0
+    for dummy_idx in range(spec.likes):
+        if storage.add_like_unlike(post_ranks[post_sampler.sample()],
+                                   rng.choice(user_names), "Like"):
+            num_likes += 1
+    return Corpus(spec, seed, user_names, post_ids,
+                  post_ranks[:spec.hot_posts], comment_ids, num_likes)
+
+
+def main():
+    '''Generates a corpus and prints its summary.
+    @return: the int exit status
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark corpus generator")
+    parser.add_argument("--size", choices=sorted(SIZES), default="medium",
+                        help="standard corpus size")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED,
+                        help="seed of the corpus")
+    parser.add_argument("--backend", choices=["memory", "sqlite", "ndb"],
+                        default="sqlite", help="storage backend to write to")
+    parser.add_argument("--path", default="corpus.sqlite3",
+                        help="path of the SQLite database")
+    parser.add_argument("--datastore-path", default=None,
+                        help="path of serve.py's datastore, for ndb")
+    parser.add_argument("--cache-path", default=None,
+                        help="path of serve.py's shared memcache, for ndb")
+    args = parser.parse_args()
+    if args.backend == "sqlite":
+        storage = blog_storage.get_storage(args.backend, args.path)
+    elif args.backend == "ndb":
+        # Writes into the datastore and cache a serve.py server runs on.
+        import serve
+        import shared_memcache
+        serve.setup_stubs(args.datastore_path or serve.DEFAULT_DATASTORE_PATH,
+                          args.cache_path or
+                          shared_memcache.DEFAULT_CACHE_PATH)
+        storage = blog_storage.get_storage(args.backend)
+    else:
+        storage = blog_storage.get_storage(args.backend)
+    start = timeit.default_timer()
+    corpus = build_corpus(storage, SIZES[args.size], args.seed)
+    elapsed = timeit.default_timer() - start
+    print "%d users, %d posts, %d comments and %d likes written in %.1f s" % (
+        len(corpus.user_names), len(corpus.post_ids),
+        len(corpus.comment_ids), corpus.num_likes, elapsed)
+    print "Hot posts: " + ", ".join(corpus.hot_post_ids)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+'''
+Declarative validation schemas of the blog-engine's forms. Each schema lists
+the fields of one form with their length limits, patterns and error
+messages. Schemas are built and their patterns compiled once, at import.
+
+Validation checks each field's length before running any pattern, so over-
+long input never reaches a regex, and stops at the first invalid field.
+
+Created on Jul 16, 2017
+@author: kennethalamantia
+'''
+
+import re
+from blog_constants import (USER, PASSWORD, PWD_VERIFY, EMAIL, SUBJECT,
+                            CONTENT, ERROR)
+
+# Field limits
+USER_MIN_LEN = 3
+USER_MAX_LEN = 20
+PASSWORD_MIN_LEN = 3
+PASSWORD_MAX_LEN = 20
+EMAIL_MAX_LEN = 254
+SUBJECT_MAX_LEN = 100
+CONTENT_MAX_LEN = 100000
+
+
+class Field(object):
+    '''Class describing the validation rules of one form field.
+    Attributes:
+        name: the form field name, a global constant
+        error: the error message shown when the input is invalid
+        min_len: the minimum length of the input
+        max_len: the maximum length of the input
+        pattern: compiled regex the input must match, or None
+        required: if False, empty input is valid
+        same_as: name of a field the input must equal, or None
+    '''
+
+    def __init__(self, name, error, min_len=1, max_len=None, pattern=None,
+                 required=True, same_as=None):
+        self.name = name
+        self.error = error
+        self.min_len = min_len
+        self.max_len = max_len
+        self.pattern = re.compile(pattern) if pattern else None
+        self.required = required
+        self.same_as = same_as
+
+    def is_valid(self, value, get_value):
+        '''Checks input against the field's rules, cheapest first.
+        @param value: the unicode input of the field
+        @param get_value: function returning the input of another field
+        @return: boolean - is the input valid
+        '''
+        if not value and not self.required:
+            return True
+        if len(value) < self.min_len:
+            return False
+        if self.max_len is not None and len(value) > self.max_len:
+            return False
+        if self.same_as is not None and value != get_value(self.same_as):
+            return False
+        return self.pattern is None or self.pattern.match(value) is not None
+
+
+class FormSchema(object):
+    '''Class validating the input of a form against a list of fields.
+    Attributes:
+        fields: tuple of the Field instances of the form, in the order they
+                are checked
+    '''
+
+    def __init__(self, *fields):
+        self.fields = fields
+
+    def validate(self, get_value):
+        '''Validates form input, stopping at the first invalid field.
+        @param get_value: function taking a field name and returning its
+        input, e.g. a webapp2 request's get method
+        @return: tuple of a boolean, true if the input was valid, and a dict
+        of the input keyed by field name. If the input was invalid, the dict
+        holds the error message of the invalid field and its input is blank.
+        '''
+        form_data = {}
+        is_valid = True
+        for field in self.fields:
+            value = get_value(field.name)
+            if is_valid and not field.is_valid(value, get_value):
+                form_data[field.name + ERROR] = field.error
+                form_data[field.name] = ""
+                is_valid = False
+            else:
+                form_data[field.name] = value
+        return is_valid, form_data
+
+
+# Fields, by name
+FIELDS = dict((field.name, field) for field in (
+    Field(USER, "The username is invalid.", min_len=USER_MIN_LEN,
+          max_len=USER_MAX_LEN, pattern=r"^[a-zA-Z0-9_-]+\Z"),
+    Field(PASSWORD, "The password is invalid.", min_len=PASSWORD_MIN_LEN,
+          max_len=PASSWORD_MAX_LEN, pattern=r"^.+\Z"),
+    Field(PWD_VERIFY, "The passwords do not match.", same_as=PASSWORD),
+    Field(EMAIL, "Invalid email address.", max_len=EMAIL_MAX_LEN,
+          pattern=r"^\S+@\S+\.\S+\Z", required=False),
+    Field(SUBJECT, "You must have a subject of less than 100 chars in "
+          "length.", max_len=SUBJECT_MAX_LEN, pattern=r"^.+\Z"),
+    # Content may span several lines, so only its length is checked.
+    Field(CONTENT, "You must include some content.",
+          max_len=CONTENT_MAX_LEN)))
+
+# Schemas of the blog-engine's forms
+SIGNUP_FORM = FormSchema(FIELDS[USER], FIELDS[PASSWORD], FIELDS[PWD_VERIFY],
+                         FIELDS[EMAIL])
+LOGIN_FORM = FormSchema(FIELDS[USER], FIELDS[PASSWORD])
+POST_FORM = FormSchema(FIELDS[SUBJECT], FIELDS[CONTENT])
+COMMENT_FORM = FormSchema(FIELDS[CONTENT])
+NO_FORM = FormSchema()
+
+_SCHEMAS = dict((tuple(field.name for field in schema.fields), schema)
+                for schema in (SIGNUP_FORM, LOGIN_FORM, POST_FORM,
+                               COMMENT_FORM, NO_FORM))
+
+
+def schema_for(field_names):
+    '''Returns the schema validating a list of fields.
+    @param field_names: the names of the form fields, in the order they are
+    checked
+    '''
+    field_names = tuple(field_names)
+    if field_names not in _SCHEMAS:
+        _SCHEMAS[field_names] = FormSchema(*[FIELDS[name]
+                                             for name in field_names])
+    return _SCHEMAS[field_names]
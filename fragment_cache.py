@@ -0,0 +1,176 @@
+'''
+Caching of rendered HTML fragments, such as the body of a post and its
+comment thread, and of whole pages, so that pages which change rarely are not
+re-rendered on every view.
+
+Fragments are keyed by the entity they render plus a version stamp of that
+entity. Any write that changes what a fragment shows bumps the entity's
+version, so stale fragments are never looked up again and age out of the
+caches. Fragments are held in a two-level cache: an in-process LRU in front
+of memcache.
+
+Created on Jul 8, 2017
+@author: kennethalamantia
+'''
+
+import time
+from google.appengine.api import memcache
+from blog_utilities import LRUCache
+
+# Fragment cache constants
+VERSION_CACHE_PREFIX = "version:"
+FRAGMENT_CACHE_PREFIX = "fragment:"
+FRAGMENT_CACHE_SECS = 3600
+FRAGMENT_LRU_ENTRIES = 1000
+FRAGMENT_LRU_SIZE = 16 * 1024 * 1024
+FRAGMENT_MAX_SIZE = 900 * 1024
+PAGE_CACHE_PREFIX = "page:"
+PAGE_CACHE_SECS = 3600
+
+
+def _content_id(entity_key):
+    '''Returns the str identifying content in cache keys.
+    @param entity_key: the str id of a storage record or content, e.g. a post
+    id, or the NDB key of an entity
+    '''
+    if isinstance(entity_key, basestring):
+        return entity_key
+    return entity_key.urlsafe()
+
+
+class ContentVersion(object):
+    '''Class providing methods to read and bump the version stamps of
+    entities. A version stamp is the str time in microseconds of the last
+    write to the entity, held in memcache. If a stamp is evicted, a new one is
+    issued, which only costs a re-render. Entities are given by their str ids
+    or NDB keys; an NDB key and its url-safe str share one stamp.
+    '''
+
+    @classmethod
+    def get(cls, entity_key):
+        '''Returns the current version stamp of an entity.
+        @param entity_key: the str id or NDB key of the entity
+        '''
+        return cls.get_multi([entity_key])[entity_key]
+
+    @classmethod
+    def get_multi(cls, entity_keys):
+        '''Returns the current version stamps of several entities with one
+        batch memcache read, issuing new stamps for any that are missing.
+        @param entity_keys: list of str ids or NDB keys of entities
+        @return: dict of version stamps keyed by entity key
+        '''
+        cache_keys = dict((cls._cache_key(entity_key), entity_key)
+                          for entity_key in entity_keys)
+        cached = memcache.get_multi(cache_keys.keys())
+        missing = dict((cache_key, cls._new_stamp())
+                       for cache_key in cache_keys if cache_key not in cached)
+        if missing:
+            memcache.add_multi(missing)
+            cached.update(memcache.get_multi(missing.keys()))
+            for cache_key, stamp in missing.iteritems():
+                cached.setdefault(cache_key, stamp)
+        return dict((entity_key, cached[cache_key])
+                    for cache_key, entity_key in cache_keys.iteritems())
+
+    @classmethod
+    def bump(cls, entity_key):
+        '''Issues a new version stamp for an entity after it was written.
+        @param entity_key: the str id or NDB key of the entity
+        '''
+        memcache.set(cls._cache_key(entity_key), cls._new_stamp())
+
+    @classmethod
+    def bump_multi(cls, entity_keys):
+        '''Issues new version stamps for several entities written together,
+        with one batch memcache write.
+        @param entity_keys: list of str ids or NDB keys of entities
+        '''
+        stamp = cls._new_stamp()
+        memcache.set_multi(dict((cls._cache_key(entity_key), stamp)
+                                for entity_key in entity_keys))
+
+    @classmethod
+    def _new_stamp(cls):
+        '''Returns a new version stamp.
+        '''
+        return str(int(time.time() * 1000000))
+
+    @classmethod
+    def _cache_key(cls, entity_key):
+        '''Returns the memcache key of the version stamp of an entity.
+        '''
+        return VERSION_CACHE_PREFIX + _content_id(entity_key)
+
+
+class FragmentCache(object):
+    '''Class providing a two-level cache of rendered fragments: an LRU held by
+    this instance, bounded in entries and size, in front of memcache.
+    Attributes:
+        _local: the in-process LRUCache of fragments
+    '''
+
+    _local = LRUCache(FRAGMENT_LRU_ENTRIES, FRAGMENT_LRU_SIZE)
+
+    @classmethod
+    def get_or_render(cls, entity_key, version, fragment_name, render_fun):
+        '''Returns a cached fragment, rendering and caching it on a miss.
+        @param entity_key: the str id or NDB key of the entity the fragment
+        renders
+        @param version: the current version stamp of the entity
+        @param fragment_name: str naming the fragment of the entity, e.g.
+        "body", including anything else the fragment depends on
+        @param render_fun: function with no arguments that renders the
+        fragment and returns it as a unicode str
+        @return: the rendered fragment
+        '''
+        cache_key = (FRAGMENT_CACHE_PREFIX + _content_id(entity_key) + ":" +
+                     version + ":" + fragment_name)
+        fragment = cls._local.get(cache_key)
+        if fragment is None:
+            fragment = memcache.get(cache_key)
+            if fragment is None:
+                fragment = render_fun()
+                if len(fragment) <= FRAGMENT_MAX_SIZE:
+                    memcache.set(cache_key, fragment, FRAGMENT_CACHE_SECS)
+            cls._local.set(cache_key, fragment)
+        return fragment
+
+    @classmethod
+    def clear_local(cls):
+        '''Empties this instance's LRU of fragments.
+        '''
+        cls._local.clear()
+
+
+class PageCache(object):
+    '''Class providing a memcache-backed cache of whole rendered pages, keyed
+    by the page's path and the version stamp its content is derived from.
+    '''
+
+    @classmethod
+    def get(cls, path, version):
+        '''Returns a cached page, or None.
+        @param path: the path and query string of the page
+        @param version: the current version stamp of the page's content
+        @return: tuple of the str content type and str body of the page
+        '''
+        return memcache.get(cls._cache_key(path, version))
+
+    @classmethod
+    def set(cls, path, version, content_type, body):
+        '''Caches a page, unless it is too large for memcache.
+        @param path: the path and query string of the page
+        @param version: the version stamp of the page's content
+        @param content_type: the str value of the page's Content-Type header
+        @param body: the str body of the page
+        '''
+        if len(body) <= FRAGMENT_MAX_SIZE:
+            memcache.set(cls._cache_key(path, version), (content_type, body),
+                         PAGE_CACHE_SECS)
+
+    @classmethod
+    def _cache_key(cls, path, version):
+        '''Returns the memcache key of a version of a page.
+        '''
+        return PAGE_CACHE_PREFIX + version + ":" + path
@@ -0,0 +1,570 @@
+'''
+Closed-loop load generator. A number of virtual users each send a request,
+wait for its response, then send the next one, for a fixed duration. Each
+request is drawn from a weighted mix of steps read from a workload file, and
+each virtual user keeps its own cookies, so it stays logged in as its own
+corpus user. Reports the throughput and latency histogram of each step.
+Logins that do not redirect to the welcome page are reported as errors.
+
+    python load_generator.py [--workload workload.jsonl] [--duration 30]
+                             [--users 8] [--size small]
+                             [--url http://localhost:8080] [--processes 2]
+                             [--json results.json]
+
+Without --url, requests are made in process through the WSGI application,
+against a testbed datastore holding a corpus_generator corpus. With --url,
+they are sent over HTTP to a running server, e.g. serve.py, whose datastore
+holds a corpus of the same size, written by corpus_generator.py --backend
+ndb. Post ids are then read from the server's home page.
+
+Each line of the workload file is a JSON object describing one step:
+    name - the name the step is reported under
+    weight - the relative frequency of the step
+    method - "GET" or "POST"
+    path - the request path
+    form - dict of POST form fields, optional
+    login - true if the virtual user must be logged in, optional
+Paths and form values may hold the placeholders {post_id}, a post drawn
+from a Zipf distribution over the corpus's posts, {user} and {password},
+the virtual user's credentials, and {text}, a short random text. A recorded
+trace is a workload with one step per recorded request.
+
+Created on Jul 24, 2017
+@author: kennethalamantia
+'''
+
+import argparse
+import bisect
+import Cookie
+import cookielib
+import json
+import multiprocessing
+import random
+import re
+import sys
+import threading
+import timeit
+import urllib
+import urllib2
+import urlparse
+import blog_constants as bc
+import corpus_generator
+
+# Load test defaults
+DEFAULT_WORKLOAD = "workload.jsonl"
+DEFAULT_DURATION_SECS = 30.0
+DEFAULT_USERS = 8
+DEFAULT_SIZE = "small"
+HTTP_TIMEOUT_SECS = 30
+LOGIN_PATH = "/blog/login"
+# Where a successful login redirects to
+WELCOME_PATH = "/blog/user_welcome"
+HOME_PATH = "/blog/display/home"
+# Name the logins made before steps requiring one are reported under
+LOGIN_STEP = "login"
+POST_ID_PATTERN = re.compile(r"post_id/([\w-]+)/")
+TEXT_WORDS = 20
+# Upper bounds of the latency histogram buckets in ms
+HISTOGRAM_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+PERCENTILES = [50, 90, 99]
+
+
+class Step(object):
+    '''Class describing one kind of request of a workload.
+    Attributes:
+        name: the name the step is reported under
+        weight: the relative frequency of the step
+        method: "GET" or "POST"
+        path: the request path, possibly holding placeholders
+        form: dict of POST form fields, possibly holding placeholders
+        login: if True, the virtual user logs in before the step
+    '''
+
+    def __init__(self, name, weight, method, path, form=None, login=False):
+        self.name = name
+        self.weight = weight
+        self.method = method.upper()
+        self.path = path
+        self.form = form or {}
+        self.login = login
+
+
+def load_workload(path):
+    '''Reads the steps of a workload file.
+    @param path: path of the JSON lines workload file
+    @return: list of Steps
+    @raise ValueError: if the file holds no steps or a malformed line
+    '''
+    steps = []
+    with open(path) as workload_file:
+        for line in workload_file:
+            if line.strip():
+                steps.append(Step(**json.loads(line)))
+    if not steps:
+        raise ValueError("No steps in workload " + path)
+    return steps
+
+
+class LoadStats(object):
+    '''Class collecting the latencies and statuses of requests, by step.
+    Attributes:
+        latencies: dict of lists of latencies in seconds keyed by step name
+        statuses: dict of dicts of response counts by status keyed by step
+                  name. Requests that failed without a response have status
+                  0.
+        failures: dict of the counts of requests whose status is not an
+                  error but whose response was not the one expected, e.g. a
+                  rejected login, keyed by step name
+        _lock: lock guarding the dicts
+    '''
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.failures = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, latency, status, failed=False):
+        '''Records one request.
+        @param failed: True if the response is an error whatever its status
+        '''
+        with self._lock:
+            self.latencies.setdefault(name, []).append(latency)
+            statuses = self.statuses.setdefault(name, {})
+            statuses[status] = statuses.get(status, 0) + 1
+            # A request whose status is an error is counted by its status
+            if failed and not _is_error_status(status):
+                self.failures[name] = self.failures.get(name, 0) + 1
+
+    def merge(self, other):
+        '''Adds the requests recorded by another LoadStats.
+        '''
+        for name, latencies in other.latencies.iteritems():
+            self.latencies.setdefault(name, []).extend(latencies)
+        for name, statuses in other.statuses.iteritems():
+            for status, count in statuses.iteritems():
+                mine = self.statuses.setdefault(name, {})
+                mine[status] = mine.get(status, 0) + count
+        for name, count in other.failures.iteritems():
+            self.failures[name] = self.failures.get(name, 0) + count
+
+    def summary(self, duration):
+        '''Summarizes the requests of each step, and of all steps as "all".
+        @param duration: the length of the run in seconds
+        @return: dict of summaries keyed by step name
+        '''
+        summaries = {}
+        all_latencies = []
+        all_statuses = {}
+        for name in self.latencies:
+            summaries[name] = _summarize(self.latencies[name],
+                                         self.statuses[name], duration,
+                                         self.failures.get(name, 0))
+            all_latencies.extend(self.latencies[name])
+            for status, count in self.statuses[name].iteritems():
+                all_statuses[status] = all_statuses.get(status, 0) + count
+        summaries["all"] = _summarize(all_latencies, all_statuses, duration,
+                                      sum(self.failures.itervalues()))
+        return summaries
+
+    def __getstate__(self):
+        return {"latencies": self.latencies, "statuses": self.statuses,
+                "failures": self.failures}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def _summarize(latencies, statuses, duration, failures=0):
+    '''Returns a dict summarizing the requests of a step.
+    @param latencies: list of the latencies in seconds
+    @param statuses: dict of response counts keyed by status
+    @param duration: the length of the run in seconds
+    @param failures: the number of failed requests whose status is not an
+    error
+    '''
+    latencies = sorted(latencies)
+    histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+    for latency in latencies:
+        histogram[bisect.bisect_left(HISTOGRAM_BOUNDS_MS,
+                                     latency * 1000)] += 1
+    summary = {"requests": len(latencies),
+               "errors": failures + sum(count for status, count
+                                        in statuses.iteritems()
+                                        if _is_error_status(status)),
+               "rps": len(latencies) / duration,
+               "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+               "statuses": dict((str(status), count)
+                                for status, count in statuses.iteritems()),
+               "histogram": histogram}
+    for percentile in PERCENTILES:
+        summary["p%d_ms" % percentile] = _percentile(latencies,
+                                                     percentile) * 1000
+    return summary
+
+
+def _is_error_status(status):
+    '''Is a response status, or 0 for no response, an error?
+    '''
+    return status == 0 or status >= 500
+
+
+def _percentile(sorted_values, percentile):
+    '''Returns a percentile of a sorted list, or 0 if it is empty.
+    '''
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1,
+                             len(sorted_values) * percentile // 100)]
+
+
+class InProcessSession(object):
+    '''Session of one virtual user making requests through a WSGI
+    application in this process.
+    Attributes:
+        _app: the WSGI application
+        _request_class: the webapp2 Request class
+        _cookies: dict of the cookies set so far, keyed by name
+    '''
+
+    def __init__(self, app):
+        # Imported here so that HTTP load tests run without the SDK.
+        import webapp2
+        self._app = app
+        self._request_class = webapp2.Request
+        self._cookies = {}
+
+    def request(self, method, path, form):
+        '''Makes a request without following redirects.
+        @return: tuple of the int status of the response and its Location
+        header, or None
+        '''
+        headers = []
+        if self._cookies:
+            headers.append(("Cookie", "; ".join(
+                "%s=%s" % cookie for cookie in self._cookies.iteritems())))
+        request = self._request_class.blank(
+            path, POST=form if method == "POST" else None, headers=headers)
+        response = request.get_response(self._app)
+        for header in response.headers.getall("Set-Cookie"):
+            for name, morsel in Cookie.SimpleCookie(header).iteritems():
+                if morsel.value:
+                    self._cookies[name] = morsel.value
+                else:
+                    self._cookies.pop(name, None)
+        return response.status_int, response.headers.get("Location")
+
+
+class _NoRedirectHandler(urllib2.HTTPRedirectHandler):
+    '''Leaves redirects to the caller, so each request is timed alone.
+    '''
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpSession(object):
+    '''Session of one virtual user making requests to a server over HTTP.
+    Attributes:
+        _base_url: the url of the server
+        _opener: urllib2 opener keeping the session's cookies
+    '''
+
+    def __init__(self, base_url):
+        self._base_url = base_url.rstrip("/")
+        self._opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar()),
+            _NoRedirectHandler())
+
+    def request(self, method, path, form):
+        '''Makes a request without following redirects.
+        @return: tuple of the int status of the response and its Location
+        header, or None
+        '''
+        data = urllib.urlencode(form) if method == "POST" else None
+        try:
+            response = self._opener.open(self._base_url + path, data,
+                                         HTTP_TIMEOUT_SECS)
+        except urllib2.HTTPError as error:
+            error.read()
+            return error.code, error.info().getheader("Location")
+        response.read()
+        return response.getcode(), response.info().getheader("Location")
+
+
+class VirtualUser(object):
+    '''A virtual user running steps of a workload in a closed loop.
+    Attributes:
+        user_name: the corpus user the virtual user logs in as
+        _session: the session making the requests
+        _steps: list of the workload's Steps
+        _cumulative_weights: list of the cumulative weights of the steps
+        _post_ids: list of post ids, most popular first
+        _post_sampler: ZipfSampler drawing indexes of _post_ids
+        _rng: the virtual user's random.Random
+        _logged_in: True if the virtual user's last login succeeded
+    '''
+
+    def __init__(self, session, user_name, steps, post_ids, seed):
+        self.user_name = user_name
+        self._session = session
+        self._steps = steps
+        self._cumulative_weights = []
+        total = 0
+        for step in steps:
+            total += step.weight
+            self._cumulative_weights.append(total)
+        self._post_ids = post_ids
+        self._rng = random.Random(seed)
+        self._post_sampler = corpus_generator.ZipfSampler(len(post_ids),
+                                                          self._rng)
+        self._logged_in = False
+
+    def run(self, stats, deadline, warmup_deadline):
+        '''Runs steps until the deadline.
+        @param stats: the LoadStats to record requests in
+        @param deadline: the timeit.default_timer() time to stop at
+        @param warmup_deadline: the time before which requests are not
+        recorded
+        '''
+        while timeit.default_timer() < deadline:
+            step = self._steps[bisect.bisect_right(
+                self._cumulative_weights,
+                self._rng.random() * self._cumulative_weights[-1])]
+            if step.login and not self._logged_in:
+                self._timed_request(stats, warmup_deadline, LOGIN_STEP,
+                                    "POST", LOGIN_PATH, self._login_form())
+            self._timed_request(stats, warmup_deadline, step.name,
+                                step.method, self._fill(step.path),
+                                dict((field, self._fill(value))
+                                     for field, value
+                                     in step.form.iteritems()))
+
+    def _timed_request(self, stats, warmup_deadline, name, method, path,
+                       form):
+        '''Makes and records a request. A login succeeds if it redirects
+        to the welcome page, and is recorded as an error otherwise.
+        @param stats: the LoadStats to record the request in
+        @param warmup_deadline: the time before which it is not recorded
+        @param name: the name of the step the request is recorded under
+        '''
+        start = timeit.default_timer()
+        try:
+            status, location = self._session.request(method, path, form)
+        except Exception:
+            status, location = 0, None
+        end = timeit.default_timer()
+        failed = False
+        if path == LOGIN_PATH:
+            self._logged_in = (status == 302 and location is not None and
+                               urlparse.urlsplit(location).path ==
+                               WELCOME_PATH)
+            failed = not self._logged_in
+        if start >= warmup_deadline:
+            stats.record(name, end - start, status, failed)
+
+    def _login_form(self):
+        '''Returns the login form of the virtual user's corpus user.
+        '''
+        return {bc.USER: self.user_name,
+                bc.PASSWORD: corpus_generator.CORPUS_PASSWORD}
+
+    def _fill(self, template):
+        '''Replaces the placeholders of a path or form value.
+        '''
+        if "{" not in template:
+            return template
+        return template.format(
+            post_id=self._post_ids[self._post_sampler.sample()],
+            user=self.user_name,
+            password=corpus_generator.CORPUS_PASSWORD,
+            text=" ".join(self._rng.choice(corpus_generator.VOCABULARY)
+                          for dummy_idx in range(TEXT_WORDS)))
+
+
+def run_users(virtual_users, duration, warmup):
+    '''Runs virtual users on one thread each.
+    @param virtual_users: list of VirtualUsers
+    @param duration: the number of seconds requests are recorded for
+    @param warmup: the number of seconds before recording starts
+    @return: the LoadStats of the run
+    '''
+    stats = LoadStats()
+    warmup_deadline = timeit.default_timer() + warmup
+    deadline = warmup_deadline + duration
+    threads = [threading.Thread(target=user.run,
+                                args=(stats, deadline, warmup_deadline))
+               for user in virtual_users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats
+
+
+def run_in_process(steps, args):
+    '''Runs a load test through the WSGI application, against a testbed
+    datastore holding a fresh corpus.
+    @return: the LoadStats of the run
+    '''
+    from google.appengine.ext import testbed
+    import blog_app
+    import blog_storage
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+    bed.init_user_stub()
+    try:
+        corpus = corpus_generator.build_corpus(
+            blog_storage.app_storage(),
+            corpus_generator.SIZES[args.size], args.seed)
+        post_ids = _by_popularity(corpus)
+        virtual_users = [
+            VirtualUser(InProcessSession(blog_app.application),
+                        corpus.user_names[index % len(corpus.user_names)],
+                        steps, post_ids, args.seed + index)
+            for index in range(args.users)]
+        return run_users(virtual_users, args.duration, args.warmup)
+    finally:
+        bed.deactivate()
+
+
+def _by_popularity(corpus):
+    '''Returns a corpus's post ids, hot posts first, then the most recent.
+    '''
+    hot = set(corpus.hot_post_ids)
+    return corpus.hot_post_ids + [post_id for post_id
+                                  in reversed(corpus.post_ids)
+                                  if post_id not in hot]
+
+
+def run_http(steps, args):
+    '''Runs a load test against a server, on args.processes processes of
+    virtual users.
+    @return: the LoadStats of the run
+    '''
+    home = urllib2.urlopen(args.url.rstrip("/") + HOME_PATH,
+                           timeout=HTTP_TIMEOUT_SECS).read()
+    post_ids = list(_unique(POST_ID_PATTERN.findall(home)))
+    if not post_ids:
+        raise ValueError("No posts found on the home page of " + args.url)
+    user_names = [corpus_generator.USER_NAME_FORMAT % index for index in
+                  range(corpus_generator.SIZES[args.size].users)]
+    if args.processes <= 1:
+        return _run_http_users(args, steps, post_ids, user_names, 0, None)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(
+                     target=_run_http_users,
+                     args=(args, steps, post_ids, user_names, index, results))
+                 for index in range(args.processes)]
+    for process in processes:
+        process.start()
+    stats = LoadStats()
+    for dummy_process in processes:
+        stats.merge(results.get())
+    for process in processes:
+        process.join()
+    return stats
+
+
+def _run_http_users(args, steps, post_ids, user_names, process_index,
+                    results):
+    '''Runs one process's share of the virtual users of an HTTP load test.
+    @param results: multiprocessing.Queue to put the LoadStats on, or None
+    @return: the LoadStats of the process's virtual users
+    '''
+    indexes = range(process_index, args.users, max(1, args.processes))
+    virtual_users = [VirtualUser(HttpSession(args.url),
+                                 user_names[index % len(user_names)],
+                                 steps, post_ids, args.seed + index)
+                     for index in indexes]
+    stats = run_users(virtual_users, args.duration, args.warmup)
+    if results is not None:
+        results.put(stats)
+    return stats
+
+
+def _unique(values):
+    '''Yields the distinct values of a list, in order.
+    '''
+    seen = set()
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            yield value
+
+
+def print_report(summaries):
+    '''Prints the throughput, latency percentiles and latency histogram of
+    each step.
+    '''
+    names = sorted(name for name in summaries if name != "all") + ["all"]
+    print "%-12s %9s %7s %9s %9s %9s %9s %9s" % (
+        "step", "requests", "errors", "req/s", "p50 ms", "p90 ms", "p99 ms",
+        "max ms")
+    for name in names:
+        summary = summaries[name]
+        print "%-12s %9d %7d %9.1f %9.1f %9.1f %9.1f %9.1f" % (
+            name, summary["requests"], summary["errors"], summary["rps"],
+            summary["p50_ms"], summary["p90_ms"], summary["p99_ms"],
+            summary["max_ms"])
+    labels = ["<=%d" % bound for bound in HISTOGRAM_BOUNDS_MS] + [
+        ">%d" % HISTOGRAM_BOUNDS_MS[-1]]
+    print
+    print "Latency histogram, requests per bucket of ms"
+    print "%-12s" % "step" + "".join("%7s" % label for label in labels)
+    for name in names:
+        print "%-12s" % name + "".join(
+            "%7d" % count for count in summaries[name]["histogram"])
+
+
+def main():
+    '''Runs the load test and prints the report.
+    @return: the int exit status, 1 if any request failed
+    '''
+    parser = argparse.ArgumentParser(description="Closed-loop load test")
+    parser.add_argument("--workload", default=DEFAULT_WORKLOAD,
+                        help="path of the JSON lines workload file")
+    parser.add_argument("--duration", type=float,
+                        default=DEFAULT_DURATION_SECS,
+                        help="seconds requests are recorded for")
+    parser.add_argument("--warmup", type=float, default=0.0,
+                        help="seconds of requests before recording starts")
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS,
+                        help="number of concurrent virtual users")
+    parser.add_argument("--size", choices=sorted(corpus_generator.SIZES),
+                        default=DEFAULT_SIZE, help="size of the corpus")
+    parser.add_argument("--seed", type=int,
+                        default=corpus_generator.DEFAULT_SEED,
+                        help="seed of the corpus and of the virtual users")
+    parser.add_argument("--url", default=None,
+                        help="url of a running server to load over HTTP")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="processes of virtual users, with --url")
+    parser.add_argument("--json", default=None,
+                        help="path to write the summaries to as JSON")
+    args = parser.parse_args()
+    steps = load_workload(args.workload)
+    if args.url:
+        stats = run_http(steps, args)
+    else:
+        if args.processes > 1:
+            parser.error("--processes needs --url, in-process runs share "
+                         "one testbed")
+        stats = run_in_process(steps, args)
+    summaries = stats.summary(args.duration)
+    print_report(summaries)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump({"workload": args.workload, "url": args.url,
+                       "users": args.users, "duration": args.duration,
+                       "summaries": summaries}, json_file, indent=2,
+                      sort_keys=True)
+    return 1 if summaries["all"]["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
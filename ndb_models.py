@@ -5,9 +5,37 @@ Created on Jun 12, 2017
 This module contains the ndb model classes used in the blog application.
 '''
 
+import logging
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 from blog_utilities import PwdUtil
-import blog_handler as bh
+from fragment_cache import ContentVersion
+from sharded_counter import ShardedCounter
+import blog_constants as bc
+
+# Home feed constants, change the cache key along with the format of the
+# feed entries
+HOME_FEED_SIZE = 20
+HOME_FEED_CACHE_KEY = "home_feed_v2"
+HOME_FEED_CACHE_SECS = 600
+HOME_FEED_CAS_RETRIES = 5
+
+# Post summary constants
+EXCERPT_LENGTH = 300
+
+# Pagination constants
+COMMENT_PAGE_SIZE = 20
+
+# Cascade delete constants
+CASCADE_BATCH_SIZE = 500
+
+# Counter names
+POSTS_COUNTER = "cur_num_posts"
+COMMENTS_MADE_COUNTER = "comments_made"
+COMMENTS_COUNTER = "cur_num_comments"
+LIKES_COUNTER = "likes"
 
 class User(ndb.Model):
     '''NDB class representity a user entity.
@@ -17,9 +45,12 @@ class User(ndb.Model):
         password - hashed and salted password
         email - user's email address
         date_created - date this user joined the blog
-        posts_made - the cumulative number of posts this user has made
+        posts_made - the cumulative number of posts this user has made, also
+                     the sequence the post numbers of the user's posts are
+                     taken from
         cur_num_posts - the current number of existing posts of this user;
-                        does not count deleted posts
+                        does not count deleted posts. Read from a sharded
+                        counter.
     '''
 
     user_name = ndb.StringProperty(required=True)
@@ -27,7 +58,13 @@ class User(ndb.Model):
     email = ndb.StringProperty()
     date_created = ndb.DateTimeProperty(auto_now_add=True)
     posts_made = ndb.IntegerProperty()
-    cur_num_posts = ndb.IntegerProperty()
+
+    @property
+    def cur_num_posts(self):
+        '''The current number of existing posts of this user.
+        '''
+        return ShardedCounter.get_count(
+            ShardedCounter.name_for(self.key, POSTS_COUNTER))
 
     @classmethod
     def create_new_user(cls, form_data):
@@ -35,16 +72,26 @@ class User(ndb.Model):
         @param form_data: dict holding username, password, and email address
         @return NDB key of this user
         '''
-        if not cls.already_exists(form_data.get(bh.USER)):
-            secured_pwd = cls._secure_password(form_data.get(bh.PASSWORD))
-            new_user = User(user_name=form_data.get(bh.USER),
-                            password=secured_pwd,
-                            email=form_data.get(bh.EMAIL),
-                            id=form_data.get(bh.USER),
-                            posts_made=0,
-                            cur_num_posts=0)
-            new_user_key = new_user.put()
-            return new_user_key
+        if not cls.already_exists(form_data.get(bc.USER)):
+            secured_pwd = cls._secure_password(form_data.get(bc.PASSWORD))
+            return cls.insert_user(form_data.get(bc.USER), secured_pwd,
+                                   form_data.get(bc.EMAIL))
+
+    @classmethod
+    @ndb.transactional
+    def insert_user(cls, user_name, password, email=None):
+        '''Creates a user unless the user name is taken. The check and the
+        insert run in one transaction, so of concurrent signups for one name
+        only the first succeeds.
+        @param user_name: the str user name
+        @param password: the hashed and salted password, see PwdUtil
+        @param email: the user's email address, or None
+        @return: NDB key of the new user, or None if the user already exists
+        '''
+        if ndb.Key(cls, user_name).get() is not None:
+            return None
+        return cls(user_name=user_name, password=password, email=email,
+                   id=user_name, posts_made=0).put()
 
     @classmethod
     def already_exists(cls, user_name):
@@ -56,18 +103,24 @@ class User(ndb.Model):
             return cls.get_by_id(user_name)
 
     @classmethod
-    def incr_posts_made(cls, user_name):
-        '''Increment the total number of posts made and the current number of
-        posts outstanding for this user.
-        @param user_name: the string id key for this user entity
-        @return: the total number of posts this user has ever made
+    def update_password(cls, user_name, clear_text):
+        '''Rehashes a user's password with the current password hashing
+        settings.
+        @param user_name: the str user name
+        @param clear_text: the user's verified clear-text password
         '''
-        user_key = ndb.Key("User", user_name)
-        user = user_key.get()
-        user.posts_made += 1
-        user.cur_num_posts += 1
+        cls.set_password(user_name, cls._secure_password(clear_text))
+
+    @classmethod
+    @ndb.transactional
+    def set_password(cls, user_name, password):
+        '''Replaces a user's stored password.
+        @param user_name: the str user name
+        @param password: the hashed and salted password, see PwdUtil
+        '''
+        user = ndb.Key("User", user_name).get()
+        user.password = password
         user.put()
-        return user.posts_made
 
     @classmethod
     def _secure_password(cls, clear_text):
@@ -83,6 +136,7 @@ class BlogPost(ndb.Model):
     '''NDB class representing a single blog post.
     Parent is the user-author of the post. It's direct children are comment
     entities.
+    Likes are stored as separate Like entities, see that class.
     Attributes:
         post_subject: subject of the post
         post_content: the context of a post
@@ -91,10 +145,15 @@ class BlogPost(ndb.Model):
         post_number: number unique to this post, n, where n equals the nth
                      post a user has made
         date_created: the date/time of the post's create
+        post_excerpt: the first EXCERPT_LENGTH chars of the content, set
+                      whenever the content is written
+        content_length: the length of the content in chars
         comments_made: the cumulative total of comments made on this post,
-                       including deleted comments
+                       including deleted comments. Read from a sharded
+                       counter.
         cur_num_comments: number of current comments on this post, not
-                          including deleted comments
+                          including deleted comments. Read from a sharded
+                          counter.
     '''
 
     post_subject = ndb.StringProperty(required=True)
@@ -102,9 +161,22 @@ class BlogPost(ndb.Model):
     post_author = ndb.StringProperty(required=True)
     post_number = ndb.StringProperty()
     date_created = ndb.DateTimeProperty(auto_now_add=True)
-    users_liked = ndb.StringProperty(repeated=True)
-    comments_made = ndb.IntegerProperty()
-    cur_num_comments = ndb.IntegerProperty()
+    post_excerpt = ndb.StringProperty()
+    content_length = ndb.IntegerProperty()
+
+    @property
+    def comments_made(self):
+        '''The cumulative total of comments made on this post.
+        '''
+        return ShardedCounter.get_count(
+            ShardedCounter.name_for(self.key, COMMENTS_MADE_COUNTER))
+
+    @property
+    def cur_num_comments(self):
+        '''The number of current comments on this post.
+        '''
+        return ShardedCounter.get_count(
+            ShardedCounter.name_for(self.key, COMMENTS_COUNTER))
 
     @classmethod
     def create_new_post(cls, user_name, form_data):
@@ -113,56 +185,97 @@ class BlogPost(ndb.Model):
         @param user_name: the user name of the post's author
         @param form_data: dict containing the subject and content of the post,
         keyed to global constants
-        @return: an NDB BlogPost entity
+        @return: the key of the new BlogPost entity
         '''
+        new_post = cls._create_post_txn(user_name, form_data)
+        HomeFeed.add_post(new_post)
+        return new_post.key
 
-        post_number = str(User.incr_posts_made(user_name))
-        new_post = BlogPost(post_subject=form_data.get(bh.SUBJECT),
-                            post_content=form_data.get(bh.CONTENT),
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _create_post_txn(cls, user_name, form_data):
+        '''Numbers a new post from its author's total number of posts made and
+        writes the post, the author and the author's posts counter in one
+        cross-group transaction, so they commit together.
+        @return: the new BlogPost entity
+        '''
+        user_key = ndb.Key("User", user_name)
+        user = user_key.get()
+        user.posts_made += 1
+        post_number = str(user.posts_made)
+        new_post = BlogPost(post_subject=form_data.get(bc.SUBJECT),
+                            post_content=form_data.get(bc.CONTENT),
                             post_author=user_name,
-                            parent=ndb.Key("User", user_name))
-        new_post.post_number = post_number
-        new_post.key = ndb.Key("User", user_name, "BlogPost", post_number)
-        new_post.users_liked = []
-        new_post.comments_made = 0
-        new_post.cur_num_comments = 0
-        new_post_key = new_post.put()
+                            post_number=post_number,
+                            key=ndb.Key("User", user_name,
+                                        "BlogPost", post_number))
+        cls._set_summary_fields(new_post)
+        ndb.put_multi([user, new_post])
+        ShardedCounter.increment(
+            ShardedCounter.name_for(user_key, POSTS_COUNTER))
+        return new_post
 
-        return new_post_key
+    @classmethod
+    @ndb.tasklet
+    def count_comments_async(cls, post_key):
+        '''Returns the number of current comments on a post.
+        @param post_key: the key of the BlogPost entity
+        @return: future of the int number of comments
+        '''
+        counter_name = ShardedCounter.name_for(post_key, COMMENTS_COUNTER)
+        counts = yield ShardedCounter.get_counts_async([counter_name])
+        raise ndb.Return(counts[counter_name])
 
     @classmethod
-    def incr_comments_made(cls, post_entity):
+    def incr_comments_made(cls, post_key):
         '''Increments both the total number of comments made to date on and the
-        number of comments currently outstanding.
-        @param post_entity: the BlogPost entity to be updated.
-        @return: the total number of comments made.
+        number of comments currently outstanding. The post entity itself is
+        not written.
+        @param post_key: the key of the BlogPost entity to be updated.
         '''
-        post_entity.comments_made += 1
-        post_entity.cur_num_comments += 1
-        post_entity.put()
-        return post_entity.comments_made
+        cls.incr_comments_made_async(post_key).get_result()
 
     @classmethod
-    def incr_cur_num_comments(cls, post_entity):
+    @ndb.tasklet
+    def incr_comments_made_async(cls, post_key):
+        '''Tasklet version of incr_comments_made. Both counters are written
+        concurrently.
+        @param post_key: the key of the BlogPost entity to be updated.
+        '''
+        yield (ShardedCounter.increment_async(
+                   ShardedCounter.name_for(post_key, COMMENTS_MADE_COUNTER)),
+               cls.incr_cur_num_comments_async(post_key))
+
+    @classmethod
+    def incr_cur_num_comments(cls, post_key, delta=1):
         '''Increment the current number of comments on this post.
-        @param post_entity: the BlogPost entity to be updated.
+        @param post_key: the key of the BlogPost entity to be updated.
+        @param delta: the int amount to add, negative to decrement
         '''
-        post_entity.cur_num_comments += 1
-        post_entity.put()
-        return post_entity.cur_num_comments
+        cls.incr_cur_num_comments_async(post_key, delta).get_result()
+
+    @classmethod
+    def incr_cur_num_comments_async(cls, post_key, delta=1):
+        '''Tasklet version of incr_cur_num_comments.
+        @param post_key: the key of the BlogPost entity to be updated.
+        @param delta: the int amount to add, negative to decrement
+        @return: future that completes once the counter is written
+        '''
+        return ShardedCounter.increment_async(
+            ShardedCounter.name_for(post_key, COMMENTS_COUNTER), delta)
 
     @classmethod
     def add_like_unlike(cls, post_entity, user_name, like_status):
-        '''Add or remove a user from users_liked list.
-        @param post_entity: BlogPost entity being updated
+        '''Record or remove a user's like of a post. The post entity itself is
+        not written.
+        @param post_entity: BlogPost entity being liked or unliked
         @param user_name: the user liking/unliking the post
         @param like_status: current str value of the like button
         '''
         if like_status == "Like":
-            post_entity.users_liked.append(user_name)
+            Like.add_like(post_entity.key, user_name)
         else:
-            post_entity.users_liked.remove(user_name)
-        post_entity.put()
+            Like.remove_like(post_entity.key, user_name)
 
     @classmethod
     def already_liked(cls, post_entity, user_name):
@@ -171,8 +284,60 @@ class BlogPost(ndb.Model):
         @param user_name: the user name of the user to check
         @return: boolean
         '''
-        result = user_name in post_entity.users_liked
-        return result
+        return Like.has_liked(post_entity.key, user_name)
+
+    @classmethod
+    def like_count(cls, post_entity):
+        '''Returns the number of users who have liked a blog post.
+        @param post_entity: the BlogPost entity to count likes for
+        '''
+        return Like.count_likes(post_entity.key)
+
+    @classmethod
+    def get_comments_page(cls, post_entity, cursor_str=None,
+                          page_size=COMMENT_PAGE_SIZE):
+        '''Returns one page of the comments for a given post, most recent
+        first.
+        @param post_entity: the blog post entity to retreive comments for
+        @param cursor_str: url-safe cursor str marking the start of the page,
+        or None for the first page
+        @param page_size: the maximum number of comments on the page
+        @return: tuple of a list of Comment entities and the url-safe cursor
+        str of the next page, or None if this is the last page
+        @raise BadValueError: if cursor_str is not a valid cursor
+        '''
+        return cls.get_comments_page_async(post_entity, cursor_str,
+                                           page_size).get_result()
+
+    @classmethod
+    def get_comments_page_async(cls, post_entity, cursor_str=None,
+                                page_size=COMMENT_PAGE_SIZE):
+        '''Tasklet version of get_comments_page.
+        @return: future of a tuple of a list of Comment entities and the
+        url-safe cursor str of the next page, or None
+        @raise BadValueError: if cursor_str is not a valid cursor
+        '''
+        return cls.comments_page_async(post_entity.key, cursor_str,
+                                       page_size)
+
+    @classmethod
+    @ndb.tasklet
+    def comments_page_async(cls, post_key, cursor_str=None,
+                            page_size=COMMENT_PAGE_SIZE):
+        '''Returns one page of the comments of a post by the post's key, so
+        the comments of a deleted post can still be read.
+        @param post_key: the key of the BlogPost entity
+        @param cursor_str: url-safe cursor str marking the start of the page,
+        or None for the first page
+        @param page_size: the maximum number of comments on the page
+        @return: future of a tuple of a list of Comment entities and the
+        url-safe cursor str of the next page, or None
+        @raise BadValueError: if cursor_str is not a valid cursor
+        '''
+        comments_query = cls.comments_query(post_key)
+        comments, cursor, more = yield comments_query.fetch_page_async(
+            page_size, start_cursor=_cursor_from_str(cursor_str))
+        raise ndb.Return((comments, _cursor_to_str(cursor, more)))
 
     @classmethod
     def get_all_comments(cls, post_entity):
@@ -180,19 +345,80 @@ class BlogPost(ndb.Model):
         @param post_entity: the blog post entity to retreive comments for
         @return: a list of Comment entities
         '''
-        comments_query = Comment.query(ancestor=post_entity.key)
-        all_comments = comments_query.order(-Comment.date_created).fetch()
-        return all_comments
+        return cls.comments_query(post_entity.key).fetch()
+
+    @classmethod
+    def comments_query(cls, post_key):
+        '''Returns the query of the comments of a post, most recent first.
+        @param post_key: the key of the BlogPost entity
+        '''
+        return Comment.query(ancestor=post_key).order(-Comment.date_created)
 
     @classmethod
     def most_recent_20(cls):
         '''Returns up to the most recent 20 blog posts in descending order of
         date created.
         '''
-        posts_query = cls.query()
-        recent_posts = posts_query.order(-cls.date_created).fetch(20)
+        recent_posts = cls._recent_posts_query().fetch(HOME_FEED_SIZE)
         return recent_posts
 
+    @classmethod
+    def recent_posts_page(cls, cursor_str, page_size=HOME_FEED_SIZE):
+        '''Returns one page of blog post summaries in descending order of date
+        created. This is a projection query, so the full post content is never
+        read; only the summary fields of each post are set.
+        @param cursor_str: url-safe cursor str marking the start of the page,
+        or None for the first page
+        @param page_size: the maximum number of posts on the page
+        @return: tuple of a list of projected BlogPost entities and the
+        url-safe cursor str of the next page, or None if this is the last page
+        @raise BadValueError: if cursor_str is not a valid cursor
+        '''
+        recent_posts, cursor, more = cls._recent_summaries_query().fetch_page(
+            page_size, start_cursor=_cursor_from_str(cursor_str))
+        return recent_posts, _cursor_to_str(cursor, more)
+
+    @classmethod
+    def backfill_summary_fields(cls, cursor_str=None):
+        '''Sets the excerpt and content length of posts written before those
+        fields existed, one batch per task. Posts without them are missing
+        from the projection queries of the home page. Run once by deferring
+        this method after deploying.
+        @param cursor_str: url-safe cursor str of the next batch of posts
+        '''
+        posts, cursor, more = cls.query().fetch_page(
+            CASCADE_BATCH_SIZE, start_cursor=_cursor_from_str(cursor_str))
+        for post in posts:
+            cls._set_summary_fields(post)
+        ndb.put_multi(posts)
+        if more:
+            deferred.defer(cls.backfill_summary_fields,
+                           _cursor_to_str(cursor, more))
+
+    @classmethod
+    def _recent_posts_query(cls):
+        '''Returns the query of all posts, most recent first.
+        '''
+        return cls.query().order(-cls.date_created)
+
+    @classmethod
+    def _recent_summaries_query(cls):
+        '''Returns the projection query of the summary fields of all posts,
+        most recent first. The home feed and every later page of the home
+        page are positions in this query.
+        '''
+        return cls.query(projection=[cls.post_subject, cls.post_author,
+                                     cls.post_excerpt, cls.content_length]
+                         ).order(-cls.date_created)
+
+    @classmethod
+    def _set_summary_fields(cls, post_entity):
+        '''Sets the excerpt and content length of a post from its content.
+        @param post_entity: the BlogPost entity to update, not put
+        '''
+        post_entity.post_excerpt = post_entity.post_content[:EXCERPT_LENGTH]
+        post_entity.content_length = len(post_entity.post_content)
+
     @classmethod
     def update_post(cls, post_entity, form_data):
         '''Updates the subject and content of a post upon editing.
@@ -201,26 +427,371 @@ class BlogPost(ndb.Model):
               subject and content strs.
         @return: updated BlogPost entity
         '''
-        post_entity.post_subject = form_data[bh.SUBJECT]
-        post_entity.post_content = form_data[bh.CONTENT]
+        post_entity.post_subject = form_data[bc.SUBJECT]
+        post_entity.post_content = form_data[bc.CONTENT]
+        cls._set_summary_fields(post_entity)
         post_entity.put()
+        ContentVersion.bump(post_entity.key)
+        HomeFeed.update_post(post_entity)
         return post_entity
 
     @classmethod
     def delete_post(cls, post_entity):
         '''Deletes this post entity and decrement the current number of posts
-        outstanding for the post's author.
+        outstanding for the post's author. The post's comments, likes and
+        counters are deleted afterwards by a background task, see
+        cascade_delete.
         @param post_entity: the NDB entity BlogPost to be deleted
         '''
-        user_entity = ndb.Key("User", post_entity.post_author).get()
-        user_entity.cur_num_posts -= 1
-        assert user_entity.cur_num_posts >= 0, "Num posts can't be < 0."
-        post_entity.key.delete()
-        user_entity.put()
+        cls._delete_post_txn(post_entity.key)
+        ContentVersion.bump(post_entity.key)
+        HomeFeed.remove_post(post_entity)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _delete_post_txn(cls, post_key):
+        '''Deletes a post and decrements its author's posts counter in one
+        cross-group transaction. The cascade task is enqueued transactionally,
+        so it only runs if the delete commits.
+        @param post_key: the key of the BlogPost entity
+        '''
+        post_key.delete()
+        ShardedCounter.increment(
+            ShardedCounter.name_for(post_key.parent(), POSTS_COUNTER), -1)
+        deferred.defer(cls.cascade_delete, post_key.urlsafe(),
+                       _transactional=True)
+
+
+    @classmethod
+    def cascade_delete(cls, post_url_key, stage=0, cursor_str=None):
+        '''Deletes one batch of the entities left behind by a deleted post,
+        then queues a task to delete the next batch. The comments are deleted
+        first, then the likes, then the post's counters. Each task carries the
+        stage and the query cursor reached so far, so a very large thread is
+        deleted in bounded chunks and a retried task resumes where it stopped.
+        @param post_url_key: the url-safe key str of the deleted post
+        @param stage: index into the list of queries of entities to delete
+        @param cursor_str: url-safe cursor str of the next batch in the stage
+        '''
+        post_key = ndb.Key(urlsafe=post_url_key)
+        child_queries = [Comment.query(ancestor=post_key),
+                         Like.query(Like.post_key == post_key)]
+        if stage < len(child_queries):
+            child_keys, cursor, more = child_queries[stage].fetch_page(
+                CASCADE_BATCH_SIZE, keys_only=True,
+                start_cursor=_cursor_from_str(cursor_str))
+            ndb.delete_multi(child_keys)
+            if more:
+                deferred.defer(cls.cascade_delete, post_url_key, stage,
+                               _cursor_to_str(cursor, more))
+            else:
+                deferred.defer(cls.cascade_delete, post_url_key, stage + 1)
+        else:
+            ShardedCounter.delete_counters(
+                [ShardedCounter.name_for(post_key, counter) for counter
+                 in (COMMENTS_MADE_COUNTER, COMMENTS_COUNTER, LIKES_COUNTER)])
+
+
+class Like(ndb.Model):
+    '''NDB class recording that a user has liked a blog post.
+    This is a root entity whose key is derived from the post and the user, so
+    liking, unliking and checking whether a user has liked a post are each a
+    single key operation and never write the BlogPost entity. The number of
+    likes on a post is kept in a sharded counter updated in the same
+    transaction.
+    Attributes:
+        post_key: the key of the liked BlogPost entity
+        user_name: the user name of the user who liked the post
+        date_created: the date/time the post was liked
+    '''
+
+    post_key = ndb.KeyProperty(required=True)
+    user_name = ndb.StringProperty(required=True)
+    date_created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def like_key(cls, post_key, user_name):
+        '''Returns the key of the Like entity for a post and a user.
+        @param post_key: the key of the BlogPost entity
+        @param user_name: the user name of the liking user
+        '''
+        return ndb.Key(cls, post_key.urlsafe() + "|" + user_name)
+
+    @classmethod
+    def add_like(cls, post_key, user_name):
+        '''Records that a user likes a post, if not already recorded.
+        @param post_key: the key of the BlogPost entity
+        @param user_name: the user name of the liking user
+        @return: boolean, true if a new like was recorded
+        '''
+        like_key = cls.like_key(post_key, user_name)
+
+        def _txn():
+            if like_key.get() is not None:
+                return False
+            cls(key=like_key, post_key=post_key, user_name=user_name).put()
+            ShardedCounter.increment(cls._counter_name(post_key))
+            return True
+        added = ndb.transaction(_txn, xg=True)
+        if added:
+            ContentVersion.bump(post_key)
+        return added
+
+    @classmethod
+    def remove_like(cls, post_key, user_name):
+        '''Removes a user's like of a post, if there is one.
+        @param post_key: the key of the BlogPost entity
+        @param user_name: the user name of the unliking user
+        @return: boolean, true if a like was removed
+        '''
+        like_key = cls.like_key(post_key, user_name)
+
+        def _txn():
+            if like_key.get() is None:
+                return False
+            like_key.delete()
+            ShardedCounter.increment(cls._counter_name(post_key), -1)
+            return True
+        removed = ndb.transaction(_txn, xg=True)
+        if removed:
+            ContentVersion.bump(post_key)
+        return removed
+
+    @classmethod
+    def has_liked(cls, post_key, user_name):
+        '''Has a given user liked a post?
+        @param post_key: the key of the BlogPost entity
+        @param user_name: the user name to check, None if no user is logged in
+        @return: boolean
+        '''
+        return cls.has_liked_async(post_key, user_name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def has_liked_async(cls, post_key, user_name):
+        '''Tasklet version of has_liked.
+        @return: future of a boolean
+        '''
+        if not user_name:
+            raise ndb.Return(False)
+        like = yield cls.like_key(post_key, user_name).get_async()
+        raise ndb.Return(like is not None)
+
+    @classmethod
+    def liked_by_user(cls, post_keys, user_name):
+        '''Which of several posts has a user liked? Looks up every like with
+        a single batch get.
+        @param post_keys: list of keys of BlogPost entities
+        @param user_name: the user name to check, None if no user is logged in
+        @return: set of the keys of the posts the user has liked
+        '''
+        return cls.liked_by_user_async(post_keys, user_name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def liked_by_user_async(cls, post_keys, user_name):
+        '''Tasklet version of liked_by_user.
+        @return: future of a set of the keys of the posts the user has liked
+        '''
+        if not user_name or not post_keys:
+            raise ndb.Return(set())
+        likes = yield ndb.get_multi_async([cls.like_key(post_key, user_name)
+                                           for post_key in post_keys])
+        raise ndb.Return(set(post_key for post_key, like
+                             in zip(post_keys, likes) if like is not None))
+
+    @classmethod
+    def count_likes(cls, post_key):
+        '''Returns the number of likes of a post.
+        @param post_key: the key of the BlogPost entity
+        '''
+        return cls.count_likes_async(post_key).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def count_likes_async(cls, post_key):
+        '''Tasklet version of count_likes.
+        @return: future of the int number of likes
+        '''
+        counts = yield ShardedCounter.get_counts_async(
+            [cls._counter_name(post_key)])
+        raise ndb.Return(counts[cls._counter_name(post_key)])
+
+    @classmethod
+    def _counter_name(cls, post_key):
+        '''Returns the name of the sharded counter of likes of a post.
+        '''
+        return ShardedCounter.name_for(post_key, LIKES_COUNTER)
+
+
+class HomeFeedEntry(object):
+    '''Read-only summary of a BlogPost used to render the home page without
+    loading the post entity itself. Exposes the same attribute names as a
+    BlogPost so templates can render either one.
+    Attributes:
+        key: the NDB key of the summarized BlogPost
+        post_subject: subject of the post
+        post_excerpt: the start of the content of the post
+        content_length: the length of the full content of the post
+        post_author: user name of the post's author
+    '''
+
+    def __init__(self, summary):
+        '''
+        @param summary: a dict created by HomeFeedEntry.summarize
+        '''
+        self.key = ndb.Key(urlsafe=summary["key"])
+        self.post_subject = summary["post_subject"]
+        self.post_excerpt = summary["post_excerpt"]
+        self.content_length = summary["content_length"]
+        self.post_author = summary["post_author"]
+
+    @classmethod
+    def summarize(cls, post_entity):
+        '''Returns the JSON-serializable summary of a post stored in the feed.
+        @param post_entity: the BlogPost entity, full or projected, to
+        summarize
+        '''
+        return dict(key=post_entity.key.urlsafe(),
+                    post_subject=post_entity.post_subject,
+                    post_excerpt=post_entity.post_excerpt,
+                    content_length=post_entity.content_length,
+                    post_author=post_entity.post_author)
+
+
+class HomeFeed(object):
+    '''The materialized first page of the home page: summaries of the most
+    recent blog posts and the cursor of the page following them, held in
+    memcache so a home page view costs one cache read. The feed is built
+    from a projection query of the most recent posts, which is also its
+    fallback when the cached copy is lost. Creating, editing or deleting a
+    post updates the cached copy with compare-and-set after the write
+    commits. No datastore entity backs the feed, so post writes never
+    contend on a shared entity group, and an update that fails only drops
+    the cached copy, which the next read rebuilds from the query.
+    '''
+
+    @classmethod
+    def recent_posts(cls):
+        '''Returns up to the HOME_FEED_SIZE most recent blog posts.
+        @return: list of HomeFeedEntry instances, most recent first
+        '''
+        return cls.first_page()[0]
+
+    @classmethod
+    def first_page(cls):
+        '''Returns the first page of the home page, reading from memcache
+        first and rebuilding the feed from a query only if it is not cached.
+        @return: tuple of a list of HomeFeedEntry instances, most recent first,
+        and the url-safe cursor str of the next page or None
+        '''
+        feed_data = memcache.get(HOME_FEED_CACHE_KEY)
+        if feed_data is None:
+            feed_data = cls._query_feed()
+            # add, so a feed updated by a write meanwhile is kept
+            memcache.add(HOME_FEED_CACHE_KEY, feed_data, HOME_FEED_CACHE_SECS)
+        entries = [HomeFeedEntry(entry) for entry in feed_data["entries"]]
+        return entries, feed_data["next_cursor"] or None
+
+    @classmethod
+    def rebuild(cls):
+        '''Rebuilds the cached feed from a query of the most recent posts.
+        @return: the feed data dict cached
+        '''
+        feed_data = cls._query_feed()
+        memcache.set(HOME_FEED_CACHE_KEY, feed_data, HOME_FEED_CACHE_SECS)
+        ContentVersion.bump(bc.HOME_CONTENT_ID)
+        return feed_data
+
+    @classmethod
+    def add_post(cls, post_entity):
+        '''Adds a newly created post to the front of the feed. The feed is
+        queried again for the cursor of the following page, and the post is
+        put in front if the query does not return it yet.
+        @param post_entity: the BlogPost entity that was created
+        '''
+        summary = HomeFeedEntry.summarize(post_entity)
+
+        def _add(dummy_feed_data):
+            feed_data = cls._query_feed()
+            if all(entry["key"] != summary["key"]
+                   for entry in feed_data["entries"]):
+                feed_data["entries"] = ([summary] +
+                                        feed_data["entries"])[:HOME_FEED_SIZE]
+            return feed_data
+        cls._change_feed(_add)
+
+    @classmethod
+    def update_post(cls, post_entity):
+        '''Replaces the summary of an edited post if it is in the feed.
+        @param post_entity: the BlogPost entity that was edited
+        '''
+        summary = HomeFeedEntry.summarize(post_entity)
+
+        def _update(feed_data):
+            feed_data = feed_data or cls._query_feed()
+            feed_data["entries"] = [summary if entry["key"] == summary["key"]
+                                    else entry
+                                    for entry in feed_data["entries"]]
+            return feed_data
+        cls._change_feed(_update)
+
+    @classmethod
+    def remove_post(cls, post_entity):
+        '''Removes a deleted post from the feed. The feed is queried again,
+        so it is refilled to HOME_FEED_SIZE posts.
+        @param post_entity: the BlogPost entity that was deleted
+        '''
+        cls._change_feed(lambda dummy_feed_data: cls._query_feed(
+            exclude_key=post_entity.key))
+
+    @classmethod
+    def _query_feed(cls, exclude_key=None):
+        '''Returns the feed data dict built from a query of the most recent
+        posts.
+        @param exclude_key: optional key of a post to leave out of the feed,
+        used when the post has just been deleted and may still be returned by
+        an eventually consistent query.
+        '''
+        recent_posts, next_cursor = BlogPost.recent_posts_page(None)
+        return dict(entries=[HomeFeedEntry.summarize(post)
+                             for post in recent_posts
+                             if post.key != exclude_key],
+                    next_cursor=next_cursor or "")
+
+    @classmethod
+    def _change_feed(cls, change_fun):
+        '''Applies a change to the cached feed with compare-and-set, retrying
+        when another write changes it first. If the change fails or cannot be
+        stored, the cached copy is dropped instead, since the post write has
+        already committed.
+        @param change_fun: function taking the cached feed data dict, or None
+        if the feed is not cached, and returning the changed feed data dict
+        '''
+        client = memcache.Client()
+        stored = False
+        try:
+            for dummy_try in range(HOME_FEED_CAS_RETRIES):
+                feed_data = client.gets(HOME_FEED_CACHE_KEY)
+                changed = change_fun(feed_data)
+                if feed_data is None:
+                    stored = client.add(HOME_FEED_CACHE_KEY, changed,
+                                        HOME_FEED_CACHE_SECS)
+                else:
+                    stored = client.cas(HOME_FEED_CACHE_KEY, changed,
+                                        HOME_FEED_CACHE_SECS)
+                if stored:
+                    break
+        except Exception:
+            logging.exception("Home feed update failed")
+        if not stored:
+            client.delete(HOME_FEED_CACHE_KEY)
+        ContentVersion.bump(bc.HOME_CONTENT_ID)
+
 
 class Comment(ndb.Model):
     '''NDB entity model representing a comment made on a blog post.
-    Parent is a BlogPost entity.
+    Parent is a BlogPost entity. Its integer id is allocated by the datastore.
     Attributes:
         content: the text of a comment
         date_created: the date the comment was created
@@ -239,24 +810,43 @@ class Comment(ndb.Model):
         @param form_data: dict keyed to global constant containing the
         content of this comment
         '''
+        return cls.create_new_comment_async(user_name, url_string,
+                                            form_data).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def create_new_comment_async(cls, user_name, url_string, form_data):
+        '''Tasklet version of create_new_comment. The comment and the post's
+        comment counters are written in one cross-group transaction, so they
+        commit together.
+        @return: future of the key of the new Comment entity
+        '''
         parent_key = ndb.Key(urlsafe=url_string)
-        parent_post = parent_key.get()
-        new_comment = Comment(content=form_data.get(bh.CONTENT),
+        comment_ids = yield cls.allocate_ids_async(size=1, parent=parent_key)
+        new_comment = Comment(content=form_data.get(bc.CONTENT),
                               author=user_name,
                               parent=parent_key)
-        comment_num = BlogPost.incr_comments_made(parent_post)
-        new_comment.key = ndb.Key("Comment", str(comment_num),
-                                  parent=parent_key)
-        new_comment.put()
-        return new_comment.key
+        new_comment.key = cls.get_comment_key(comment_ids[0], parent_key)
+        yield cls._put_comment_txn_async(new_comment)
+        ContentVersion.bump(parent_key)
+        raise ndb.Return(new_comment.key)
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _put_comment_txn_async(cls, comment_entity):
+        '''Writes a new comment and increments its post's comment counters.
+        '''
+        yield comment_entity.put_async(), BlogPost.incr_comments_made_async(
+            comment_entity.key.parent())
 
     @classmethod
     def get_comment_key(cls, comment_num, post_key):
         '''Returns the a comment entity's key.
-        @param comment_num: unique string number of this coment
+        @param comment_num: unique number of this coment, allocated by the
+        datastore; an int or a str of digits
         @param post_key: the key of the BlogPost parent of this comment
         '''
-        return ndb.Key("Comment", str(comment_num), parent=post_key)
+        return ndb.Key("Comment", int(comment_num), parent=post_key)
 
     @classmethod
     def entity_from_uri(cls, comment_uri_key):
@@ -275,8 +865,9 @@ class Comment(ndb.Model):
         @param form_data: dict keyed to global constant containing updated
         content.
         '''
-        comment_entity.content = form_data[bh.CONTENT]
+        comment_entity.content = form_data[bc.CONTENT]
         comment_entity.put()
+        ContentVersion.bump(comment_entity.key.parent())
         return comment_entity
 
     @classmethod
@@ -285,8 +876,39 @@ class Comment(ndb.Model):
         Deletes the comment and decrements the number of comments currently
         outstanding for its parent post.
         '''
-        parent_post = comment_entity.key.parent().get()
-        parent_post.cur_num_comments -= 1
-        assert parent_post.cur_num_comments >= 0, "Num comments can't be < 0."
-        comment_entity.key.delete()
-        parent_post.put()
+        cls.delete_comment_async(comment_entity).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def delete_comment_async(cls, comment_entity):
+        '''Tasklet version of delete_comment. The delete and the counter
+        update are made in one cross-group transaction.
+        '''
+        post_key = comment_entity.key.parent()
+        yield cls._delete_comment_txn_async(comment_entity.key)
+        ContentVersion.bump(post_key)
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _delete_comment_txn_async(cls, comment_key):
+        '''Deletes a comment and decrements its post's comment counter.
+        '''
+        yield (comment_key.delete_async(),
+               BlogPost.incr_cur_num_comments_async(comment_key.parent(), -1))
+
+
+def _cursor_from_str(cursor_str):
+    '''Returns the query cursor for a url-safe cursor str, or None if no cursor
+    str was given.
+    @raise BadValueError: if cursor_str is not a valid cursor
+    '''
+    if cursor_str:
+        return Cursor(urlsafe=cursor_str)
+
+
+def _cursor_to_str(cursor, more):
+    '''Returns the url-safe str of a query cursor returned by fetch_page, or
+    None if there are no more results after it.
+    '''
+    if cursor and more:
+        return cursor.urlsafe()
@@ -0,0 +1,89 @@
+'''
+On-demand profiling of live requests. Handler dispatch is run under cProfile
+for a sample of requests, or for single requests sent by an admin with the
+profiling header, and the stats are aggregated per route. The cumulative
+hotspots of each route are shown at the admin-only /_admin/profiles page.
+
+Profiles are held in memory and so are per instance. When profiling is
+off, the cost per request is one setting lookup and one header lookup.
+
+Created on Jul 19, 2017
+@author: kennethalamantia
+'''
+
+import cProfile
+import pstats
+import random
+import threading
+from cStringIO import StringIO
+from google.appengine.api import users
+import blog_config
+
+
+class RouteProfiles(object):
+    '''Class aggregating the profiles of requests per route.
+    Attributes:
+        _stats: dict of pstats.Stats keyed by route name
+        _num_requests: dict of the number of profiled requests keyed by route
+                       name
+        _lock: lock guarding the other attributes
+    '''
+
+    _stats = {}
+    _num_requests = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def should_profile(cls, request):
+        '''Should a request be profiled?
+        @param request: the webapp2 request
+        '''
+        if (request.headers.get(blog_config.PROFILE_HEADER) and
+                users.is_current_user_admin()):
+            return True
+        return (blog_config.PROFILING_ENABLED and
+                random.random() < blog_config.PROFILE_SAMPLE_RATE)
+
+    @classmethod
+    def profile(cls, route_name, fun, *args, **kwargs):
+        '''Calls a function under cProfile and adds its stats to a route's.
+        @param route_name: the name of the route being served
+        @param fun: the function to call
+        @return: the function's return value
+        '''
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fun, *args, **kwargs)
+        finally:
+            stats = pstats.Stats(profile)
+            with cls._lock:
+                if route_name in cls._stats:
+                    cls._stats[route_name].add(stats)
+                else:
+                    cls._stats[route_name] = stats
+                cls._num_requests[route_name] = (
+                    cls._num_requests.get(route_name, 0) + 1)
+
+    @classmethod
+    def report(cls, top_n=blog_config.PROFILE_TOP_N):
+        '''Returns the top cumulative hotspots of each profiled route.
+        @param top_n: the number of functions to list per route
+        @return: str report
+        '''
+        out = StringIO()
+        with cls._lock:
+            for route_name in sorted(cls._stats):
+                out.write("=== %s: %d requests ===\n" % (
+                    route_name, cls._num_requests[route_name]))
+                cls._stats[route_name].stream = out
+                cls._stats[route_name].sort_stats("cumulative").print_stats(
+                    top_n)
+        return out.getvalue()
+
+    @classmethod
+    def clear(cls):
+        '''Discards every profile.
+        '''
+        with cls._lock:
+            cls._stats.clear()
+            cls._num_requests.clear()
@@ -0,0 +1,176 @@
+'''
+Per-request accounting of App Engine API calls. Counts the datastore gets,
+puts, queries and deletes and the memcache hits and misses made while serving
+a request, and the wall time spent in each kind of call.
+
+RpcAccountingMiddleware wraps a WSGI application, logs one JSON line of
+stats per request and, if blog_config.RPC_DEBUG_HEADER is set, adds them to
+the response in the X-RPC-Stats header. The measure context manager counts
+the calls made by any block of code, e.g. in tests.
+
+Created on Jul 18, 2017
+@author: kennethalamantia
+'''
+
+import json
+import logging
+import threading
+import timeit
+from contextlib import contextmanager
+from google.appengine.api import apiproxy_stub_map
+import blog_config
+
+# Accounting constants
+HOOK_NAME = "rpc_accounting"
+STATS_HEADER = "X-RPC-Stats"
+LOG_PREFIX = "rpc_stats "
+
+# Call categories, keyed by (service, call)
+CATEGORIES = {
+    ("datastore_v3", "Get"): "datastore_get",
+    ("datastore_v3", "Put"): "datastore_put",
+    ("datastore_v3", "RunQuery"): "datastore_query",
+    ("datastore_v3", "Next"): "datastore_query",
+    ("datastore_v3", "Delete"): "datastore_delete",
+    ("memcache", "Get"): "memcache_get",
+    }
+OTHER_CATEGORY = "other"
+
+_local = threading.local()
+
+
+class RpcStats(object):
+    '''Class holding the API call counts of one request.
+    Attributes:
+        calls: dict of the number of calls keyed by category
+        millis: dict of the wall time in ms spent in calls keyed by category
+        memcache_hits: the number of keys found by memcache gets
+        memcache_misses: the number of keys not found by memcache gets
+        _starts: dict of call start times keyed by id of the call's request
+    '''
+
+    def __init__(self):
+        self.calls = {}
+        self.millis = {}
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+        self._starts = {}
+
+    def count(self, category):
+        '''Returns the number of calls made in a category.
+        '''
+        return self.calls.get(category, 0)
+
+    def as_dict(self):
+        '''Returns the stats as a dict fit for JSON.
+        '''
+        millis = dict((category, round(category_millis, 1))
+                      for category, category_millis in self.millis.iteritems())
+        return {"calls": self.calls,
+                "millis": millis,
+                "memcache_hits": self.memcache_hits,
+                "memcache_misses": self.memcache_misses}
+
+    def as_header(self):
+        '''Returns the stats in the compact format of the debug header, e.g.
+        "datastore_get=2/3.1ms; memcache_hits=4".
+        '''
+        parts = ["%s=%d/%.1fms" % (category, self.calls[category],
+                                   self.millis.get(category, 0.0))
+                 for category in sorted(self.calls)]
+        parts.append("memcache_hits=%d" % self.memcache_hits)
+        parts.append("memcache_misses=%d" % self.memcache_misses)
+        return "; ".join(parts)
+
+    def _started(self, request):
+        '''Records the start time of a call.
+        '''
+        self._starts[id(request)] = timeit.default_timer()
+
+    def _finished(self, service, call, request, response):
+        '''Counts a finished call, and the memcache hits and misses of gets.
+        @param response: the call's response, or None if the call failed
+        '''
+        category = CATEGORIES.get((service, call), OTHER_CATEGORY)
+        self.calls[category] = self.calls.get(category, 0) + 1
+        start = self._starts.pop(id(request), None)
+        if start is not None:
+            self.millis[category] = (self.millis.get(category, 0.0) +
+                                     (timeit.default_timer() - start) * 1000)
+        if category == "memcache_get" and response is not None:
+            hits = response.item_size()
+            self.memcache_hits += hits
+            self.memcache_misses += request.key_size() - hits
+
+
+def _pre_call_hook(service, call, request, response):
+    '''Records the start of an API call made by the current thread.
+    '''
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats._started(request)
+
+
+def _post_call_hook(service, call, request, response, rpc=None, error=None):
+    '''Counts an API call made by the current thread.
+    '''
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats._finished(service, call, request,
+                        response if error is None else None)
+
+
+def _install_hooks():
+    '''Installs the call hooks on the current API proxy. The proxy is looked
+    up on every request since test beds replace it; hooks already installed
+    under HOOK_NAME are left as they are.
+    '''
+    proxy = apiproxy_stub_map.apiproxy
+    proxy.GetPreCallHooks().Append(HOOK_NAME, _pre_call_hook)
+    proxy.GetPostCallHooks().Append(HOOK_NAME, _post_call_hook)
+
+
+@contextmanager
+def measure():
+    '''Context manager counting the API calls made by the current thread
+    inside its block.
+    @return: the RpcStats of the block
+    '''
+    _install_hooks()
+    previous = getattr(_local, "stats", None)
+    _local.stats = RpcStats()
+    try:
+        yield _local.stats
+    finally:
+        _local.stats = previous
+
+
+class RpcAccountingMiddleware(object):
+    '''WSGI middleware counting the API calls made while serving each
+    request. Calls made while a streamed response is iterated are logged but
+    come too late for the debug header.
+    Attributes:
+        _app: the wrapped WSGI application
+    '''
+
+    def __init__(self, app):
+        self._app = app
+
+    def __call__(self, environ, start_response):
+        start = timeit.default_timer()
+        with measure() as stats:
+
+            def _start_response(status, headers, exc_info=None):
+                if blog_config.RPC_DEBUG_HEADER:
+                    headers = headers + [(STATS_HEADER, stats.as_header())]
+                return start_response(status, headers, exc_info)
+            try:
+                for chunk in self._app(environ, _start_response):
+                    yield chunk
+            finally:
+                record = stats.as_dict()
+                record.update(path=environ.get("PATH_INFO", ""),
+                              method=environ.get("REQUEST_METHOD", ""),
+                              wall_millis=round(
+                                  (timeit.default_timer() - start) * 1000, 1))
+                logging.info(LOG_PREFIX + json.dumps(record, sort_keys=True))
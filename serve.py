@@ -0,0 +1,525 @@
+'''
+Serves the blog-engine outside of App Engine, e.g. on a self-hosted Linux
+box, from a pre-forking server:
+
+    python serve.py [--port 8080] [--workers 1] [--threads 8]
+                    [--backend ndb] [--storage-path blog.sqlite3]
+                    [--datastore-path blog.datastore]
+                    [--cache-path /dev/shm/blog-engine-memcache.sqlite3]
+                    [--task-path blog.tasks.sqlite3]
+
+The master process opens the listening socket and forks the workers, which
+accept connections from it and serve each one on a pool of threads. It
+restarts workers that die, and on SIGHUP reloads gracefully: new workers
+importing the current code are started before the old ones are stopped.
+With a single process backend, the old worker is stopped and has finished
+its requests before the new one is started, so only one process at a time
+ever updates the data.
+SIGTERM or SIGINT stops the server. Stopped workers finish the requests
+they have accepted first.
+
+The app's data is kept by the --backend of blog_storage:
+    ndb - the datastore. The SDK's stub detects conflicting transactions
+          within one process only, so this backend is served by a single
+          worker, which scales with --threads.
+    sqlite - a SQLite database on --storage-path. Its transactions lock the
+             file, so any number of workers can share it.
+    memory - the memory of a single worker, lost when it stops.
+
+Each worker registers App Engine API stubs from the SDK, which must be on
+the PYTHONPATH:
+    datastore - the SDK's SQLite stub on --datastore-path
+    memcache - a SharedMemcacheStub on --cache-path, shared by all workers
+    taskqueue - a stub in the worker's memory. A thread of the worker moves
+                the deferred tasks queued there to a SQLite database on
+                --task-path, shared by all workers, and runs them from it.
+                Failed tasks are retried with exponential backoff until
+                they succeed or raise deferred.PermanentTaskFailure, and
+                tasks left by a worker that stopped are run by another.
+No user is ever signed in to the users API, so the admin pages are closed.
+
+Created on Jul 22, 2017
+@author: kennethalamantia
+'''
+
+import argparse
+import errno
+import logging
+import os
+import Queue
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+# Server defaults
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 8080
+# One worker, as the datastore of the default backend is local to a process
+DEFAULT_WORKERS = 1
+DEFAULT_THREADS = 8
+DEFAULT_BACKEND = "ndb"
+DEFAULT_STORAGE_PATH = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "blog.sqlite3")
+DEFAULT_DATASTORE_PATH = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "blog.datastore")
+DEFAULT_TASK_PATH = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "blog.tasks.sqlite3")
+# Backends whose data only one process can safely update
+SINGLE_PROCESS_BACKENDS = ("ndb", "memory")
+APP_ID = "dev~blog-engine"
+# Starts with blog_config.SELF_HOSTED_SOFTWARE, so the app runs with its
+# production settings
+SERVER_SOFTWARE = "blog-engine serve.py/1.0"
+LISTEN_BACKLOG = 1024
+REQUEST_TIMEOUT_SECS = 30
+# Seconds stopped workers are given to finish their requests
+GRACEFUL_TIMEOUT_SECS = 30
+MASTER_POLL_SECS = 0.5
+WORKER_POLL_SECS = 0.5
+
+# Deferred task settings
+TASK_POLL_SECS = 1.0
+DEFAULT_QUEUE = "default"
+# Seconds a running task is hidden from the other workers, after which a
+# task whose worker died is run again
+TASK_LEASE_SECS = 600
+TASK_MIN_BACKOFF_SECS = 1.0
+TASK_MAX_BACKOFF_SECS = 3600.0
+TASK_DB_TIMEOUT_SECS = 30
+TASK_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload BLOB NOT NULL,
+    retries INTEGER NOT NULL DEFAULT 0,
+    eta REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS tasks_by_eta ON tasks (eta);
+'''
+SQL_INSERT_TASK = "INSERT INTO tasks (payload, eta) VALUES (?, ?)"
+SQL_DUE_TASKS = ("SELECT task_id, payload, retries FROM tasks "
+                 "WHERE eta <= ? ORDER BY eta")
+SQL_LEASE_TASK = "UPDATE tasks SET eta = ? WHERE task_id = ? AND eta <= ?"
+SQL_RETRY_TASK = "UPDATE tasks SET retries = ?, eta = ? WHERE task_id = ?"
+SQL_DELETE_TASK = "DELETE FROM tasks WHERE task_id = ?"
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    '''Request handler logging requests through the logging module rather
+    than to stderr.
+    '''
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.client_address[0], format % args)
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    '''WSGI server accepting connections from a socket opened by another
+    process and serving them on a fixed pool of threads.
+    Attributes:
+        _requests: queue of accepted connections waiting for a thread
+        _threads: list of the pool's threads
+    '''
+
+    def __init__(self, listen_socket, app, num_threads):
+        WSGIServer.__init__(self, listen_socket.getsockname(),
+                            QuietRequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listen_socket
+        self.server_bind()
+        self.set_app(app)
+        self._requests = Queue.Queue()
+        self._threads = [threading.Thread(target=self._serve_requests)
+                         for dummy_idx in range(num_threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def server_bind(self):
+        '''Sets up the server's environ for the inherited socket, which is
+        already bound and listening.
+        '''
+        host, port = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+
+    def get_request(self):
+        '''Accepts a connection, in blocking mode with a timeout. Raises
+        socket.error if another worker accepted it first.
+        '''
+        request, client_address = self.socket.accept()
+        request.settimeout(REQUEST_TIMEOUT_SECS)
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def drain(self):
+        '''Waits for the pool to serve every accepted connection, then stops
+        its threads. Call once serve_forever has returned.
+        '''
+        for dummy_thread in self._threads:
+            self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _serve_requests(self):
+        '''Serves connections from the queue until it yields None.
+        '''
+        while True:
+            queued = self._requests.get()
+            if queued is None:
+                return
+            request, client_address = queued
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def setup_stubs(datastore_path, cache_path):
+    '''Registers the App Engine API stubs of a worker process.
+    @param datastore_path: path of the SQLite datastore file
+    @param cache_path: path of the shared memcache database
+    '''
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import user_service_stub
+    from google.appengine.api.taskqueue import taskqueue_stub
+    from google.appengine.datastore import datastore_sqlite_stub
+    from google.appengine.datastore import datastore_stub_util
+    from shared_memcache import SharedMemcacheStub
+    os.environ.setdefault("APPLICATION_ID", APP_ID)
+    os.environ.setdefault("AUTH_DOMAIN", "gmail.com")
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        "datastore_v3", datastore_sqlite_stub.DatastoreSqliteStub(
+            os.environ["APPLICATION_ID"], datastore_path,
+            auto_id_policy=datastore_stub_util.SCATTERED))
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        "memcache", SharedMemcacheStub(cache_path))
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        "taskqueue", taskqueue_stub.TaskQueueServiceStub(
+            root_path=os.path.dirname(os.path.abspath(__file__))))
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        "user", user_service_stub.UserServiceStub())
+
+
+class TaskStore(object):
+    '''Deferred tasks kept in a SQLite database shared by the workers.
+    Attributes:
+        _conn: the connection to the database, used by a single thread
+    '''
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=TASK_DB_TIMEOUT_SECS)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.executescript(TASK_SCHEMA)
+
+    def add(self, payload, eta):
+        '''Stores a task.
+        @param payload: the str payload of the task
+        @param eta: unix time at which the task is due
+        '''
+        with self._conn:
+            self._conn.execute(SQL_INSERT_TASK, (sqlite3.Binary(payload),
+                                                 eta))
+
+    def lease_due(self):
+        '''Leases the tasks that are due to the calling worker. A task
+        leased by another worker first is left out.
+        @return: list of (task_id, payload, retries) tuples
+        '''
+        now = time.time()
+        leased = []
+        with self._conn:
+            for task_id, payload, retries in self._conn.execute(
+                    SQL_DUE_TASKS, (now,)).fetchall():
+                if self._conn.execute(SQL_LEASE_TASK,
+                                      (now + TASK_LEASE_SECS, task_id,
+                                       now)).rowcount:
+                    leased.append((task_id, str(payload), retries))
+        return leased
+
+    def retry(self, task_id, retries):
+        '''Makes a failed task due again after a backoff doubling with each
+        retry.
+        @param retries: the number of times the task has failed
+        @return: the float seconds until the task is due
+        '''
+        delay = min(TASK_MIN_BACKOFF_SECS * 2 ** (retries - 1),
+                    TASK_MAX_BACKOFF_SECS)
+        with self._conn:
+            self._conn.execute(SQL_RETRY_TASK,
+                               (retries, time.time() + delay, task_id))
+        return delay
+
+    def remove(self, task_id):
+        '''Deletes a task that is done.
+        '''
+        with self._conn:
+            self._conn.execute(SQL_DELETE_TASK, (task_id,))
+
+    def close(self):
+        self._conn.close()
+
+
+def run_deferred_tasks(stopped, task_path):
+    '''Moves the deferred tasks queued in this worker to the task database,
+    and runs the due tasks of all the workers, until stopped is set.
+    @param stopped: threading.Event set when the worker stops
+    @param task_path: path of the task database
+    '''
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.ext import deferred
+    taskqueue = apiproxy_stub_map.apiproxy.GetStub("taskqueue")
+    store = TaskStore(task_path)
+    try:
+        while not stopped.wait(TASK_POLL_SECS):
+            _store_queued_tasks(taskqueue, store)
+            for task_id, payload, retries in store.lease_due():
+                try:
+                    deferred.run(payload)
+                except deferred.PermanentTaskFailure:
+                    logging.exception("Deferred task %d failed permanently",
+                                      task_id)
+                    store.remove(task_id)
+                except Exception:
+                    delay = store.retry(task_id, retries + 1)
+                    logging.exception("Deferred task %d failed, retrying in "
+                                      "%.0f seconds", task_id, delay)
+                else:
+                    store.remove(task_id)
+        # Tasks queued by the last requests are run by the other workers
+        _store_queued_tasks(taskqueue, store)
+    finally:
+        store.close()
+
+
+def _store_queued_tasks(taskqueue, store):
+    '''Moves the tasks queued in the taskqueue stub to the task database.
+    '''
+    for task in taskqueue.get_filtered_tasks(queue_names=[DEFAULT_QUEUE]):
+        store.add(task.payload, task.eta_posix)
+        taskqueue.DeleteTask(DEFAULT_QUEUE, task.name)
+
+
+def worker_main(listen_socket, args):
+    '''Serves requests in a forked worker process until it is sent SIGTERM.
+    @param listen_socket: the master's listening socket
+    @param args: the parsed command line arguments
+    '''
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_stubs(args.datastore_path, args.cache_path)
+    import blog_storage
+    if args.backend == "sqlite":
+        blog_storage.set_app_backend(args.backend, path=args.storage_path)
+    else:
+        blog_storage.set_app_backend(args.backend)
+    import blog_app
+    server = ThreadPoolWSGIServer(listen_socket, blog_app.application,
+                                  args.threads)
+    stopped = threading.Event()
+    task_runner = threading.Thread(target=run_deferred_tasks,
+                                   args=(stopped, args.task_path))
+    task_runner.start()
+
+    def _stop(signum, frame):
+        # shutdown waits for serve_forever to return, so it cannot be
+        # called from the thread running it.
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, _stop)
+    try:
+        server.serve_forever(WORKER_POLL_SECS)
+    finally:
+        server.drain()
+        stopped.set()
+        task_runner.join()
+
+
+class Master(object):
+    '''Pre-forking master process, keeping a number of workers running.
+    Attributes:
+        _listen_socket: the listening socket the workers accept from
+        _args: the parsed command line arguments
+        _workers: set of the pids of the current workers
+        _retiring: set of the pids of workers being stopped
+        _reload: set by SIGHUP
+        _stopping: set by SIGTERM and SIGINT
+    '''
+
+    def __init__(self, listen_socket, args):
+        self._listen_socket = listen_socket
+        self._args = args
+        self._workers = set()
+        self._retiring = set()
+        self._reload = False
+        self._stopping = False
+
+    def run(self):
+        '''Runs the workers until the master is sent SIGTERM or SIGINT.
+        '''
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        self._spawn(self._args.workers)
+        while not self._stopping:
+            if self._reload:
+                self._reload = False
+                logging.info("Reloading %d workers", len(self._workers))
+                old_workers = self._workers
+                self._workers = set()
+                if self._args.backend in SINGLE_PROCESS_BACKENDS:
+                    self._retire(old_workers)
+                    self._wait_retired()
+                    self._spawn(self._args.workers)
+                else:
+                    self._spawn(self._args.workers)
+                    self._retire(old_workers)
+            self._reap()
+            time.sleep(MASTER_POLL_SECS)
+        self._retire(self._workers)
+        self._workers = set()
+        self._wait_retired()
+
+    def _spawn(self, num_workers):
+        '''Forks new workers.
+        '''
+        for dummy_idx in range(num_workers):
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    worker_main(self._listen_socket, self._args)
+                except Exception:
+                    logging.exception("Worker %d failed", os.getpid())
+                    status = 1
+                finally:
+                    os._exit(status)
+            self._workers.add(pid)
+
+    def _retire(self, pids):
+        '''Asks workers to finish their requests and exit.
+        '''
+        for pid in pids:
+            _kill(pid, signal.SIGTERM)
+        self._retiring.update(pids)
+
+    def _wait_retired(self):
+        '''Waits for the workers being stopped to exit, and kills those still
+        running after GRACEFUL_TIMEOUT_SECS.
+        '''
+        deadline = time.time() + GRACEFUL_TIMEOUT_SECS
+        while self._retiring and time.time() < deadline:
+            self._reap()
+            if self._retiring:
+                time.sleep(MASTER_POLL_SECS)
+        for pid in self._retiring:
+            _kill(pid, signal.SIGKILL)
+            try:
+                os.waitpid(pid, 0)
+            except OSError as error:
+                if error.errno != errno.ECHILD:
+                    raise
+        self._retiring.clear()
+
+    def _reap(self):
+        '''Collects exited workers, and replaces current workers that died.
+        '''
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+            elif pid in self._workers:
+                self._workers.discard(pid)
+                logging.warning("Worker %d exited with status %d, restarting",
+                                pid, status)
+                if not self._stopping:
+                    self._spawn(1)
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+
+def _kill(pid, signum):
+    '''Sends a signal to a process that may already have exited.
+    '''
+    try:
+        os.kill(pid, signum)
+    except OSError as error:
+        if error.errno != errno.ESRCH:
+            raise
+
+
+def main():
+    '''Parses the command line and runs the server.
+    @return: the int exit status
+    '''
+    parser = argparse.ArgumentParser(description="Pre-forking blog server")
+    parser.add_argument("--host", default=DEFAULT_HOST,
+                        help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="port to listen on")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of worker processes, only one for "
+                             "the ndb and memory backends")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS,
+                        help="number of threads per worker")
+    parser.add_argument("--backend", default=DEFAULT_BACKEND,
+                        choices=("ndb", "sqlite", "memory"),
+                        help="storage backend of the app's data")
+    parser.add_argument("--storage-path", default=DEFAULT_STORAGE_PATH,
+                        help="path of the sqlite backend's database")
+    parser.add_argument("--datastore-path", default=DEFAULT_DATASTORE_PATH,
+                        help="path of the SQLite datastore file")
+    parser.add_argument("--cache-path", default=None,
+                        help="path of the shared memcache database")
+    parser.add_argument("--task-path", default=DEFAULT_TASK_PATH,
+                        help="path of the deferred task database")
+    parser.add_argument("--debug", action="store_true",
+                        help="run with development settings")
+    args = parser.parse_args()
+    if args.workers > 1 and args.backend in SINGLE_PROCESS_BACKENDS:
+        parser.error("the %s backend is served by one worker; scale it with "
+                     "--threads, or use --backend sqlite" % args.backend)
+    if args.cache_path is None:
+        from shared_memcache import DEFAULT_CACHE_PATH
+        args.cache_path = DEFAULT_CACHE_PATH
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format="%(asctime)s %(process)d %(levelname)s "
+                               "%(message)s")
+    if not args.debug:
+        # Read by blog_config when the workers import the app
+        os.environ["SERVER_SOFTWARE"] = SERVER_SOFTWARE
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((args.host, args.port))
+    listen_socket.listen(LISTEN_BACKLOG)
+    # Workers wait for connections with select, and all of them wake up for
+    # each one, so accept must not block the workers that lose the race.
+    listen_socket.setblocking(0)
+    logging.info("Serving on %s:%d with %d workers of %d threads, on the %s "
+                 "backend", args.host, args.port, args.workers, args.threads,
+                 args.backend)
+    Master(listen_socket, args).run()
+    listen_socket.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
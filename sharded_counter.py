@@ -0,0 +1,219 @@
+'''
+Sharded counters for values that are updated faster than a single datastore
+entity can be written, such as the number of comments on a popular post.
+
+Each counter is split across a configurable number of CounterShard entities.
+An increment transactionally updates one randomly chosen shard, and the total
+is the sum of all shards, cached in memcache. Increments invalidate the cached
+total once they commit, locking it briefly so that a read which summed the
+shards before the commit cannot cache its stale total. Reads and increments have
+tasklet variants, so that they can overlap other datastore calls.
+
+Created on Jun 30, 2017
+@author: kennethalamantia
+'''
+
+import random
+from functools import partial
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# Counter constants
+DEFAULT_NUM_SHARDS = 10
+COUNT_CACHE_PREFIX = "counter:"
+COUNT_CACHE_SECS = 60
+# Seconds a cached total stays locked against adds after it is invalidated
+COUNT_LOCK_SECS = 2
+
+
+class CounterConfig(ndb.Model):
+    '''NDB class holding the configuration of a single named counter. Keyed by
+    the name of the counter. Counters without a config entity use
+    DEFAULT_NUM_SHARDS shards.
+    Attributes:
+        num_shards: the number of shards the counter is split across
+    '''
+
+    num_shards = ndb.IntegerProperty(default=DEFAULT_NUM_SHARDS)
+
+
+class CounterShard(ndb.Model):
+    '''NDB class holding one shard of a named counter. Keyed by the name of
+    the counter and the index of the shard.
+    Attributes:
+        count: this shard's part of the counter's total
+    '''
+
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class ShardedCounter(object):
+    '''Class providing methods to read, increment and configure sharded
+    counters. Counters are identified by a str name, see name_for.
+    '''
+
+    @classmethod
+    def name_for(cls, entity_key, field_name):
+        '''Returns the name of a counter belonging to a datastore entity.
+        @param entity_key: the NDB key of the entity owning the counter
+        @param field_name: the name of the counted value, e.g. "likes"
+        '''
+        return entity_key.urlsafe() + ":" + field_name
+
+    @classmethod
+    def get_count(cls, name):
+        '''Returns the total of a counter.
+        @param name: the name of the counter
+        '''
+        return cls.get_counts([name])[name]
+
+    @classmethod
+    def get_counts(cls, names):
+        '''Returns the totals of several counters, reading memcache with one
+        batch call and summing the shards of any counters missing from it with
+        one batch datastore get.
+        @param names: list of counter names
+        @return: dict of totals keyed by counter name
+        '''
+        return cls.get_counts_async(names).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_counts_async(cls, names):
+        '''Tasklet version of get_counts. Concurrent memcache and datastore
+        reads are batched by the NDB context.
+        @param names: list of counter names
+        @return: future of a dict of totals keyed by counter name
+        '''
+        context = ndb.get_context()
+        cached = yield [context.memcache_get(COUNT_CACHE_PREFIX + name)
+                        for name in names]
+        counts = dict((name, count) for name, count in zip(names, cached)
+                      if count is not None)
+        missing = [name for name in names if name not in counts]
+        if missing:
+            num_shards = yield cls._num_shards_async(missing)
+            shard_keys = dict((name, cls._all_shard_keys(name, shards_of_name))
+                              for name, shards_of_name
+                              in num_shards.iteritems())
+            all_keys = [key for keys in shard_keys.values() for key in keys]
+            shard_entities = yield ndb.get_multi_async(all_keys)
+            shards = dict(zip(all_keys, shard_entities))
+            to_cache = {}
+            for name, keys in shard_keys.iteritems():
+                counts[name] = sum(shards[key].count for key in keys
+                                   if shards[key] is not None)
+                to_cache[COUNT_CACHE_PREFIX + name] = counts[name]
+            # Adds fail while an increment's invalidation holds the lock.
+            yield [context.memcache_add(cache_key, count, COUNT_CACHE_SECS)
+                   for cache_key, count in to_cache.iteritems()]
+        raise ndb.Return(counts)
+
+    @classmethod
+    def increment(cls, name, delta=1):
+        '''Adds to a counter by updating one randomly chosen shard. Runs in its
+        own transaction, or joins the caller's transaction if there is one.
+        The cached total is invalidated once the transaction commits.
+        @param name: the name of the counter
+        @param delta: the int amount to add, negative to subtract
+        '''
+        cls.increment_async(name, delta).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def increment_async(cls, name, delta=1):
+        '''Tasklet version of increment.
+        @param name: the name of the counter
+        @param delta: the int amount to add, negative to subtract
+        @return: future that completes once the shard is written
+        '''
+        num_shards = yield cls._num_shards_async([name])
+        shard_key = ndb.Key(CounterShard,
+                            cls._shard_id(name, random.randint(
+                                0, num_shards[name] - 1)))
+        yield cls._increment_shard_async(shard_key, delta)
+        ndb.get_context().call_on_commit(
+            partial(cls._invalidate_cached_count, name))
+
+    @classmethod
+    def increase_shards(cls, name, num_shards):
+        '''Increases the number of shards of a counter. The number of shards
+        can never decrease, since every shard is summed when reading.
+        @param name: the name of the counter
+        @param num_shards: the new number of shards
+        '''
+        def _txn():
+            config = CounterConfig.get_or_insert(name)
+            if config.num_shards < num_shards:
+                config.num_shards = num_shards
+                config.put()
+        ndb.transaction(_txn)
+
+    @classmethod
+    def delete_counters(cls, names):
+        '''Deletes the shards, configs and cached totals of several counters.
+        @param names: list of counter names
+        '''
+        keys = []
+        for name, num_shards in cls._num_shards(names).iteritems():
+            keys.extend(cls._all_shard_keys(name, num_shards))
+            keys.append(ndb.Key(CounterConfig, name))
+        ndb.delete_multi(keys)
+        memcache.delete_multi([COUNT_CACHE_PREFIX + name for name in names])
+
+    @classmethod
+    @ndb.transactional_tasklet(propagation=ndb.TransactionOptions.ALLOWED)
+    def _increment_shard_async(cls, shard_key, delta):
+        '''Reads and updates a single shard.
+        @param shard_key: the NDB key of the CounterShard entity
+        @param delta: the int amount to add
+        '''
+        shard = yield shard_key.get_async()
+        if shard is None:
+            shard = CounterShard(key=shard_key)
+        shard.count += delta
+        yield shard.put_async()
+
+    @classmethod
+    def _num_shards(cls, names):
+        '''Returns the number of shards of several counters.
+        @param names: list of counter names
+        @return: dict of numbers of shards keyed by counter name
+        '''
+        return cls._num_shards_async(names).get_result()
+
+    @classmethod
+    @ndb.non_transactional
+    @ndb.tasklet
+    def _num_shards_async(cls, names):
+        '''Tasklet version of _num_shards. Reads outside of any transaction so
+        that configs never join the caller's transaction.
+        @param names: list of counter names
+        @return: future of a dict of numbers of shards keyed by counter name
+        '''
+        configs = yield ndb.get_multi_async([ndb.Key(CounterConfig, name)
+                                             for name in names])
+        raise ndb.Return(dict((name, config.num_shards if config else
+                               DEFAULT_NUM_SHARDS)
+                              for name, config in zip(names, configs)))
+
+    @classmethod
+    def _all_shard_keys(cls, name, num_shards):
+        '''Returns the keys of every shard of a counter.
+        '''
+        return [ndb.Key(CounterShard, cls._shard_id(name, index))
+                for index in range(num_shards)]
+
+    @classmethod
+    def _shard_id(cls, name, index):
+        '''Returns the str id of a shard of a counter.
+        '''
+        return name + "-" + str(index)
+
+    @classmethod
+    def _invalidate_cached_count(cls, name):
+        '''Deletes the cached total of a counter and locks it against adds
+        for COUNT_LOCK_SECS. The total is recomputed from the shards on the
+        next read after the lock expires.
+        '''
+        memcache.delete(COUNT_CACHE_PREFIX + name, seconds=COUNT_LOCK_SECS)
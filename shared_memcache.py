@@ -0,0 +1,301 @@
+'''
+Memcache API stub whose cache is shared by every process on a host. Entries
+are kept in a SQLite database, by default in /dev/shm so it lives in shared
+memory. serve.py registers it in each of its worker processes in place of the
+App Engine SDK's stub, whose cache is private to one process.
+
+It implements the calls the memcache client makes: Get (with cas ids), Set
+(set, add, replace and cas), Delete (with delete lock times), Increment,
+BatchIncrement, FlushAll and Stats. Hit and miss counts are per process.
+
+Like memcache, the cache is bounded: each write evicts the entries written
+before the last MAX_ENTRIES writes, oldest first. Reads do not record access
+times, so a get never needs the write lock.
+
+Created on Jul 22, 2017
+@author: kennethalamantia
+'''
+
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from google.appengine.api import apiproxy_stub
+from google.appengine.api.memcache import memcache_service_pb
+from google.appengine.runtime import apiproxy_errors
+
+# Shared cache settings
+DEFAULT_CACHE_PATH = "/dev/shm/blog-engine-memcache.sqlite3"
+SQLITE_TIMEOUT_SECS = 10.0
+# Expired entries are deleted by the first write after this interval.
+PURGE_INTERVAL_SECS = 60
+# Expiration times up to this many seconds are relative, larger ones are
+# unix timestamps, as in the memcache API.
+MAX_RELATIVE_EXPIRATION = 30 * 24 * 60 * 60
+MAX_INCR_VALUE = 2 ** 64
+# Each write evicts the entries older than the last MAX_ENTRIES writes.
+# Values are at most 1 MB, as in the memcache API.
+MAX_ENTRIES = 100000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL,
+    key BLOB NOT NULL,
+    value BLOB,
+    flags INTEGER NOT NULL DEFAULT 0,
+    cas_id INTEGER NOT NULL DEFAULT 0,
+    expires REAL,
+    PRIMARY KEY (namespace, key));
+'''
+# A row with a NULL value is a deleted key locked against add and replace
+# until it expires.
+SQL_GET = ("SELECT value, flags, cas_id, expires FROM cache "
+           "WHERE namespace = ? AND key = ?")
+SQL_PUT = ("INSERT OR REPLACE INTO cache (namespace, key, value, flags, "
+           "cas_id, expires) VALUES (?, ?, ?, ?, ?, ?)")
+SQL_DELETE = "DELETE FROM cache WHERE namespace = ? AND key = ?"
+SQL_PURGE = "DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?"
+SQL_FLUSH = "DELETE FROM cache"
+# INSERT OR REPLACE gives each write the next rowid, so rowids order entries
+# from oldest to newest write.
+SQL_EVICT = ("DELETE FROM cache WHERE rowid <= "
+             "(SELECT MAX(rowid) FROM cache) - ?")
+SQL_STATS = ("SELECT COUNT(*), COALESCE(SUM(LENGTH(key) + LENGTH(value)), 0) "
+             "FROM cache WHERE value IS NOT NULL AND "
+             "(expires IS NULL OR expires > ?)")
+
+SetRequest = memcache_service_pb.MemcacheSetRequest
+SetResponse = memcache_service_pb.MemcacheSetResponse
+DeleteResponse = memcache_service_pb.MemcacheDeleteResponse
+IncrementRequest = memcache_service_pb.MemcacheIncrementRequest
+IncrementResponse = memcache_service_pb.MemcacheIncrementResponse
+
+# Not seeded from the random module's state, which forked workers share.
+_cas_random = random.SystemRandom()
+
+
+class SharedMemcacheStub(apiproxy_stub.APIProxyStub):
+    '''Memcache service stub backed by a SQLite database shared between
+    processes. Each thread of each process has its own connection.
+    Attributes:
+        path: the path of the database file
+        max_entries: the number of entries kept before the oldest are
+                     evicted
+        _local: thread local holding each thread's connection and the pid it
+                was opened in
+        _hits: the number of keys found by gets in this process
+        _misses: the number of keys not found by gets in this process
+        _next_purge: the time expired entries are next deleted
+    '''
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, service_name="memcache",
+                 max_entries=MAX_ENTRIES):
+        super(SharedMemcacheStub, self).__init__(service_name)
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._hits = 0
+        self._misses = 0
+        self._next_purge = 0
+        with self._write() as conn:
+            conn.executescript(SCHEMA)
+
+    def _Dynamic_Get(self, request, response):
+        namespace = request.name_space()
+        now = time.time()
+        conn = self._connection()
+        for key in set(request.key_list()):
+            entry = self._get_entry(conn, namespace, key, now)
+            if entry is None or entry[0] is None:
+                self._misses += 1
+                continue
+            self._hits += 1
+            item = response.add_item()
+            item.set_key(key)
+            item.set_value(str(entry[0]))
+            item.set_flags(entry[1])
+            if request.for_cas():
+                item.set_cas_id(entry[2])
+
+    def _Dynamic_Set(self, request, response):
+        namespace = request.name_space()
+        now = time.time()
+        with self._write() as conn:
+            for item in request.item_list():
+                response.add_set_status(
+                    self._set_item(conn, namespace, item, now))
+            self._purge_expired(conn, now)
+
+    def _Dynamic_Delete(self, request, response):
+        namespace = request.name_space()
+        now = time.time()
+        with self._write() as conn:
+            for item in request.item_list():
+                entry = self._get_entry(conn, namespace, item.key(), now)
+                if entry is None or entry[0] is None:
+                    response.add_delete_status(DeleteResponse.NOT_FOUND)
+                    continue
+                if item.delete_time():
+                    conn.execute(SQL_PUT, (namespace,
+                                           sqlite3.Binary(item.key()), None,
+                                           0, 0, _expires(item.delete_time(),
+                                                          now)))
+                else:
+                    conn.execute(SQL_DELETE, (namespace,
+                                              sqlite3.Binary(item.key())))
+                response.add_delete_status(DeleteResponse.DELETED)
+
+    def _Dynamic_Increment(self, request, response):
+        try:
+            with self._write() as conn:
+                new_value = self._increment(conn, request.name_space(),
+                                            request, time.time())
+        except ValueError:
+            new_value = None
+        if new_value is None:
+            raise apiproxy_errors.ApplicationError(
+                memcache_service_pb.MemcacheServiceError.UNSPECIFIED_ERROR)
+        response.set_new_value(new_value)
+
+    def _Dynamic_BatchIncrement(self, request, response):
+        namespace = request.name_space()
+        now = time.time()
+        with self._write() as conn:
+            for item in request.item_list():
+                item_response = response.add_item()
+                try:
+                    new_value = self._increment(conn, namespace, item, now)
+                except ValueError:
+                    item_response.set_increment_status(IncrementResponse.ERROR)
+                    continue
+                if new_value is None:
+                    item_response.set_increment_status(
+                        IncrementResponse.NOT_CHANGED)
+                else:
+                    item_response.set_increment_status(IncrementResponse.OK)
+                    item_response.set_new_value(new_value)
+
+    def _Dynamic_FlushAll(self, request, response):
+        with self._write() as conn:
+            conn.execute(SQL_FLUSH)
+
+    def _Dynamic_Stats(self, request, response):
+        conn = self._connection()
+        items, size = conn.execute(SQL_STATS, (time.time(),)).fetchone()
+        stats = response.mutable_stats()
+        stats.set_hits(self._hits)
+        stats.set_misses(self._misses)
+        stats.set_byte_hits(0)
+        stats.set_items(items)
+        stats.set_bytes(size)
+        stats.set_oldest_item_age(0)
+
+    def _set_item(self, conn, namespace, item, now):
+        '''Stores one item of a Set request according to its set policy.
+        @return: the set status of the item
+        '''
+        entry = self._get_entry(conn, namespace, item.key(), now)
+        policy = item.set_policy()
+        if policy == SetRequest.ADD and entry is not None:
+            return SetResponse.NOT_STORED
+        if policy in (SetRequest.REPLACE, SetRequest.CAS) and (
+                entry is None or entry[0] is None):
+            return SetResponse.NOT_STORED
+        if policy == SetRequest.CAS and entry[2] != item.cas_id():
+            return SetResponse.EXISTS
+        conn.execute(SQL_PUT, (namespace, sqlite3.Binary(item.key()),
+                               sqlite3.Binary(item.value()), item.flags(),
+                               _new_cas_id(),
+                               _expires(item.expiration_time(), now)))
+        return SetResponse.STORED
+
+    def _increment(self, conn, namespace, request, now):
+        '''Applies one increment request.
+        @return: the new int value, or None if the key is not set and the
+        request has no initial value
+        @raise ValueError: if the stored value is not an int
+        '''
+        key = request.key()
+        entry = self._get_entry(conn, namespace, key, now)
+        if entry is None or entry[0] is None:
+            if not request.has_initial_value():
+                return None
+            value, flags = request.initial_value(), request.initial_flags()
+            expires = None
+        else:
+            value, flags, expires = int(str(entry[0])), entry[1], entry[3]
+        if request.direction() == IncrementRequest.INCREMENT:
+            value = (value + request.delta()) % MAX_INCR_VALUE
+        else:
+            value = max(0, value - request.delta())
+        conn.execute(SQL_PUT, (namespace, sqlite3.Binary(key),
+                               sqlite3.Binary(str(value)), flags,
+                               _new_cas_id(), expires))
+        return value
+
+    def _get_entry(self, conn, namespace, key, now):
+        '''Returns the (value, flags, cas_id, expires) row of a key, or None
+        if the key is not set or has expired.
+        '''
+        entry = conn.execute(SQL_GET, (namespace,
+                                       sqlite3.Binary(key))).fetchone()
+        if entry is None or (entry[3] is not None and entry[3] <= now):
+            return None
+        return entry
+
+    def _purge_expired(self, conn, now):
+        '''Deletes expired entries, at most once per PURGE_INTERVAL_SECS.
+        '''
+        if now >= self._next_purge:
+            self._next_purge = now + PURGE_INTERVAL_SECS
+            conn.execute(SQL_PURGE, (now,))
+
+    def _connection(self):
+        '''Returns the calling thread's connection, opening a new one if
+        there is none or the process has forked since it was opened.
+        '''
+        if getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT_SECS,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    @contextmanager
+    def _write(self):
+        '''Context manager running its block in a write transaction, which
+        locks out writers in other processes until it commits. Evicts the
+        oldest entries before committing if the cache has grown too large.
+        @return: the connection
+        '''
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute(SQL_EVICT, (self.max_entries,))
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def _expires(expiration_time, now):
+    '''Returns the unix time an entry expires at, or None if it never does.
+    @param expiration_time: the expiration time of a memcache request
+    '''
+    if not expiration_time:
+        return None
+    if expiration_time <= MAX_RELATIVE_EXPIRATION:
+        return now + expiration_time
+    return float(expiration_time)
+
+
+def _new_cas_id():
+    '''Returns a cas id for a newly written entry. Ids are random, so
+    processes never need to agree on a sequence.
+    '''
+    return _cas_random.getrandbits(63)
@@ -4,17 +4,39 @@ Created on Jan 30, 2017
 
 @author: kennethalamantia
 '''
+import hashlib
 import os
+import tempfile
+import time
 import unittest
+from email.utils import formatdate
 
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import memcache
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
+import jinja2
 import webapp2
 
+import benchmark_suite
+import blog_app
+import blog_config
 import blog_handler as blog
+import blog_storage
 import blog_utilities as util
+import corpus_generator
+import form_schema
+import fragment_cache
+import load_generator
+import ndb_models
+import profiler
+import rpc_accounting
+import serve
+import shared_memcache
+import sharded_counter
 import blog_handler
+from ndb_models import BlogPost, Comment, HomeFeed, Like, User
 from google.appengine.ext.db import SelfReference
 from cherrypy import response
 
@@ -30,7 +52,10 @@ class TestBlog(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
         ndb.get_context().set_cache_policy(False)
+        fragment_cache.FragmentCache.clear_local()
+        util.CookieUtil.clear_local()
 #         print os.environ['APPLICATION_ID']
 
     def tearDown(self):
@@ -54,14 +79,48 @@ class TestBlog(unittest.TestCase):
         self.assertTrue(stringToLookFor in response.body, stringToLookFor +
                         " not present in response body: " + response.body)
 
+    def _assertRpcBudget(self, path, budget, headersList=None):
+        '''Makes a mock GET request and asserts that it made no more API calls
+        than budgeted.
+        @param path: the path to request
+        @param budget: dict of the maximum number of calls keyed by
+        rpc_accounting category, e.g. {"datastore_get" : 4}
+        @param headersList: list of headers for the request
+        @return: the response
+        '''
+        with rpc_accounting.measure() as stats:
+            response = blog.app.get_response(path, headers=headersList)
+        for category, max_calls in budget.iteritems():
+            self.assertLessEqual(stats.count(category), max_calls,
+                                 "%s made %d %s calls, over its budget of %d"
+                                 % (path, stats.count(category), category,
+                                    max_calls))
+        return response
+
+    def _runDeferredTasks(self):
+        '''Runs queued deferred tasks, including any tasks they queue, until
+        the default queue is empty.
+        @return: the number of tasks run
+        '''
+        taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        num_run = 0
+        tasks = taskqueue_stub.get_filtered_tasks()
+        while tasks:
+            taskqueue_stub.FlushQueue("default")
+            for task in tasks:
+                deferred.run(task.payload)
+                num_run += 1
+            tasks = taskqueue_stub.get_filtered_tasks()
+        return num_run
+
     @classmethod
     def _createDummyUser(cls, username, password):
         '''Create a dummy user account for testing.
         @param username: the username of the mock user
         @param password: the password of the mock user
         '''
-        return blog.User.create_new_user({blog.USER : username,
-                              blog.PASSWORD : password})
+        return User.create_new_user({blog.USER : username,
+                                     blog.PASSWORD : password})
 
     @classmethod
     def _createDummyPost(cls, username, subject, content):
@@ -132,8 +191,8 @@ class TestSignupInputVerification(TestBlog):
         self.assertEqual(ndb.Key("User", "friend").get().user_name,
                          "friend", "user name is incorrect in db")
         self.assertTrue("username=friend" in response.headers.get("Set-Cookie"))
-        self.assertTrue(util.CookieUtil._hash("friend") in
-                                            response.headers.get("Set-Cookie"))
+        token = response.headers.get("Set-Cookie").split(";")[0].split("=")[1]
+        self.assertEqual(util.CookieUtil._verify_token(token), "friend")
         self.assertEqual(response.location, "http://localhost" + blog.WELCOME,
                    "successful signup did not redirect to welcome page." +
                    " Location was " + response.location)
@@ -173,7 +232,7 @@ class TestNewPost(TestBlog):
         '''Makes a series of posts and then tests the DB for correctness.
         Posts are only made during this test.
         '''
-        blog.User.create_new_user({blog.USER : "test_username",
+        User.create_new_user({blog.USER : "test_username",
                               blog.PASSWORD : "test_password"})
         # Post 1
         response = self.setPostRequest("test_username", "test_subject",
@@ -203,10 +262,32 @@ class TestNewPost(TestBlog):
         self.assertEqual(post1.post_author, "test_username")
         self.assertEqual(post1.post_number, "2")
 
+    def testPostWritesBatched(self):
+        '''A new post and its author are written in one put, and the post
+        counters stay consistent through a delete.
+        '''
+        User.create_new_user({blog.USER : "test_username",
+                              blog.PASSWORD : "test_password"})
+        HomeFeed.rebuild()
+        with rpc_accounting.measure() as stats:
+            post_key = BlogPost.create_new_post(
+                "test_username", {blog.SUBJECT : "subject",
+                                  blog.CONTENT : "content"})
+        self.assertEqual(post_key.id(), "1")
+        # one put for the post and its author and one for the counter shard;
+        # the home feed is only cached
+        self.assertEqual(stats.count("datastore_put"), 2)
+        user = ndb.Key("User", "test_username").get()
+        self.assertEqual((user.posts_made, user.cur_num_posts), (1, 1))
+        BlogPost.delete_post(post_key.get())
+        self.assertEqual(post_key.get(), None)
+        self.assertEqual(user.cur_num_posts, 0)
+        self.assertTrue(self._runDeferredTasks() > 0)
+
     def testNewPostBadSubject(self):
         '''Test making a post with an invalid subject field.
         '''
-        blog.User.create_new_user({blog.USER : "test_username",
+        User.create_new_user({blog.USER : "test_username",
                               blog.PASSWORD : "test_password"})
         # Post 1
         response = self.setPostRequest("test_username", "",
@@ -229,7 +310,7 @@ class TestNewPost(TestBlog):
     def testNewPostBadContent(self):
         '''Test making a new post with a bad content field.
         '''
-        blog.User.create_new_user({blog.USER : "test_username",
+        User.create_new_user({blog.USER : "test_username",
                               blog.PASSWORD : "test_password"})
         # Post 1
         response = self.setPostRequest("test_username", "test_subject",
@@ -240,7 +321,7 @@ class TestNewPost(TestBlog):
     def testNoUserLoggedIn(self):
         '''Test attempting to create a post with no logged in user.
         '''
-        blog.User.create_new_user({blog.USER : "test_username",
+        User.create_new_user({blog.USER : "test_username",
                               blog.PASSWORD : "test_password"})
 
         # Post 2 - redirect in get
@@ -289,7 +370,7 @@ class TestComments(TestBlog):
         # set post response
         self._setPostRequest(self.C_AUTHOR, "comment_content",
                              post_key.urlsafe())
-        new_comment_key = blog.Comment.get_comment_key("1", post_key)
+        new_comment_key = Comment.get_comment_key("1", post_key)
         new_comment = new_comment_key.get()
 
         self.assertEqual(new_comment.content, "comment_content",
@@ -300,7 +381,7 @@ class TestComments(TestBlog):
         self._setPostRequest(self.C_AUTHOR, "2nd comment_content",
                              post_key.urlsafe())
 
-        new_comment2 = blog.Comment.get_comment_key("2", post_key).get()
+        new_comment2 = Comment.get_comment_key("2", post_key).get()
         self.assertEqual(new_comment2.content, "2nd comment_content",
                          "New Comment Content is not corrent, was " +
                          new_comment.content + " but should have been" +
@@ -311,6 +392,39 @@ class TestComments(TestBlog):
         self.assertEqual(post_key.get().comments_made, 3)
 
 
+    def testCommentPagination(self):
+        '''Comments are listed one bounded page at a time.
+        '''
+        self.setUpTest()
+        post_key = ndb.Key("User", self.P_AUTHOR, "BlogPost", "1")
+        for comment_num in range(25):
+            Comment.create_new_comment(self.C_AUTHOR, post_key.urlsafe(),
+                                       {blog.CONTENT : str(comment_num)})
+        comments, next_cursor = BlogPost.get_comments_page(
+            post_key.get())
+        self.assertEqual(len(comments), 20)
+        self.assertTrue(next_cursor)
+        comments, next_cursor = BlogPost.get_comments_page(
+            post_key.get(), next_cursor)
+        self.assertEqual(len(comments), 5)
+        self.assertEqual(next_cursor, None)
+
+    def testAsyncCommentLifecycle(self):
+        '''Comments created and deleted by tasklets update the post's
+        counters.
+        '''
+        self.setUpTest()
+        post_key = ndb.Key("User", self.P_AUTHOR, "BlogPost", "1")
+        futures = [Comment.create_new_comment_async(
+                       self.C_AUTHOR, post_key.urlsafe(),
+                       {blog.CONTENT : "comment"}) for dummy_idx in range(3)]
+        comment_keys = [future.get_result() for future in futures]
+        self.assertEqual(len(set(comment_keys)), 3)
+        Comment.delete_comment_async(comment_keys[0].get()).get_result()
+        self.assertEqual(BlogPost.count_comments_async(
+            post_key).get_result(), 2)
+        self.assertEqual(post_key.get().comments_made, 3)
+
     def testInputVerification(self):
         '''Test no input into comment form.
         '''
@@ -366,6 +480,21 @@ class testLoginLogout(TestBlog):
                    "successful signup did not redirect to welcome page." +
                    " Location was " + response.location)
 
+    def testLegacyPasswordRehashed(self):
+        '''Logging in with a password stored in the legacy format upgrades it
+        to PBKDF2.
+        '''
+        self._createDummyUser(self.REALUSER, self.ACTUALPWD)
+        user = ndb.Key("User", self.REALUSER).get()
+        user.password = hashlib.sha256(self.ACTUALPWD + "salty").hexdigest() \
+            + ",salty"
+        user.put()
+        response = self._setPostRequest(self.REALUSER, self.ACTUALPWD)
+        self.assertEqual(response.location, "http://localhost" + blog.WELCOME)
+        password = ndb.Key("User", self.REALUSER).get().password
+        self.assertTrue(password.startswith(util.PWD_KDF + "$"))
+        self.assertTrue(util.PwdUtil(self.ACTUALPWD, password).verify_password())
+
     def testBagLogin(self):
         '''Test login with incorrect username. Make sure correct error msg
         is displayed.
@@ -436,6 +565,67 @@ class testLoginLogout(TestBlog):
                    " Location was " + response.location)
 
 
+class testSessionToken(TestBlog):
+    '''
+    Class to test verification, expiry and revocation of session tokens.
+    '''
+    USERNAME = "session_user"
+
+    def _makeToken(self, issued_at=None):
+        '''Returns a session token, issued now or at a given time.
+        '''
+        if issued_at is None:
+            return util.CookieUtil._value_and_hash(self.USERNAME)
+        stamped = self.USERNAME + "|" + str(issued_at)
+        return stamped + "|" + util.CookieUtil._hash(stamped)
+
+    def testValidToken(self):
+        '''A fresh token verifies, first with the HMAC and then from the LRU.
+        '''
+        token = self._makeToken()
+        self.assertEqual(util.CookieUtil._verify_token(token), self.USERNAME)
+        self.assertEqual(len(util.CookieUtil._verified), 1)
+        self.assertEqual(util.CookieUtil._verify_token(token), self.USERNAME)
+
+    def testTamperedToken(self):
+        '''Tokens with a changed value or timestamp, or in the old format,
+        are rejected.
+        '''
+        token = self._makeToken()
+        value, issued_at, token_hash = token.split("|")
+        for bad_token in ("other_user|" + issued_at + "|" + token_hash,
+                          value + "|" + str(int(issued_at) + 1) + "|" +
+                          token_hash,
+                          value + "|" + util.CookieUtil._hash(value),
+                          "garbage"):
+            self.assertIsNone(util.CookieUtil._verify_token(bad_token))
+
+    def testExpiredToken(self):
+        '''Tokens older than the maximum age are rejected.
+        '''
+        issued_at = int(time.time()) - util.SESSION_MAX_AGE - 1
+        self.assertIsNone(util.CookieUtil._verify_token(
+            self._makeToken(issued_at)))
+
+    def testRevokedOnLogout(self):
+        '''Logging out revokes the token, even if it is replayed.
+        '''
+        token = self._makeToken()
+        self.assertEqual(util.CookieUtil._verify_token(token), self.USERNAME)
+        blog.app.get_response(blog.LOGOUT, headers=[
+            ("Cookie", blog.USER + "=" + token)])
+        self.assertIsNone(util.CookieUtil._verify_token(token))
+
+    def testRevokedOnOtherInstance(self):
+        '''A token revoked by another instance is rejected at once, even
+        though it is in this instance's LRU.
+        '''
+        token = self._makeToken()
+        self.assertEqual(util.CookieUtil._verify_token(token), self.USERNAME)
+        memcache.set(util.REVOKED_CACHE_PREFIX + token.split("|")[2], True)
+        self.assertIsNone(util.CookieUtil._verify_token(token))
+
+
 class testLikeUnlike(TestBlog):
     '''
     Class of tests for liking and unliking posts.
@@ -498,7 +688,8 @@ class testLikeUnlike(TestBlog):
                    " not present in the body of the response. Response was:" +
                    response.body)
         # other user should be in the post's users liked list
-        self.assertTrue(self.OTHER_USER in self._get_MockPostEntity().users_liked,
+        self.assertTrue(BlogPost.already_liked(
+                        self._get_MockPostEntity(), self.OTHER_USER),
                    "Liking user not present in list of users who have liked" +
                    " post.")
 
@@ -509,19 +700,47 @@ class testLikeUnlike(TestBlog):
         self._setupTest()
         # like post
         response = self._setLikeResponse(self.OTHER_USER)
-        self.assertTrue(self.OTHER_USER in self._get_MockPostEntity().users_liked,
+        self.assertTrue(BlogPost.already_liked(
+                        self._get_MockPostEntity(), self.OTHER_USER),
                    "Liking user not present in list of users who have liked" +
                    " post.")
         self.assertTrue("Unlike" in response.body, "Unlike is not present in" +
                    " the body of the response. Response was:" + response.body)
         # unlike post
         response = self._setLikeResponse(self.OTHER_USER)
-        self.assertTrue(self.OTHER_USER not in self._get_MockPostEntity().users_liked,
+        self.assertTrue(not BlogPost.already_liked(
+                        self._get_MockPostEntity(), self.OTHER_USER),
                    "Liking user should not be present in list of users who have liked" +
                    " post.")
         self.assertTrue("Like" in response.body, "Like is not present in" +
                    " the body of the response. Response was:" + response.body)
 
+    def testLikeCount(self):
+        '''Likes are counted once per user and unlikes are subtracted.
+        '''
+        self._setupTest()
+        post_entity = self._get_MockPostEntity()
+        BlogPost.add_like_unlike(post_entity, self.OTHER_USER, "Like")
+        BlogPost.add_like_unlike(post_entity, self.OTHER_USER, "Like")
+        self.assertEqual(BlogPost.like_count(post_entity), 1)
+        BlogPost.add_like_unlike(post_entity, self.OTHER_USER, "Unlike")
+        self.assertEqual(BlogPost.like_count(post_entity), 0)
+        self.assertFalse(BlogPost.already_liked(post_entity,
+                                                self.OTHER_USER))
+
+    def testBatchLikeStates(self):
+        '''Like states of several posts are read together.
+        '''
+        self._setupTest()
+        self._createDummyPost(self.POST_AUTHOR, "subject 2", "content 2")
+        post1 = self._get_MockPostEntity()
+        post2 = ndb.Key("User", self.POST_AUTHOR, "BlogPost", "2").get()
+        BlogPost.add_like_unlike(post2, self.OTHER_USER, "Like")
+        post_keys = [post1.key, post2.key]
+        self.assertEqual(Like.liked_by_user(post_keys, self.OTHER_USER),
+                         set([post2.key]))
+        self.assertEqual(Like.liked_by_user(post_keys, None), set())
+
     def testLikeOwnPost(self):
         '''Liking user is logged in, is post's author.
         '''
@@ -533,7 +752,8 @@ class testLikeUnlike(TestBlog):
         response = self._setLikeResponse(self.POST_AUTHOR)
         self.assertTrue(ERROR_MSG in response.body, "Error msg incorrect" +
                         " for liking own post." + response.body)
-        self.assertTrue(self.POST_AUTHOR not in self._get_MockPostEntity().users_liked,
+        self.assertTrue(not BlogPost.already_liked(
+                        self._get_MockPostEntity(), self.POST_AUTHOR),
                    "Liking user should not be present in list of users who have liked" +
                    " post.")
 
@@ -552,6 +772,125 @@ class testLikeUnlike(TestBlog):
         self.assertTrue(ERROR_MSG in response.body, "Error msg incorrect" +
                         " for liking post while logged out." + response.body)
 
+class testRpcBudget(TestBlog):
+    '''
+    Class asserting API call budgets per route, so that N+1 patterns fail
+    the build. Budgets do not grow with the number of posts or comments
+    shown. Class fields are constants used in testing.
+    '''
+    AUTHOR = "post_author"
+    READER = "reader"
+    PASSWORD = "some_pwd"
+    NUM_ENTITIES = 10
+
+    def _setupTest(self):
+        '''Creates NUM_ENTITIES posts, the first with NUM_ENTITIES comments
+        and a like, and returns the headers of a logged in reader.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyUser(self.READER, self.PASSWORD)
+        for post_num in range(self.NUM_ENTITIES):
+            self._createDummyPost(self.AUTHOR, "subject" + str(post_num),
+                                  "content")
+        post_key = ndb.Key("User", self.AUTHOR, "BlogPost", "1")
+        for comment_num in range(self.NUM_ENTITIES):
+            Comment.create_new_comment(self.READER, post_key.urlsafe(),
+                                       {blog.CONTENT : "comment"})
+        BlogPost.add_like_unlike(post_key.get(), self.READER, "Like")
+        return [("Cookie", util.CookieUtil._format_cookie(blog.USER,
+                                                          self.READER))]
+
+    def testHomePageBudget(self):
+        '''The home page resolves posts and like states in batches.
+        '''
+        headersList = self._setupTest()
+        self._assertRpcBudget("/blog/display/home",
+                              {"datastore_get" : 6, "datastore_query" : 2,
+                               "datastore_put" : 1},
+                              headersList)
+
+    def testPostPageBudget(self):
+        '''A post page fetches its comments with one query.
+        '''
+        headersList = self._setupTest()
+        post_key = ndb.Key("User", self.AUTHOR, "BlogPost", "1")
+        self._assertRpcBudget("/blog/post_id/" + post_key.urlsafe() +
+                              "/display/display",
+                              {"datastore_get" : 8, "datastore_query" : 3,
+                               "datastore_put" : 0},
+                              headersList)
+
+    def testStatsHeader(self):
+        '''The served application reports the calls of each request.
+        '''
+        self._setupTest()
+        response = webapp2.Request.blank("/blog/display/home").get_response(
+            blog_app.application)
+        self.assertEqual(response.status_int, 200)
+        self.assertIn("datastore_get=",
+                      response.headers.get(rpc_accounting.STATS_HEADER))
+
+
+class testProfiler(TestBlog):
+    '''
+    Class to test on-demand profiling of requests.
+    '''
+    REPORT_PAGE = "/_admin/profiles"
+
+    def tearDown(self):
+        '''Discards profiles and turns profiling back off.
+        '''
+        profiler.RouteProfiles.clear()
+        blog.blog_config.PROFILING_ENABLED = False
+        TestBlog.tearDown(self)
+
+    def testSampledRequests(self):
+        '''With profiling on and every request sampled, stats are kept per
+        route.
+        '''
+        blog.blog_config.PROFILING_ENABLED = True
+        sample_rate = blog.blog_config.PROFILE_SAMPLE_RATE
+        blog.blog_config.PROFILE_SAMPLE_RATE = 1.0
+        try:
+            blog.app.get_response("/blog/display/home")
+        finally:
+            blog.blog_config.PROFILE_SAMPLE_RATE = sample_rate
+        self.assertIn("=== " + blog.HOME + ": 1 requests",
+                      profiler.RouteProfiles.report())
+
+    def testAdminHeader(self):
+        '''Admins can profile a single request with the profiling header,
+        and read the report.
+        '''
+        headersList = [(blog.blog_config.PROFILE_HEADER, "1")]
+        blog.app.get_response("/blog/display/home", headers=headersList)
+        self.assertEqual(profiler.RouteProfiles.report(), "")
+        self.testbed.setup_env(USER_IS_ADMIN="1", overwrite=True)
+        blog.app.get_response("/blog/display/home", headers=headersList)
+        response = blog.app.get_response(self.REPORT_PAGE)
+        self.assertEqual(response.status_int, 200)
+        self.assertIn("cumulative", response.body)
+
+    def testReportAdminOnly(self):
+        '''Visitors who are not admins cannot read the report.
+        '''
+        response = blog.app.get_response(self.REPORT_PAGE)
+        self.assertEqual(response.status_int, 403)
+
+
+class testWarmup(TestBlog):
+    '''
+    Class to test the warmup request sent to new instances.
+    '''
+
+    def testWarmup(self):
+        '''Warmup loads every template and caches the home feed.
+        '''
+        response = blog.app.get_response("/_ah/warmup")
+        self.assertEqual(response.status_int, 200)
+        self.assertIsNotNone(memcache.get(
+            ndb_models.HOME_FEED_CACHE_KEY))
+
 class testPwdUtil(TestBlog):
     '''Tests the password utility functions. Tests results of using a unicode
     vs. ASCII password.
@@ -572,6 +911,445 @@ class testPwdUtil(TestBlog):
         pwd_helper2 = util.PwdUtil(self.unicodePwd, db_password)
         self.assertTrue(pwd_helper2.verify_password())
 
+    def testCostStoredWithHash(self):
+        '''The iteration count is stored with the hash, and hashes with fewer
+        iterations than the current setting need a rehash.
+        '''
+        db_password = util.PwdUtil(self.bytesPwd,
+                                   iterations=1000).new_pwd_salt_pair()
+        self.assertEqual(db_password.split("$")[1], "1000")
+        pwd_helper = util.PwdUtil(self.bytesPwd, db_password)
+        self.assertTrue(pwd_helper.verify_password())
+        self.assertTrue(pwd_helper.needs_rehash())
+        self.assertFalse(util.PwdUtil("wrong", db_password).verify_password())
+
+    def testBusyHashingFailsFast(self):
+        '''A login that finds every hashing slot busy gets a 503 after a
+        bounded wait instead of queueing on the request thread.
+        '''
+        User.create_new_user({blog.USER : "busy_user",
+                              blog.PASSWORD : self.bytesPwd})
+        wait_secs = util.HASH_WAIT_SECS
+        util.HASH_WAIT_SECS = 0.05
+        for dummy_idx in range(util.MAX_CONCURRENT_HASHES):
+            util.PwdUtil._hash_slots.acquire(0)
+        try:
+            response = blog.app.get_response("/blog/login", POST={
+                blog.USER : "busy_user", blog.PASSWORD : self.bytesPwd})
+        finally:
+            for dummy_idx in range(util.MAX_CONCURRENT_HASHES):
+                util.PwdUtil._hash_slots.release()
+            util.HASH_WAIT_SECS = wait_secs
+        self.assertEqual(response.status_int, 503)
+        self.assertIn("Retry-After", response.headers)
+        self.assertNotIn("Set-Cookie", response.headers)
+
+class testFormSchema(unittest.TestCase):
+    '''Tests the declarative form validation schemas.
+    '''
+
+    def testMultiLineContent(self):
+        '''Post content may span several lines.
+        '''
+        form = {blog.SUBJECT : "subject", blog.CONTENT : "line 1\nline 2"}
+        is_valid, form_data = form_schema.POST_FORM.validate(form.get)
+        self.assertTrue(is_valid)
+        self.assertEqual(form_data[blog.CONTENT], "line 1\nline 2")
+
+    def testStopsAtFirstError(self):
+        '''Only the first invalid field gets an error message.
+        '''
+        form = {blog.USER : "a", blog.PASSWORD : "b", blog.PWD_VERIFY : "c",
+                blog.EMAIL : "garbage"}
+        is_valid, form_data = form_schema.SIGNUP_FORM.validate(form.get)
+        self.assertFalse(is_valid)
+        self.assertEqual(form_data[blog.USER + blog.ERROR],
+                         "The username is invalid.")
+        self.assertNotIn(blog.PASSWORD + blog.ERROR, form_data)
+        self.assertNotIn(blog.EMAIL + blog.ERROR, form_data)
+
+    def testLengthCheckedBeforePattern(self):
+        '''Over-long input is rejected without running the pattern.
+        '''
+        field = form_schema.FIELDS[blog.SUBJECT]
+        self.assertFalse(field.is_valid("x" * 101, None))
+        self.assertFalse(field.is_valid("two\nlines", None))
+        self.assertTrue(field.is_valid("x" * 100, None))
+
+    def testOptionalEmail(self):
+        '''The email address may be left blank.
+        '''
+        form = {blog.USER : "friend", blog.PASSWORD : "ttt",
+                blog.PWD_VERIFY : "ttt", blog.EMAIL : ""}
+        self.assertTrue(form_schema.SIGNUP_FORM.validate(form.get)[0])
+
+class testLRUCache(unittest.TestCase):
+    '''Tests the in-process LRU cache utility.
+    '''
+
+    def testEvictsLeastRecentlyUsed(self):
+        '''Tests eviction by number of entries.
+        '''
+        cache = util.LRUCache(2)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "1")
+        self.assertEqual(cache.get("c"), "3")
+
+    def testEvictsBySize(self):
+        '''Tests eviction by total size, and that oversized values are not
+        held.
+        '''
+        cache = util.LRUCache(10, 5)
+        cache.set("a", "123")
+        cache.set("b", "45")
+        cache.set("c", "6")
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(len(cache), 2)
+        cache.set("d", "123456")
+        self.assertEqual(cache.get("d"), None)
+
+class testFragmentCache(TestBlog):
+    '''
+    Class to test caching of rendered fragments. Class fields are constants
+    used in testing.
+    '''
+    AUTHOR = "post_author"
+    OTHER_USER = "other_user"
+    PASSWORD = "some_pwd"
+
+    def testRenderedOncePerVersion(self):
+        '''A fragment is rendered once per version of its entity.
+        '''
+        key = ndb.Key("User", self.AUTHOR)
+        renders = []
+
+        def _render():
+            renders.append(1)
+            return u"fragment" + str(len(renders))
+        version = fragment_cache.ContentVersion.get(key)
+        self.assertEqual(fragment_cache.FragmentCache.get_or_render(
+            key, version, "body", _render), u"fragment1")
+        fragment_cache.FragmentCache.clear_local()
+        self.assertEqual(fragment_cache.FragmentCache.get_or_render(
+            key, version, "body", _render), u"fragment1")
+        fragment_cache.ContentVersion.bump(key)
+        version = fragment_cache.ContentVersion.get(key)
+        self.assertEqual(fragment_cache.FragmentCache.get_or_render(
+            key, version, "body", _render), u"fragment2")
+
+    def testWritesBumpVersion(self):
+        '''Edits, comments and likes bump the version of a post.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyPost(self.AUTHOR, "subject", "content")
+        post_key = ndb.Key("User", self.AUTHOR, "BlogPost", "1")
+        versions = [fragment_cache.ContentVersion.get(post_key)]
+        BlogPost.update_post(post_key.get(), {blog.SUBJECT : "edited",
+                                              blog.CONTENT : "edited"})
+        versions.append(fragment_cache.ContentVersion.get(post_key))
+        Comment.create_new_comment(self.OTHER_USER, post_key.urlsafe(),
+                                   {blog.CONTENT : "comment"})
+        versions.append(fragment_cache.ContentVersion.get(post_key))
+        BlogPost.add_like_unlike(post_key.get(), self.OTHER_USER, "Like")
+        versions.append(fragment_cache.ContentVersion.get(post_key))
+        self.assertEqual(len(set(versions)), 4)
+
+class testSharedMemcache(TestBlog):
+    '''
+    Class to test the memcache stub shared by the workers of serve.py. Two
+    stubs on the same database stand in for two worker processes.
+    '''
+
+    def setUp(self):
+        super(testSharedMemcache, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        path = os.path.join(self.cache_dir, "memcache.sqlite3")
+        self.stubs = [shared_memcache.SharedMemcacheStub(path)
+                      for dummy_idx in range(2)]
+
+    def tearDown(self):
+        super(testSharedMemcache, self).tearDown()
+        for name in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir, name))
+        os.rmdir(self.cache_dir)
+
+    def _useStub(self, index):
+        '''Serves memcache calls from one of the stubs.
+        '''
+        apiproxy_stub_map.apiproxy.ReplaceStub("memcache", self.stubs[index])
+
+    def testSharedBetweenStubs(self):
+        '''Values written through one stub are read through the other.
+        '''
+        self._useStub(0)
+        memcache.set("key", {"some" : "value"})
+        memcache.set("counter", 5)
+        self._useStub(1)
+        self.assertEqual(memcache.get("key"), {"some" : "value"})
+        self.assertEqual(memcache.incr("counter", 2), 7)
+        self.assertFalse(memcache.add("key", "other"))
+        memcache.delete("key")
+        self._useStub(0)
+        self.assertEqual(memcache.get("key"), None)
+        self.assertEqual(memcache.get("counter"), 7)
+
+    def testCompareAndSet(self):
+        '''A cas fails once another stub has written the key.
+        '''
+        self._useStub(0)
+        memcache.set("key", 1)
+        client = memcache.Client()
+        self.assertEqual(client.gets("key"), 1)
+        self._useStub(1)
+        memcache.set("key", 2)
+        self._useStub(0)
+        self.assertFalse(client.cas("key", 3))
+        self.assertEqual(client.gets("key"), 2)
+        self.assertTrue(client.cas("key", 3))
+        self.assertEqual(memcache.get("key"), 3)
+
+    def testExpiration(self):
+        '''Expired values are not returned.
+        '''
+        self._useStub(0)
+        memcache.set("key", "value", time=1)
+        self.assertEqual(memcache.get("key"), "value")
+        time.sleep(1.1)
+        self.assertEqual(memcache.get("key"), None)
+
+    def testEviction(self):
+        '''Once the cache is full, the entries written longest ago are
+        evicted, and rewriting an entry keeps it.
+        '''
+        for stub in self.stubs:
+            stub.max_entries = 3
+        self._useStub(0)
+        for key, value in (("a", 1), ("b", 2), ("c", 3), ("a", 4)):
+            memcache.set(key, value)
+        self._useStub(1)
+        memcache.set("d", 5)
+        self.assertEqual(memcache.get_multi(["a", "b", "c", "d"]),
+                         {"a" : 4, "c" : 3, "d" : 5})
+
+class testTaskStore(TestBlog):
+    '''
+    Class to test the deferred task database shared by the workers of
+    serve.py. Two stores on the same database stand in for two workers.
+    '''
+
+    def setUp(self):
+        super(testTaskStore, self).setUp()
+        self.task_dir = tempfile.mkdtemp()
+        path = os.path.join(self.task_dir, "tasks.sqlite3")
+        self.stores = [serve.TaskStore(path) for dummy_idx in range(2)]
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        for name in os.listdir(self.task_dir):
+            os.remove(os.path.join(self.task_dir, name))
+        os.rmdir(self.task_dir)
+        super(testTaskStore, self).tearDown()
+
+    def testLeasedOnce(self):
+        '''A due task is leased to one worker only, and tasks that are not
+        due are left alone.
+        '''
+        self.stores[0].add("payload", time.time())
+        self.stores[0].add("later", time.time() + 60)
+        leased = self.stores[1].lease_due()
+        self.assertEqual([task[1:] for task in leased], [("payload", 0)])
+        self.assertEqual(self.stores[0].lease_due(), [])
+
+    def testRetry(self):
+        '''A failed task is due again after a backoff that doubles with
+        each retry, and a removed task is gone.
+        '''
+        self.stores[0].add("payload", time.time())
+        task_id = self.stores[0].lease_due()[0][0]
+        self.assertEqual(self.stores[0].retry(task_id, 1),
+                         serve.TASK_MIN_BACKOFF_SECS)
+        self.assertEqual(self.stores[1].lease_due(), [])
+        time.sleep(serve.TASK_MIN_BACKOFF_SECS + 0.1)
+        self.assertEqual(self.stores[1].lease_due(),
+                         [(task_id, "payload", 1)])
+        self.assertEqual(self.stores[1].retry(task_id, 2),
+                         2 * serve.TASK_MIN_BACKOFF_SECS)
+        self.assertEqual(self.stores[1].retry(task_id, 30),
+                         serve.TASK_MAX_BACKOFF_SECS)
+        self.stores[1].remove(task_id)
+        self.assertEqual(self.stores[0].lease_due(), [])
+
+class testPageCache(TestBlog):
+    '''
+    Class to test caching of whole pages and conditional GETs for visitors
+    who are not logged in. Class fields are constants used in testing.
+    '''
+    AUTHOR = "post_author"
+    PASSWORD = "some_pwd"
+    HOME_PAGE = "/blog/display/home"
+
+    def _postPage(self, post_key):
+        '''Returns the path of the display page of a post.
+        '''
+        return "/blog/post_id/" + post_key.urlsafe() + "/display/display"
+
+    def testValidatorsSet(self):
+        '''Anonymous views of the home page and of a post carry an ETag and
+        a Last-Modified date.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyPost(self.AUTHOR, "subject", "content")
+        post_key = ndb.Key("User", self.AUTHOR, "BlogPost", "1")
+        for path in (self.HOME_PAGE, self._postPage(post_key)):
+            response = blog.app.get_response(path)
+            self.assertEqual(response.status_int, 200)
+            self.assertTrue(response.headers.get("ETag"))
+            self.assertTrue(response.headers.get("Last-Modified"))
+            self.assertEqual(response.headers.get("Vary"), "Cookie")
+
+    def testNotModified(self):
+        '''A conditional GET with a matching ETag gets an empty 304.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyPost(self.AUTHOR, "subject", "content")
+        etag = blog.app.get_response(self.HOME_PAGE).headers["ETag"]
+        response = blog.app.get_response(self.HOME_PAGE,
+                                         headers=[("If-None-Match", etag)])
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, "")
+
+    def testIfModifiedSince(self):
+        '''If-Modified-Since gets a 304 only for a page older than its
+        second, so a page changed within the second of the client's copy is
+        sent again.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyPost(self.AUTHOR, "subject", "content")
+        last_modified = blog.app.get_response(
+            self.HOME_PAGE).headers["Last-Modified"]
+        response = blog.app.get_response(
+            self.HOME_PAGE, headers=[("If-Modified-Since", last_modified)])
+        self.assertEqual(response.status_int, 200)
+        later = formatdate(time.time() + 2, usegmt=True)
+        response = blog.app.get_response(
+            self.HOME_PAGE, headers=[("If-Modified-Since", later)])
+        self.assertEqual(response.status_int, 304)
+
+    def testWritesChangeETag(self):
+        '''New posts change the ETag of the home page, and comments change
+        the ETag of the post.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyPost(self.AUTHOR, "subject", "content")
+        post_key = ndb.Key("User", self.AUTHOR, "BlogPost", "1")
+        home_etag = blog.app.get_response(self.HOME_PAGE).headers["ETag"]
+        post_etag = blog.app.get_response(
+            self._postPage(post_key)).headers["ETag"]
+        self._createDummyPost(self.AUTHOR, "subject2", "content2")
+        Comment.create_new_comment(self.AUTHOR, post_key.urlsafe(),
+                                   {blog.CONTENT : "comment"})
+        response = blog.app.get_response(self.HOME_PAGE,
+                                         headers=[("If-None-Match",
+                                                   home_etag)])
+        self.assertEqual(response.status_int, 200)
+        self.assertIn("subject2", response.body)
+        response = blog.app.get_response(self._postPage(post_key),
+                                         headers=[("If-None-Match",
+                                                   post_etag)])
+        self.assertEqual(response.status_int, 200)
+        self.assertIn("comment", response.body)
+
+    def testLikeKeepsHomeETag(self):
+        '''Likes change the ETag of the post but not of the home page,
+        which shows no like counts.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyPost(self.AUTHOR, "subject", "content")
+        post_key = ndb.Key("User", self.AUTHOR, "BlogPost", "1")
+        home_etag = blog.app.get_response(self.HOME_PAGE).headers["ETag"]
+        post_etag = blog.app.get_response(
+            self._postPage(post_key)).headers["ETag"]
+        BlogPost.add_like_unlike(post_key.get(), "reader", "Like")
+        response = blog.app.get_response(self.HOME_PAGE,
+                                         headers=[("If-None-Match",
+                                                   home_etag)])
+        self.assertEqual(response.status_int, 304)
+        response = blog.app.get_response(self._postPage(post_key),
+                                         headers=[("If-None-Match",
+                                                   post_etag)])
+        self.assertEqual(response.status_int, 200)
+
+    def testMissingPostNotFound(self):
+        '''Conditional GETs of a post that never existed get a 404, even
+        with a wildcard or a previously issued ETag.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        path = self._postPage(ndb.Key("User", self.AUTHOR, "BlogPost", "9"))
+        response = blog.app.get_response(path)
+        self.assertEqual(response.status_int, 404)
+        self.assertNotIn("ETag", response.headers)
+        for etag in ("*", '"%s-dev"' % blog.ContentVersion.get(
+                ndb.Key("User", self.AUTHOR, "BlogPost", "9"))):
+            response = blog.app.get_response(
+                path, headers=[("If-None-Match", etag)])
+            self.assertEqual(response.status_int, 404)
+
+    def testDeletedPostNotFound(self):
+        '''A deleted post's cached page and ETag are no longer served.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyPost(self.AUTHOR, "subject", "content")
+        post_key = ndb.Key("User", self.AUTHOR, "BlogPost", "1")
+        etag = blog.app.get_response(
+            self._postPage(post_key)).headers["ETag"]
+        BlogPost.delete_post(post_key.get())
+        response = blog.app.get_response(self._postPage(post_key))
+        self.assertEqual(response.status_int, 404)
+        response = blog.app.get_response(self._postPage(post_key),
+                                         headers=[("If-None-Match", etag)])
+        self.assertEqual(response.status_int, 404)
+
+    def testVersionReadBeforePost(self):
+        '''A post edited while its page renders is not cached under the
+        version stamp of the edit.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyPost(self.AUTHOR, "subject", "content")
+        path = self._postPage(ndb.Key("User", self.AUTHOR, "BlogPost", "1"))
+        headersList = [("Cookie",
+                        util.CookieUtil._format_cookie(blog.USER,
+                                                       self.AUTHOR))]
+        storage = blog_storage.app_storage()
+        get_post = storage.get_post
+
+        def get_post_then_edit(post_id):
+            post = get_post(post_id)
+            storage.update_post(post_id, {blog.SUBJECT : "subject",
+                                          blog.CONTENT : "edited"})
+            return post
+        storage.get_post = get_post_then_edit
+        try:
+            blog.app.get_response(path, headers=headersList)
+        finally:
+            del storage.get_post
+        response = blog.app.get_response(path, headers=headersList)
+        self.assertIn("edited", response.body)
+
+    def testLoggedInNotCached(self):
+        '''Logged in visitors never get cache validators.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        headersList = [("Cookie",
+                        util.CookieUtil._format_cookie(blog.USER,
+                                                       self.AUTHOR))]
+        response = blog.app.get_response(self.HOME_PAGE, headers=headersList)
+        self.assertNotIn("ETag", response.headers)
+
 class testPostEditing(TestBlog):
     '''
     Class to test editing posts functionality. Class fields are constants
@@ -630,6 +1408,610 @@ class testPostEditing(TestBlog):
         self.assertEqual(cur_post.post_subject, self.EDITED_SUBJECT)
         self.assertEqual(cur_post.post_content, self.EDITED_CONTENT)
 
+
+class testHomeFeed(TestBlog):
+    '''
+    Class to test the materialized home page feed. Class fields are constants
+    used in testing.
+    '''
+    AUTHOR = "feed_author"
+    PASSWORD = "some_pwd"
+
+    def _setupTest(self, num_posts):
+        '''Set up a mock author and make a number of mock posts.
+        @param num_posts: the number of posts to make
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        for post_num in range(1, num_posts + 1):
+            self._createDummyPost(self.AUTHOR, "subject" + str(post_num),
+                                  "content" + str(post_num))
+
+    def _getPostEntity(self, post_num):
+        '''Returns the mock post entity with the given post number.
+        '''
+        return ndb.Key("User", self.AUTHOR, "BlogPost", str(post_num)).get()
+
+    def testFeedOrderAndSize(self):
+        '''New posts go to the front of the feed, which is capped in size.
+        '''
+        self._setupTest(22)
+        feed = HomeFeed.recent_posts()
+        self.assertEqual(len(feed), 20)
+        self.assertEqual(feed[0].post_subject, "subject22")
+        self.assertEqual(feed[-1].post_subject, "subject3")
+        self.assertEqual(feed[0].key, self._getPostEntity(22).key)
+
+    def testFeedNextPage(self):
+        '''The feed links to the next page of posts, which is read from a
+        query cursor.
+        '''
+        self._setupTest(25)
+        feed, next_cursor = HomeFeed.first_page()
+        self.assertEqual(len(feed), 20)
+        self.assertTrue(next_cursor)
+        next_posts, next_cursor = BlogPost.recent_posts_page(next_cursor)
+        self.assertEqual([post.post_subject for post in next_posts],
+                         ["subject5", "subject4", "subject3", "subject2",
+                          "subject1"])
+        self.assertEqual(next_cursor, None)
+
+    def testExcerpts(self):
+        '''Posts store a bounded excerpt that the home page lists.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyPost(self.AUTHOR, "subject", "x" * 1000)
+        post = self._getPostEntity(1)
+        self.assertEqual(post.post_excerpt, "x" * ndb_models.EXCERPT_LENGTH)
+        self.assertEqual(post.content_length, 1000)
+        feed = HomeFeed.recent_posts()
+        self.assertEqual(feed[0].post_excerpt, post.post_excerpt)
+        self.assertEqual(feed[0].content_length, 1000)
+        self.assertFalse(hasattr(feed[0], "post_content"))
+
+    def testFeedServedFromMemcache(self):
+        '''Once read, the feed is held in memcache.
+        '''
+        self._setupTest(2)
+        HomeFeed.recent_posts()
+        self.assertEqual(
+            len(memcache.get(ndb_models.HOME_FEED_CACHE_KEY)["entries"]), 2)
+
+    def testFeedUpdatedOnEdit(self):
+        '''Editing a post updates its summary in the feed.
+        '''
+        self._setupTest(2)
+        BlogPost.update_post(self._getPostEntity(1),
+                             {blog.SUBJECT : "edited",
+                              blog.CONTENT : "edited content"})
+        feed = HomeFeed.recent_posts()
+        self.assertEqual(feed[1].post_subject, "edited")
+        self.assertEqual(feed[1].post_excerpt, "edited content")
+
+    def testFeedRebuiltWhenLost(self):
+        '''A feed dropped from memcache is rebuilt from the query, and the
+        next new post goes to its front.
+        '''
+        self._setupTest(2)
+        memcache.flush_all()
+        self.assertEqual([entry.post_subject for entry
+                          in HomeFeed.recent_posts()],
+                         ["subject2", "subject1"])
+        self._createDummyPost(self.AUTHOR, "subject3", "content3")
+        self.assertEqual(HomeFeed.recent_posts()[0].post_subject,
+                         "subject3")
+        self.assertEqual(ndb.Query(kind="HomeFeed").count(), 0)
+
+    def testFeedUpdatedOnDelete(self):
+        '''Deleting a post removes it from the feed.
+        '''
+        self._setupTest(2)
+        BlogPost.delete_post(self._getPostEntity(2))
+        feed = HomeFeed.recent_posts()
+        self.assertEqual([entry.post_subject for entry in feed], ["subject1"])
+
+class testRequestContext(TestBlog):
+    '''
+    Class to test the per-request context shared by decorators, helpers and
+    handlers.
+    '''
+    AUTHOR = "post_author"
+    PASSWORD = "some_pwd"
+
+    def _makeHandler(self, username=None):
+        '''Returns a handler for a mock request.
+        @param username: user name to set a login cookie for, if any
+        '''
+        headersList = []
+        if username:
+            headersList = [("Cookie",
+                            util.CookieUtil._format_cookie(blog.USER,
+                                                           username))]
+        request = webapp2.Request.blank("/blog/display/home",
+                                        headers=headersList)
+        request.app = blog.app
+        return blog.Handler(request, webapp2.Response())
+
+    def testResolvedOnce(self):
+        '''The context is shared and its lookups are cached.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyPost(self.AUTHOR, "subject", "content")
+        post_key = ndb.Key("User", self.AUTHOR, "BlogPost", "1").urlsafe()
+        handler = self._makeHandler(self.AUTHOR)
+        self.assertTrue(handler.context is handler.context)
+        self.assertEqual(handler.context.cur_user, self.AUTHOR)
+        post = handler.context.get_post(post_key)
+        self.assertEqual(post.post_subject, "subject")
+        self.assertTrue(blog.HandlerHelper(handler, (), post_key).cur_post
+                        is post)
+
+    def testMissingEntities(self):
+        '''Bad keys and missing cookies resolve to None.
+        '''
+        handler = self._makeHandler()
+        self.assertEqual(handler.context.cur_user, None)
+        self.assertEqual(handler.context.get_post("garbage"), None)
+        self.assertEqual(handler.context.get_comment(""), None)
+
+class testCascadeDelete(TestBlog):
+    '''
+    Class to test deleting a post's comments and likes in the background.
+    Class fields are constants used in testing.
+    '''
+    AUTHOR = "post_author"
+    OTHER_USER = "other_user"
+    PASSWORD = "some_pwd"
+
+    def testCascadeDelete(self):
+        '''Deleting a post queues tasks that delete its children in batches.
+        '''
+        self._createDummyUser(self.AUTHOR, self.PASSWORD)
+        self._createDummyPost(self.AUTHOR, "subject", "content")
+        post_key = ndb.Key("User", self.AUTHOR, "BlogPost", "1")
+        for comment_num in range(5):
+            Comment.create_new_comment(self.OTHER_USER,
+                                       post_key.urlsafe(),
+                                       {blog.CONTENT : str(comment_num)})
+        BlogPost.add_like_unlike(post_key.get(), self.OTHER_USER, "Like")
+        old_batch_size = ndb_models.CASCADE_BATCH_SIZE
+        ndb_models.CASCADE_BATCH_SIZE = 2
+        try:
+            BlogPost.delete_post(post_key.get())
+            self.assertEqual(post_key.get(), None)
+            self.assertEqual(Comment.query(ancestor=post_key).count(), 5)
+            self.assertTrue(self._runDeferredTasks() > 3)
+        finally:
+            ndb_models.CASCADE_BATCH_SIZE = old_batch_size
+        self.assertEqual(Comment.query(ancestor=post_key).count(), 0)
+        self.assertEqual(Like.query().count(), 0)
+        self.assertEqual(Like.count_likes(post_key), 0)
+
+class testStorage(TestBlog):
+    '''
+    Class to test that every storage backend behaves the same. Class fields
+    are constants used in testing.
+    '''
+    AUTHOR = "post_author"
+    OTHER_USER = "other_user"
+
+    def _checkStorage(self, storage):
+        '''Runs users, posts, comments and likes through a backend.
+        @param storage: the blog_storage.Storage backend to check
+        '''
+        self.assertEqual(storage.create_user(self.AUTHOR, "pwd"), self.AUTHOR)
+        self.assertRaises(blog_storage.DuplicateUserError,
+                          storage.create_user, self.AUTHOR, "other pwd")
+        self.assertEqual(storage.get_user(self.AUTHOR).password, "pwd")
+        first_id = storage.create_post(self.AUTHOR,
+                                       {blog.SUBJECT : "first",
+                                        blog.CONTENT : "x" * 400})
+        second_id = storage.create_post(self.AUTHOR,
+                                        {blog.SUBJECT : "second",
+                                         blog.CONTENT : "content"})
+        self.assertEqual(storage.get_user(self.AUTHOR).posts_made, 2)
+        storage.update_password(self.AUTHOR, "new pwd")
+        self.assertEqual(storage.get_user(self.AUTHOR).password, "new pwd")
+        self.assertEqual([post.post_id for post
+                          in storage.most_recent_posts()],
+                         [second_id, first_id])
+        posts, next_cursor = storage.recent_posts_page(None, 1)
+        self.assertEqual([post.post_id for post in posts], [second_id])
+        posts, next_cursor = storage.recent_posts_page(next_cursor, 1)
+        self.assertEqual(([post.post_id for post in posts], next_cursor),
+                         ([first_id], None))
+        self.assertRaises(blog_storage.InvalidCursorError,
+                          storage.recent_posts_page, "not a cursor")
+        self.assertEqual(storage.get_post("no such post"), None)
+        first = storage.get_post(first_id)
+        self.assertEqual((first.post_number, first.content_length,
+                          len(first.excerpt)), (1, 400, 300))
+        old_id = storage.create_comment(self.OTHER_USER, first_id,
+                                        {blog.CONTENT : "old"})
+        new_id = storage.create_comment(self.OTHER_USER, first_id,
+                                        {blog.CONTENT : "new"})
+        self.assertEqual([comment.comment_id for comment
+                          in storage.get_all_comments(first_id)],
+                         [new_id, old_id])
+        comments, next_cursor = storage.get_comments_page(first_id, None, 1)
+        self.assertEqual([comment.comment_id for comment in comments],
+                         [new_id])
+        comments, next_cursor = storage.get_comments_page(first_id,
+                                                          next_cursor, 1)
+        self.assertEqual(([comment.comment_id for comment in comments],
+                          next_cursor), ([old_id], None))
+        self.assertEqual(storage.update_comment(
+            new_id, {blog.CONTENT : "edited"}).content, "edited")
+        self.assertEqual(storage.get_comment(new_id).post_id, first_id)
+        self.assertEqual(storage.get_comment("no such comment"), None)
+        storage.delete_comment(old_id)
+        self.assertEqual(storage.count_comments(first_id), 1)
+        self.assertTrue(storage.add_like_unlike(first_id, self.OTHER_USER,
+                                                "Like"))
+        self.assertFalse(storage.add_like_unlike(first_id, self.OTHER_USER,
+                                                 "Like"))
+        self.assertTrue(storage.has_liked(first_id, self.OTHER_USER))
+        self.assertEqual(storage.count_likes(first_id), 1)
+        self.assertEqual(storage.get_post_stats(first_id, self.OTHER_USER),
+                         (1, 1, True))
+        self.assertEqual(storage.liked_by_user([first_id, second_id],
+                                               self.OTHER_USER),
+                         set([first_id]))
+        self.assertEqual(storage.liked_by_user([first_id], None), set())
+        self.assertEqual(storage.update_post(
+            first_id, {blog.SUBJECT : "edited",
+                       blog.CONTENT : "short"}).content_length, 5)
+        storage.delete_post(first_id)
+        self._runDeferredTasks()
+        self.assertEqual(storage.get_post(first_id), None)
+        self.assertEqual(storage.get_all_comments(first_id), [])
+        self.assertEqual(storage.count_likes(first_id), 0)
+
+    def testNdbStorage(self):
+        '''The datastore backend passes the storage checks.
+        '''
+        self._checkStorage(blog_storage.get_storage("ndb"))
+
+    def testMemoryStorage(self):
+        '''The in-memory backend passes the storage checks.
+        '''
+        self._checkStorage(blog_storage.get_storage("memory"))
+
+    def testSqliteStorage(self):
+        '''The SQLite backend passes the storage checks.
+        '''
+        self._checkStorage(blog_storage.get_storage("sqlite"))
+
+    def testStorageIsAbstract(self):
+        '''Only backends implementing the whole interface can be created.
+        '''
+        self.assertRaises(TypeError, blog_storage.Storage)
+
+
+class testAppOnMemoryStorage(TestBlog):
+    '''
+    Class to test the handlers on a storage backend other than the
+    datastore. Class fields are constants used in testing.
+    '''
+    BACKEND = "memory"
+    AUTHOR = "post_author"
+    READER = "reader"
+    PASSWORD = "test_password"
+
+    def setUp(self):
+        '''Routes the handlers to a new, empty backend.
+        '''
+        super(testAppOnMemoryStorage, self).setUp()
+        self.storage = blog_storage.set_app_backend(self.BACKEND)
+
+    def tearDown(self):
+        '''Routes the handlers back to the configured backend.
+        '''
+        blog_storage.set_app_backend(blog_config.STORAGE_BACKEND,
+                                     **blog_config.STORAGE_OPTIONS)
+        super(testAppOnMemoryStorage, self).tearDown()
+
+    def _request(self, path, form=None, user_name=None):
+        '''Makes a request of the application.
+        @param form: dict of POST items, or None for a GET request
+        @param user_name: the user name of the logged in user, or None
+        '''
+        headers = []
+        if user_name:
+            headers = [("Cookie", util.CookieUtil._format_cookie(blog.USER,
+                                                                 user_name))]
+        return blog.app.get_response(path, POST=form, headers=headers)
+
+    def testSignupAndLogin(self):
+        '''Users sign up to and log in from the backend, not the datastore.
+        '''
+        response = self._request("/blog/signup/display",
+                                 {blog.USER : self.AUTHOR,
+                                  blog.PASSWORD : self.PASSWORD,
+                                  blog.PWD_VERIFY : self.PASSWORD})
+        self.assertEqual(response.status_int, 302)
+        self.assertEqual(self.storage.get_user(self.AUTHOR).user_name,
+                         self.AUTHOR)
+        self.assertEqual(ndb.Key("User", self.AUTHOR).get(), None)
+        response = self._request("/blog/login",
+                                 {blog.USER : self.AUTHOR,
+                                  blog.PASSWORD : self.PASSWORD})
+        self.assertEqual(response.location,
+                         "http://localhost/blog/user_welcome")
+
+    def testPostLifecycle(self):
+        '''Posts, comments and likes are written to the backend, and the
+        pages cached for anonymous visitors follow every write.
+        '''
+        self.storage.create_user(self.AUTHOR, "pwd")
+        self.storage.create_user(self.READER, "pwd")
+        response = self._request("/blog/new_post",
+                                 {blog.SUBJECT : "first subject",
+                                  blog.CONTENT : "first content"},
+                                 self.AUTHOR)
+        post_id = self.storage.most_recent_posts()[0].post_id
+        post_path = "/blog/post_id/" + post_id
+        page_path = post_path + "/display/display"
+        self.assertEqual(response.location, "http://localhost" + page_path)
+        self.assertIn("first content", self._request(page_path).body)
+        self._request(post_path + "/comment/new/display_post",
+                      {blog.CONTENT : "a comment"}, self.READER)
+        self._request(post_path + "/like_post/display_post",
+                      {"like_post" : "like_post_" + post_id}, self.READER)
+        response = self._request(page_path)
+        self.assertIn("a comment", response.body)
+        self.assertIn("Likes: 1", response.body)
+        self.assertIn("first subject",
+                      self._request("/blog/display/home").body)
+        self._request(post_path + "/edit", {blog.SUBJECT : "edited subject",
+                                            blog.CONTENT : "edited content"},
+                      self.AUTHOR)
+        self.assertIn("edited content", self._request(page_path).body)
+        self._request(post_path + "/delete", {}, self.AUTHOR)
+        self.assertEqual(self._request(page_path).status_int, 404)
+        self.assertNotIn("edited subject",
+                         self._request("/blog/display/home").body)
+        self.assertEqual(BlogPost.query().count(), 0)
+
+
+class testAppOnSqliteStorage(testAppOnMemoryStorage):
+    '''
+    Class to test the handlers on an in-memory SQLite database.
+    '''
+    BACKEND = "sqlite"
+
+
+class testCorpusGenerator(TestBlog):
+    '''
+    Class to test the benchmark corpus generator.
+    '''
+    SPEC = corpus_generator.SIZES["tiny"]
+
+    def testDeterministic(self):
+        '''The same seed gives the same corpus, another seed a different one.
+        '''
+        corpora = [corpus_generator.build_corpus(
+                       blog_storage.get_storage("memory"), self.SPEC, seed,
+                       password_hash="hash") for seed in (1, 1, 2)]
+        self.assertEqual(corpora[0], corpora[1])
+        self.assertNotEqual(corpora[0], corpora[2])
+
+    def testNdbCorpus(self):
+        '''A corpus is written through the ndb models and its hot posts draw
+        the most comments.
+        '''
+        storage = blog_storage.get_storage("ndb")
+        corpus = corpus_generator.build_corpus(storage, self.SPEC)
+        self.assertEqual(BlogPost.query().count(), self.SPEC.posts)
+        self.assertEqual(Comment.query().count(), self.SPEC.comments)
+        self.assertEqual(sum(ndb.Key("User", user_name).get().posts_made
+                             for user_name in corpus.user_names),
+                         self.SPEC.posts)
+        comment_counts = sorted(storage.count_comments(post_id)
+                                for post_id in corpus.post_ids)
+        self.assertEqual(storage.count_comments(corpus.hot_post_ids[0]),
+                         comment_counts[-1])
+        user = ndb.Key("User", corpus.user_names[0]).get()
+        self.assertTrue(util.PwdUtil(corpus_generator.CORPUS_PASSWORD,
+                                     user.password).verify_password())
+
+class testLoadGenerator(TestBlog):
+    '''
+    Class to test the load generator.
+    '''
+
+    def testWorkloadFile(self):
+        '''The default workload file parses into weighted steps.
+        '''
+        steps = load_generator.load_workload(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            load_generator.DEFAULT_WORKLOAD))
+        self.assertEqual(len(set(step.name for step in steps)), len(steps))
+        self.assertTrue(all(step.weight > 0 for step in steps))
+
+    def testErrorsCountedOnce(self):
+        '''A failed request is one error, whether or not its status is an
+        error too.
+        '''
+        stats = load_generator.LoadStats()
+        for status in (0, 503, 200):
+            stats.record("login", 0.1, status, True)
+        stats.record("login", 0.1, 302)
+        summaries = stats.summary(1.0)
+        self.assertEqual(summaries["login"]["errors"], 3)
+        self.assertEqual(summaries["all"]["errors"], 3)
+
+    def testInProcessRun(self):
+        '''Virtual users log in with their own cookies and their requests
+        are recorded by step.
+        '''
+        corpus = corpus_generator.build_corpus(
+            blog_storage.get_storage("ndb"), corpus_generator.SIZES["tiny"])
+        steps = [load_generator.Step("post", 1, "GET",
+                                     "/blog/post_id/{post_id}/display/"
+                                     "display_post"),
+                 load_generator.Step("comment", 1, "POST",
+                                     "/blog/post_id/{post_id}/comment/new/"
+                                     "display_post",
+                                     form={blog.CONTENT : "{text}"},
+                                     login=True)]
+        virtual_users = [load_generator.VirtualUser(
+                             load_generator.InProcessSession(
+                                 blog_app.application),
+                             corpus.user_names[index], steps,
+                             corpus.post_ids, index) for index in range(2)]
+        summaries = load_generator.run_users(virtual_users, 1.0,
+                                             0).summary(1.0)
+        self.assertEqual(summaries["all"]["errors"], 0)
+        self.assertTrue(summaries["post"]["requests"] > 0)
+        self.assertEqual(summaries["comment"]["statuses"].keys(), ["302"])
+        self.assertEqual(Comment.query().count(),
+                         corpus_generator.SIZES["tiny"].comments +
+                         summaries["comment"]["requests"])
+
+    def testFailedLogin(self):
+        '''A virtual user whose login is rejected stays logged out, and its
+        logins are counted as errors.
+        '''
+        steps = [load_generator.Step("like", 1, "POST",
+                                     "/blog/post_id/{post_id}/like_post/"
+                                     "display_post", login=True)]
+        virtual_user = load_generator.VirtualUser(
+            load_generator.InProcessSession(blog_app.application),
+            "no_such_user", steps, ["no_such_post"], 0)
+        summaries = load_generator.run_users([virtual_user], 0.5,
+                                             0).summary(0.5)
+        self.assertFalse(virtual_user._logged_in)
+        self.assertTrue(summaries["login"]["requests"] > 1)
+        self.assertEqual(summaries["login"]["errors"],
+                         summaries["login"]["requests"])
+        self.assertEqual(summaries["all"]["errors"],
+                         summaries["login"]["requests"])
+
+class testBenchmarkSuite(TestBlog):
+    '''
+    Class to test the benchmark suite.
+    '''
+
+    def testCompare(self):
+        '''Benchmarks slower than their threshold regress and benchmarks
+        missing from the baseline are new.
+        '''
+        results = {"tiny" : {"a" : {"median_us" : 120.0},
+                             "b" : {"median_us" : 120.0},
+                             "c" : {"median_us" : 50.0},
+                             "d" : {"median_us" : 10.0}}}
+        baseline = {"tiny" : {"a" : {"median_us" : 100.0},
+                              "b" : {"median_us" : 100.0},
+                              "c" : {"median_us" : 100.0}}}
+        rows = benchmark_suite.compare(results, baseline, 10.0, {"b" : 25.0})
+        self.assertEqual([row[5] for row in rows],
+                         ["REGRESSED", "ok", "faster", "new"])
+
+    def testHandlerBenchmark(self):
+        '''A handler benchmark checks the status of its response.
+        '''
+        home = benchmark_suite.Benchmark(
+            "home", lambda: blog_app.app.get_response(
+                benchmark_suite.HOME_PATH), iterations=2, expected_status=200)
+        home.check()
+        timing = home.time(3)
+        self.assertTrue(0 < timing["min_us"] <= timing["median_us"])
+        missing = benchmark_suite.Benchmark(
+            "missing", lambda: blog_app.app.get_response("/missing"),
+            expected_status=200)
+        self.assertRaises(ValueError, missing.check)
+
+class testShardedCounter(TestBlog):
+    '''
+    Class to test sharded counters. Class fields are constants used in testing.
+    '''
+    COUNTER = "test_counter"
+    OTHER_COUNTER = "other_counter"
+
+    def testIncrementAndDecrement(self):
+        '''Increments and decrements are summed across shards.
+        '''
+        for dummy_idx in range(15):
+            sharded_counter.ShardedCounter.increment(self.COUNTER)
+        sharded_counter.ShardedCounter.increment(self.COUNTER, -5)
+        self.assertEqual(
+            sharded_counter.ShardedCounter.get_count(self.COUNTER), 10)
+
+    def testConcurrentIncrements(self):
+        '''Increments made by concurrent tasklets are all counted.
+        '''
+        futures = [sharded_counter.ShardedCounter.increment_async(
+                       self.COUNTER) for dummy_idx in range(5)]
+        ndb.Future.wait_all(futures)
+        counts = sharded_counter.ShardedCounter.get_counts_async(
+            [self.COUNTER, self.OTHER_COUNTER]).get_result()
+        self.assertEqual(counts, {self.COUNTER : 5, self.OTHER_COUNTER : 0})
+
+    def testCountWithoutCache(self):
+        '''Totals are recomputed from the shards when not in memcache.
+        '''
+        sharded_counter.ShardedCounter.increment(self.COUNTER, 3)
+        sharded_counter.ShardedCounter.get_count(self.COUNTER)
+        memcache.flush_all()
+        sharded_counter.ShardedCounter.increment(self.COUNTER, 2)
+        self.assertEqual(
+            sharded_counter.ShardedCounter.get_count(self.COUNTER), 5)
+
+    def testIncrementInvalidatesCache(self):
+        '''A total summed before an increment committed cannot be cached
+        after it.
+        '''
+        sharded_counter.ShardedCounter.increment(self.COUNTER, 3)
+        cache_key = sharded_counter.COUNT_CACHE_PREFIX + self.COUNTER
+        self.assertFalse(memcache.add(cache_key, 0))
+        self.assertEqual(
+            sharded_counter.ShardedCounter.get_count(self.COUNTER), 3)
+
+    def testIncreaseShards(self):
+        '''Increasing the number of shards keeps the total.
+        '''
+        sharded_counter.ShardedCounter.increment(self.COUNTER, 4)
+        sharded_counter.ShardedCounter.increase_shards(self.COUNTER, 50)
+        for dummy_idx in range(6):
+            sharded_counter.ShardedCounter.increment(self.COUNTER)
+        memcache.flush_all()
+        self.assertEqual(
+            sharded_counter.ShardedCounter.get_count(self.COUNTER), 10)
+
+    def testGetCounts(self):
+        '''Several counters are read with one call.
+        '''
+        sharded_counter.ShardedCounter.increment(self.COUNTER, 2)
+        sharded_counter.ShardedCounter.get_count(self.COUNTER)
+        sharded_counter.ShardedCounter.increment(self.OTHER_COUNTER, 7)
+        counts = sharded_counter.ShardedCounter.get_counts(
+            [self.COUNTER, self.OTHER_COUNTER, "unused_counter"])
+        self.assertEqual(counts, {self.COUNTER : 2, self.OTHER_COUNTER : 7,
+                                  "unused_counter" : 0})
+
+class testTemplateLoader(TestBlog):
+    '''
+    Class to test where templates are loaded from.
+    '''
+
+    def setUp(self):
+        super(testTemplateLoader, self).setUp()
+        self.compiled_dir = blog_config.COMPILED_TEMPLATE_DIR
+        blog_config.COMPILED_TEMPLATE_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.rmdir(blog_config.COMPILED_TEMPLATE_DIR)
+        blog_config.COMPILED_TEMPLATE_DIR = self.compiled_dir
+        super(testTemplateLoader, self).tearDown()
+
+    def testSourceOutsideProduction(self):
+        '''Outside of production templates are loaded from source even when
+        compiled templates exist.
+        '''
+        self.assertFalse(blog_config.PRODUCTION)
+        self.assertTrue(isinstance(blog_handler._template_loader(),
+                                   jinja2.FileSystemLoader))
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()